@@ -0,0 +1,215 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+from function_model_worker import CoreFunction, precomputeLargestDeviations
+from calculations_worker import minimiseLossBatch, classifyBatch
+from mapping_worker import writeClassificationToSqlite, getDatabaseEngine
+from instrumentation_worker import INSTRUMENTATION, span
+
+
+"""
+This script benchmarks the end-to-end mapping pipeline on synthetic data:
+1. Generate ideal, training and test CSV files at a configurable scale
+2. Time every stage of the pipeline and record its peak memory
+3. Report the results as JSON and compare them against an earlier report
+"""
+
+def generateDatasets(directory, rows, idealColumns, trainColumns, testPoints, seed=0):
+    """
+    This function writes synthetic ideal.csv, train.csv and test.csv files to a directory.
+    Every training function is a noisy copy of a random ideal function, and most test points
+    are close to one of those ideal functions. It returns the paths of the three files.
+    """
+    generator = np.random.default_rng(seed)
+    x = np.round(-20.0 + 0.1 * np.arange(rows), 1)
+
+    # A mix of periodic, polynomial and linear shapes, like the sample ideal catalog
+    amplitudes = generator.uniform(0.5, 20.0, idealColumns)
+    frequencies = generator.uniform(0.1, 2.0, idealColumns)
+    offsets = generator.uniform(-10.0, 10.0, idealColumns)
+    shapes = np.arange(idealColumns) % 3
+    idealValues = np.where(shapes == 0, amplitudes * np.sin(np.outer(x, frequencies)),
+                           np.where(shapes == 1, amplitudes * 1e-3 * np.outer(x, np.ones(idealColumns)) ** 2,
+                                    np.outer(x, frequencies))) + offsets
+    ideal = pd.DataFrame(idealValues, columns=[f"y{index}" for index in range(1, idealColumns + 1)])
+    ideal.insert(0, "x", x)
+
+    chosen = generator.choice(idealColumns, size=trainColumns, replace=trainColumns > idealColumns)
+    train = pd.DataFrame(idealValues[:, chosen] + generator.normal(0.0, 0.3, (rows, trainColumns)),
+                         columns=[f"y{index}" for index in range(1, trainColumns + 1)])
+    train.insert(0, "x", x)
+
+    testRows = generator.integers(0, rows, testPoints)
+    testIdeals = chosen[generator.integers(0, trainColumns, testPoints)]
+    test = pd.DataFrame({"x": x[testRows],
+                         "y": idealValues[testRows, testIdeals] + generator.normal(0.0, 0.5, testPoints)})
+
+    paths = []
+    for name, dataset in (("ideal", ideal), ("train", train), ("test", test)):
+        path = os.path.join(directory, f"{name}.csv")
+        dataset.to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def runBenchmark(directory, rows, idealColumns, trainColumns, testPoints, plots=False, traceMemory=True):
+    """
+    This function generates the synthetic data in a directory and runs the pipeline on it stage by stage.
+    The wall and CPU times come from a run without memory tracing, since tracemalloc slows down every allocation
+    and the pure Python stages most of all. With traceMemory, the pipeline runs a second time with tracemalloc
+    on, only to record the peak memory of every stage. It returns the report as a dictionary.
+    """
+    paths = generateDatasets(directory, rows, idealColumns, trainColumns, testPoints)
+    stages = ["load", "to_sql", "minimiseLoss", "classification", "writeToSqlite"] + (["plotting"] if plots else [])
+
+    run = _runPipeline(directory, paths, "solution.db", rows, idealColumns, trainColumns, testPoints, plots,
+                       traceMemory=False)
+    if traceMemory:
+        memoryRun = _runPipeline(directory, paths, "solution-memory.db", rows, idealColumns, trainColumns,
+                                 testPoints, plots, traceMemory=True)
+        for name, statistics in run["spans"].items():
+            statistics["peak_bytes"] = memoryRun["spans"].get(name, {}).get("peak_bytes")
+
+    # The spans of the instrumented worker functions break the stages down further
+    return {
+        "config": {"rows": rows, "ideal_columns": idealColumns, "train_columns": trainColumns,
+                   "test_points": testPoints, "plots": plots, "memory_pass": traceMemory},
+        "environment": environmentInfo(),
+        "stages": {stage: run["spans"][stage] for stage in stages},
+        "functions": {name: statistics for name, statistics in run["spans"].items() if name not in stages},
+        "counters": run["counters"],
+    }
+
+
+def _runPipeline(directory, paths, databaseName, rows, idealColumns, trainColumns, testPoints, plots, traceMemory):
+    """
+    This function runs every stage of the pipeline once on the generated files, with the instrumentation
+    enabled, and returns the run report of the instrumentation.
+    """
+    idealPath, trainPath, testPath = paths
+    databasePath = os.path.join(directory, databaseName)
+    INSTRUMENTATION.reset()
+    INSTRUMENTATION.enable(traceMemory=traceMemory)
+
+    with span("load", rows * (idealColumns + trainColumns) + testPoints):
+        idealDataset = CoreFunction(idealPath)
+        trainDataset = CoreFunction(trainPath)
+        testDataset = CoreFunction(testPath)
+
+    with span("to_sql", rows * (idealColumns + trainColumns)):
+        idealDataset.to_sql(file_name="ideal", suffix=" (ideal function)", database_path=databasePath)
+        trainDataset.to_sql(file_name="training", suffix=" (training function)", database_path=databasePath)
+
+    with span("minimiseLoss", rows * idealColumns * trainColumns):
+        idealFunctions, _ = minimiseLossBatch(trainDataset, idealDataset.functions)
+        for idealFunction in idealFunctions:
+            idealFunction.toleranceFactor = np.sqrt(2)
+        precomputeLargestDeviations(idealFunctions)
+
+    with span("classification", testPoints):
+        classification = classifyBatch(testDataset.functions[0], idealFunctions)
+
+    with span("writeToSqlite", testPoints):
+        writeClassificationToSqlite(classification, databasePath=databasePath)
+
+    if plots:
+        # Imported here, so that runs without plots don't need bokeh
+        from visualisation_worker import plotIdealFunctions, plotClassificationsByIdealFunction
+
+        # The same plots as main.py, whose size doesn't grow with the number of test points
+        with span("plotting", testPoints):
+            plotIdealFunctions(idealFunctions, "ideal-functions-vs-training-data", outputDirectory=directory)
+            plotClassificationsByIdealFunction(classification, "test-functions-vs-ideal-functions",
+                                               outputDirectory=directory)
+
+    INSTRUMENTATION.disable()
+    getDatabaseEngine(databasePath).dispose()
+    return INSTRUMENTATION.report()
+
+
+def environmentInfo():
+    """
+    This function describes the environment of a run, so that reports of different commits can be compared.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "numpy": np.__version__,
+            "pandas": pd.__version__, "machine": platform.machine(), "cpus": os.cpu_count()}
+
+
+def compareReports(report, baseline, tolerance):
+    """
+    This function compares the wall time of every stage with a baseline report.
+    It returns the list of stages that got slower than the baseline by more than the tolerance factor.
+    The wall times of runs at a different scale, or with other options, aren't comparable, so it raises a
+    ValueError when the configs of the two reports differ.
+    """
+    if report.get("config") != baseline.get("config"):
+        raise ValueError(f"The baseline was run with {baseline.get('config')}, but this run with "
+                         f"{report.get('config')}. Run the benchmark with the options of the baseline to compare.")
+    regressions = []
+    for stage, result in report["stages"].items():
+        baselineResult = baseline.get("stages", {}).get(stage)
+        if baselineResult is None or not baselineResult["wall_s"]:
+            continue
+        ratio = result["wall_s"] / baselineResult["wall_s"]
+        result["baseline_ratio"] = ratio
+        if ratio > tolerance:
+            regressions.append(stage)
+    return regressions
+
+
+def parseArguments():
+    """
+    This function parses the command line options of the benchmark
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks the mapping pipeline on synthetic data")
+    parser.add_argument("--rows", type=int, default=400, help="Rows of the ideal and training data")
+    parser.add_argument("--ideal-columns", type=int, default=50, help="Number of ideal functions")
+    parser.add_argument("--train-columns", type=int, default=4, help="Number of training functions")
+    parser.add_argument("--test-points", type=int, default=100, help="Number of test points")
+    parser.add_argument("--plots", action="store_true", help="Also time the Bokeh plotting stage")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="Skip the second, memory traced run that records the peak memory of every stage")
+    parser.add_argument("--output", default=None, help="Write the JSON report to this file instead of stdout")
+    parser.add_argument("--compare", default=None, help="JSON report of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="Slowdown factor of a stage compared to --compare that counts as a regression")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parseArguments()
+
+    with tempfile.TemporaryDirectory() as directory:
+        report = runBenchmark(directory, arguments.rows, arguments.ideal_columns, arguments.train_columns,
+                              arguments.test_points, plots=arguments.plots, traceMemory=not arguments.no_memory)
+
+    regressions = []
+    if arguments.compare:
+        with open(arguments.compare) as baselineFile:
+            try:
+                regressions = compareReports(report, json.load(baselineFile), arguments.tolerance)
+            except ValueError as error:
+                sys.exit(f"Can't compare with {arguments.compare}: {error}")
+        report["regressions"] = regressions
+
+    if arguments.output:
+        with open(arguments.output, "w") as outputFile:
+            json.dump(report, outputFile, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if regressions:
+        print(f"Stages slower than the baseline by more than {arguments.tolerance}x: {', '.join(regressions)}", file=sys.stderr)
+        sys.exit(1)
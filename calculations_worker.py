@@ -1,13 +1,37 @@
+import heapq
+import itertools
 import logging
-from function_model_worker import IdealFunction
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+import pandas as pd
+from function_model_worker import CoreFunction, Function, IdealFunction, MappingResult, functionMatrix, locateYMatrix, \
+    sharesGrid
+from instrumentation_worker import instrumented
+from logging_worker import RateLimitedLogger
 
+# Per-call messages of the hot functions, emitted at DEBUG level and at most once per second
+hotPathLog = RateLimitedLogger(logging.getLogger(__name__))
 
-def minimiseLoss(trainFunction, listOfCandidateFunctions, lossFunction):
+
+@instrumented()
+def minimiseLoss(trainFunction, listOfCandidateFunctions, lossFunction, topK=None):
     """
     This function finds the function with the minimum loss based on a training function and a list of candidate functions.
     It returns an IdealFunction object with the data of the function with the smallest error.
+    With topK, it returns a list of the topK IdealFunction objects with the smallest errors instead, best first
+    and ties in candidate order. For errorSquared the ranking abandons hopeless candidates early (see rankCandidates).
     """
-    logging.info(f"Invoking minimiseLoss with trainFunction={trainFunction}, listOfCandidateFunctions={listOfCandidateFunctions}, lossFunction={lossFunction}")
+    hotPathLog.debug("Invoking minimiseLoss with trainFunction=%s, listOfCandidateFunctions=%s, lossFunction=%s",
+                     trainFunction, listOfCandidateFunctions, lossFunction)
+
+    if topK is not None:
+        if lossFunction is errorSquared:
+            return rankCandidates(trainFunction, listOfCandidateFunctions, topK)
+        errors = [lossFunction(trainFunction, candidateFunction) for candidateFunction in listOfCandidateFunctions]
+        ranking = heapq.nsmallest(topK, range(len(errors)), key=lambda index: (errors[index], index))
+        return [IdealFunction(functionData=listOfCandidateFunctions[index], trainingFunction=trainFunction, error=errors[index])
+                for index in ranking]
     
     functionWithSmallestError = None
     smallestError = None
@@ -24,19 +48,110 @@ def minimiseLoss(trainFunction, listOfCandidateFunctions, lossFunction):
                           error=smallestError)
 
 
-def findClassification(point, idealFunctions):
+@instrumented()
+def rankCandidates(trainFunction, candidateFunctions, k, blockSize=4096):
+    """
+    This function returns the k candidate functions with the smallest squared error, best first,
+    as a list of IdealFunction objects. Ties keep the candidate order.
+
+    The squared errors are accumulated over blocks of rows. The k candidates with the smallest error over
+    the first block are completed first; the largest of their errors bounds the k-th best error, so every
+    other candidate is abandoned as soon as its partial sum exceeds that bound.
+    """
+    candidateFunctions = list(candidateFunctions)
+    k = min(k, len(candidateFunctions))
+    if k <= 0:
+        return []
+
+    trainValues = trainFunction.yValues
+    idealMatrix = functionMatrix(candidateFunctions)
+    _checkMatchingRows(trainValues[:, None], idealMatrix)
+    rowCount = len(trainValues)
+
+    def blockErrors(start, candidates):
+        distances = idealMatrix[start:start + blockSize, candidates] - trainValues[start:start + blockSize, None]
+        return np.einsum("ij,ij->j", distances, distances)
+
+    everyCandidate = np.arange(len(candidateFunctions))
+    partialErrors = blockErrors(0, everyCandidate)
+
+    # Complete the most promising candidates first, their k-th error bounds the final ranking
+    seeds = np.sort(np.argpartition(partialErrors, k - 1)[:k])
+    for start in range(blockSize, rowCount, blockSize):
+        partialErrors[seeds] += blockErrors(start, seeds)
+    threshold = np.max(partialErrors[seeds])
+
+    others = np.setdiff1d(everyCandidate, seeds, assume_unique=True)
+    active = others[partialErrors[others] <= threshold]
+    for start in range(blockSize, rowCount, blockSize):
+        if len(active) == 0:
+            break
+        partialErrors[active] += blockErrors(start, active)
+        active = active[partialErrors[active] <= threshold]
+
+    finished = np.concatenate([seeds, active])
+    ranking = finished[np.lexsort((finished, partialErrors[finished]))][:k]
+    return [IdealFunction(functionData=candidateFunctions[index], trainingFunction=trainFunction,
+                          error=float(partialErrors[index]))
+            for index in ranking]
+
+
+# How the y value of an ideal function is looked up at the x value of a test point
+LOOKUP_POLICIES = ("exact", "nearest", "linear", "cubic")
+
+
+def locateY(function, x, lookup="exact", outOfRange="raise"):
+    """
+    This function returns the y value(s) of a function at x value(s) following a lookup policy.
+    "exact" requires x to be on the grid of the function, the other policies interpolate between grid points.
+    It raises an IndexError when an x value can't be looked up. With outOfRange="nan", the interpolating
+    policies give NaN for x values outside the range of the grid instead.
+    """
+    if lookup == "exact":
+        return function.locateYBasedOnX(x)
+    if lookup not in LOOKUP_POLICIES:
+        raise ValueError(f"Unknown lookup policy {lookup}, expected one of {', '.join(LOOKUP_POLICIES)}.")
+    return function.interpolateYBasedOnX(x, method=lookup, outOfRange=outOfRange)
+
+
+def checkBandIndexLookup(bandIndex, lookup):
+    """
+    This function raises a ValueError when a ToleranceBandIndex is combined with an interpolated lookup,
+    so that callers holding both can reject them before classifying anything.
+    """
+    if bandIndex is not None and lookup != "exact":
+        raise ValueError("A tolerance band index only supports the exact lookup policy.")
+
+
+@instrumented()
+def findClassification(point, idealFunctions, bandIndex=None, lookup="exact"):
     """
     This function finds the classification of a point with respect to a list of ideal functions.
+    With a ToleranceBandIndex built over the same ideal functions, only the ideal functions whose
+    tolerance band can contain the point are visited.
+    The lookup policy ("exact", "nearest", "linear" or "cubic") decides how off-grid x values are handled.
+    With an interpolating policy, a point outside the x range of an ideal function can't be classified by it.
     It returns a tuple containing the ideal function with the lowest distance and the distance itself.
     """
-    logging.info(f"Invoking findClassification with point={point}, idealFunctions={idealFunctions}")
+    hotPathLog.debug("Invoking findClassification with point=%s, idealFunctions=%s", point, idealFunctions)
+
+    checkBandIndexLookup(bandIndex, lookup)
+    if bandIndex is not None:
+        try:
+            idealIndex, distance = bandIndex.query(point["x"], point["y"])
+        except IndexError as e:
+            logging.error(f"IndexError occurred while locating y for point {point}: {e}")
+            raise
+        if idealIndex < 0:
+            return None, None
+        return idealFunctions[idealIndex], distance
     
     lowestClassification = None
     lowestDistance = None
 
     for idealFunction in idealFunctions:
         try:
-            yLocation = idealFunction.locateYBasedOnX(point["x"])
+            yLocation = locateY(idealFunction, point["x"], lookup, outOfRange="nan")
         except IndexError as e:
             logging.error(f"IndexError occurred while locating y for point {point}: {e}")
             raise
@@ -53,13 +168,749 @@ def findClassification(point, idealFunctions):
     return lowestClassification, lowestDistance
 
 
+def classifyBatch(testFunction, idealFunctions, bandIndex=None, lookup="exact"):
+    """
+    This function classifies every point of a test function against a list of ideal functions at once.
+    It gives the same results as calling findClassification for each point, in a single vectorized pass.
+    An optional ToleranceBandIndex over the same ideal functions prunes the candidates of every point.
+    It returns a MappingResult. Points without a classification have the ideal index -1 and a delta y of NaN.
+    """
+    try:
+        return classifyPoints(testFunction.xValues, testFunction.yValues, idealFunctions,
+                              bandIndex=bandIndex, lookup=lookup)
+    except IndexError as e:
+        logging.error(f"IndexError occurred while locating y values for {testFunction.name}: {e}")
+        raise
+
+
+@instrumented(rows=lambda xValues, *args, **kwargs: len(xValues))
+def classifyPoints(xValues, yValues, idealFunctions, tolerances=None, bandIndex=None, lookup="exact"):
+    """
+    This function classifies arrays of x and y values against a list of ideal functions, like classifyBatch.
+    The tolerances of the ideal functions can be passed in, otherwise they are read from the functions.
+    With an interpolating lookup, points outside the x range of the ideal functions stay unclassified and are
+    reported, instead of failing the whole batch.
+    It returns a MappingResult.
+    """
+    checkBandIndexLookup(bandIndex, lookup)
+    if bandIndex is not None:
+        idealIndexes, deltaY = bandIndex.classify(xValues, yValues)
+        return MappingResult(xValues, yValues, idealIndexes, deltaY, idealFunctions)
+    if tolerances is None:
+        tolerances = [idealFunction.tolerance for idealFunction in idealFunctions]
+    idealIndexes = np.full(len(xValues), -1, dtype=np.int16)
+    deltaY = np.full(len(xValues), np.nan)
+    if not idealFunctions or len(xValues) == 0:
+        return MappingResult(xValues, yValues, idealIndexes, deltaY, idealFunctions)
+
+    if lookup not in LOOKUP_POLICIES:
+        raise ValueError(f"Unknown lookup policy {lookup}, expected one of {', '.join(LOOKUP_POLICIES)}.")
+    # Ideal functions on one grid locate every x value once, and read all their y values in one gather
+    yMatrix = locateYMatrix(idealFunctions, xValues, lookup, outOfRange="nan")
+    if lookup != "exact":
+        outOfRange = np.count_nonzero(np.all(np.isnan(yMatrix), axis=1))
+        if outOfRange:
+            logging.warning(f"{outOfRange} test points are outside the x range of the ideal functions and stay unclassified")
+    distances = np.abs(yMatrix - yValues[:, np.newaxis])
+    # Points outside the tolerance band can never be classified by this ideal function
+    distances[~(distances < np.asarray(tolerances, dtype=np.float64))] = np.inf
+
+    # argmin keeps the first ideal function on ties, like the per-point loop
+    bestColumns = np.argmin(distances, axis=1)
+    bestDistances = distances[np.arange(len(xValues)), bestColumns]
+    classified = np.isfinite(bestDistances)
+    idealIndexes[classified] = bestColumns[classified]
+    deltaY[classified] = bestDistances[classified]
+    return MappingResult(xValues, yValues, idealIndexes, deltaY, idealFunctions)
+
+
+@instrumented()
+def classifyBatchParallel(testFunction, idealFunctions, workers, chunkSize=None, useProcesses=False, bandIndex=None,
+                          lookup="exact"):
+    """
+    This function gives the same result as classifyBatch, with the test points split into chunks that are
+    classified concurrently by classifyBatchChunks. The chunk results are merged back in the original row order.
+    It returns a MappingResult.
+    """
+    if chunkSize is None:
+        chunkSize = max(10000, -(-len(testFunction.xValues) // (max(workers, 1) * 4)))
+    if workers <= 1 or len(testFunction.xValues) <= chunkSize:
+        return classifyBatch(testFunction, idealFunctions, bandIndex=bandIndex, lookup=lookup)
+    return MappingResult.concatenate(classifyBatchChunks(testFunction, idealFunctions, chunkSize, workers, useProcesses,
+                                                         bandIndex, lookup))
+
+
+def classifyBatchChunks(testFunction, idealFunctions, chunkSize, workers=1, useProcesses=False, bandIndex=None,
+                        lookup="exact"):
+    """
+    This function classifies the points of a test function in consecutive chunks and yields the MappingResult of
+    every chunk in order, so the results of the first chunks can be written while the others are classified.
+    With more than one worker the chunks are classified concurrently, at most `workers` chunks ahead of the
+    consumer. Threads are used by default, since the NumPy kernels release the GIL; with useProcesses the chunks
+    go to a process pool that receives a compact copy of the ideal functions once.
+    """
+    xValues = testFunction.xValues
+    yValues = testFunction.yValues
+    # Resolve the tolerances and build the lookup caches up front, so the chunks only read shared state
+    checkBandIndexLookup(bandIndex, lookup)
+    tolerances = [idealFunction.tolerance for idealFunction in idealFunctions]
+    for idealFunction in idealFunctions:
+        locateY(idealFunction, xValues[:0], lookup)
+
+    def classifyChunk(start):
+        return classifyPoints(xValues[start:start + chunkSize], yValues[start:start + chunkSize], idealFunctions,
+                              tolerances, bandIndex, lookup)
+
+    def chunkResult(start, future):
+        if not useProcesses:
+            return future.result()
+        # The workers only send back the index and delta y columns, the name table stays in this process
+        idealIndexes, deltaY = future.result()
+        return MappingResult(xValues[start:start + chunkSize], yValues[start:start + chunkSize], idealIndexes, deltaY,
+                             idealFunctions)
+
+    starts = range(0, len(xValues), chunkSize)
+    try:
+        if workers <= 1:
+            for start in starts:
+                yield classifyChunk(start)
+            return
+        if useProcesses:
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_setClassificationFunctions,
+                                           initargs=(_compactFunctions(idealFunctions), tolerances, bandIndex, lookup))
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers)
+        with executor:
+            pending = []
+            for start in starts:
+                if useProcesses:
+                    future = executor.submit(_classifyChunk, (xValues[start:start + chunkSize],
+                                                              yValues[start:start + chunkSize]))
+                else:
+                    future = executor.submit(classifyChunk, start)
+                pending.append((start, future))
+                if len(pending) > workers:
+                    yield chunkResult(*pending.pop(0))
+            for start, future in pending:
+                yield chunkResult(start, future)
+    except IndexError as e:
+        logging.error(f"IndexError occurred while locating y values for {testFunction.name}: {e}")
+        raise
+
+
+def _compactFunctions(idealFunctions):
+    """
+    Copies the x and y values of the ideal functions into one matrix for the worker processes, or into one matrix
+    per function when they don't share their x grid, so the workers don't receive the data frames.
+    """
+    if sharesGrid(idealFunctions):
+        matrix = np.column_stack([idealFunctions[0].xValues, functionMatrix(idealFunctions)])
+        return [Function.from_matrix(idealFunction.name, matrix, column + 1)
+                for column, idealFunction in enumerate(idealFunctions)]
+    return [Function.from_matrix(idealFunction.name, np.column_stack([idealFunction.xValues, idealFunction.yValues]), 1)
+            for idealFunction in idealFunctions]
+
+
+_classificationFunctions = None
+
+
+def _setClassificationFunctions(idealFunctions, tolerances, bandIndex, lookup):
+    """
+    Pool initializer storing the compact ideal functions, their tolerances, the band index and the lookup policy
+    in a worker process.
+    """
+    global _classificationFunctions
+    _classificationFunctions = (idealFunctions, tolerances, bandIndex, lookup)
+
+
+def _classifyChunk(chunk):
+    """
+    Classifies one chunk of (x values, y values) in a worker process and returns its (ideal index, delta y) arrays.
+    """
+    xValues, yValues = chunk
+    idealFunctions, tolerances, bandIndex, lookup = _classificationFunctions
+    result = classifyPoints(xValues, yValues, idealFunctions, tolerances, bandIndex, lookup)
+    return result.idealIndexes, result.deltaY
+
+
+class ToleranceBandIndex:
+    """
+    A per-x index of the tolerance bands [y - tolerance, y + tolerance] of a list of ideal functions.
+    For every x of the grid the band centers are kept sorted, so a point only visits the ideal functions
+    whose center lies within the widest tolerance of it: O(log k) plus the few overlapping bands.
+    Classifications are identical to checking every ideal function, including the first-wins tie order.
+
+    Attributes:
+        gridX (numpy.ndarray): The sorted, unique x values of the grid.
+        centers (numpy.ndarray): The (grid x functions) y values, sorted within every row.
+        order (numpy.ndarray): The ideal function index of every entry of centers.
+        tolerances (numpy.ndarray): The tolerance of every ideal function.
+        maxTolerance (float): The widest tolerance.
+    """
+
+    def __init__(self, idealFunctions):
+        """
+        Builds the index over the x grid of the first ideal function.
+
+        Args:
+            idealFunctions (list): A list of `IdealFunction` objects sharing the same x grid.
+        """
+        idealFunctions = list(idealFunctions)
+        if not idealFunctions:
+            raise ValueError("At least one ideal function is required to build a tolerance band index.")
+
+        self.gridX = np.unique(idealFunctions[0].xValues)
+        try:
+            yMatrix = locateYMatrix(idealFunctions, self.gridX)
+        except IndexError as e:
+            raise ValueError("The ideal functions of a tolerance band index must share the same x grid.") from e
+
+        # Ties between equal centers are resolved by the ideal function index when classifying, so any order works
+        self.order = np.argsort(yMatrix, axis=1).astype(np.int32)
+        self.centers = np.take_along_axis(yMatrix, self.order, axis=1)
+        self.tolerances = np.array([idealFunction.tolerance for idealFunction in idealFunctions], dtype=np.float64)
+        self.maxTolerance = float(np.max(self.tolerances))
+
+    def _locateGridRows(self, xValues):
+        """
+        Returns the grid rows of exact x values, raising an IndexError if one is not on the grid.
+        """
+        rows = np.minimum(np.searchsorted(self.gridX, xValues), len(self.gridX) - 1)
+        if not np.all(self.gridX[rows] == xValues):
+            raise IndexError("Y value not found for given X value.")
+        return rows
+
+    def _searchRows(self, rows, values, side):
+        """
+        Returns, for every value, the position of values[i] in the sorted centers of rows[i], like np.searchsorted
+        on that row. All the rows are bisected at once, in about log2(functions) vectorized steps.
+        """
+        low = np.zeros(len(rows), dtype=np.intp)
+        high = np.full(len(rows), self.centers.shape[1], dtype=np.intp)
+        while True:
+            searching = low < high
+            if not np.any(searching):
+                return low
+            middle = (low + high) // 2
+            centers = self.centers[rows, np.minimum(middle, self.centers.shape[1] - 1)]
+            goRight = searching & ((centers <= values) if side == "right" else (centers < values))
+            low = np.where(goRight, middle + 1, low)
+            high = np.where(searching & ~goRight, middle, high)
+
+    def _window(self, y):
+        """
+        Returns the half-width of the center range that can contain bands covering y.
+        It is slightly wider than the widest tolerance, so rounding never drops a candidate.
+        """
+        return self.maxTolerance + 4 * np.finfo(np.float64).eps * (np.abs(y) + self.maxTolerance)
+
+    def query(self, x, y):
+        """
+        Classifies a single point.
+
+        Args:
+            x (float): The x value of the point, which must be on the grid.
+            y (float): The y value of the point.
+
+        Returns:
+            A tuple (ideal function index, distance), or (-1, None) when no band contains the point.
+        """
+        row = int(self._locateGridRows(np.asarray(x, dtype=np.float64)))
+        centers = self.centers[row]
+        window = self._window(y)
+        start = int(np.searchsorted(centers, y - window, side="right"))
+        stop = int(np.searchsorted(centers, y + window, side="left"))
+
+        bestIndex, bestDistance = -1, None
+        for position in range(start, stop):
+            idealIndex = int(self.order[row, position])
+            distance = abs(centers[position] - y)
+            if distance < self.tolerances[idealIndex] and (
+                    bestDistance is None or distance < bestDistance or (distance == bestDistance and idealIndex < bestIndex)):
+                bestIndex, bestDistance = idealIndex, distance
+        return bestIndex, bestDistance
+
+    def classify(self, xValues, yValues):
+        """
+        Classifies arrays of points at once.
+
+        Args:
+            xValues (numpy.ndarray): The x values of the points, which must be on the grid.
+            yValues (numpy.ndarray): The y values of the points.
+
+        Returns:
+            A tuple of arrays (ideal function index, delta y), with -1 and NaN for unclassified points.
+        """
+        xValues = np.asarray(xValues, dtype=np.float64)
+        yValues = np.asarray(yValues, dtype=np.float64)
+        idealIndexes = np.full(len(xValues), -1, dtype=np.intp)
+        deltaY = np.full(len(xValues), np.nan)
+        if len(xValues) == 0:
+            return idealIndexes, deltaY
+
+        rows = self._locateGridRows(xValues)
+        window = self._window(yValues)
+        starts = self._searchRows(rows, yValues - window, side="right")
+        stops = self._searchRows(rows, yValues + window, side="left")
+
+        # Every (point, center) pair within the window, flattened, so all candidates are checked in one pass
+        counts = np.maximum(stops - starts, 0)
+        points = np.repeat(np.arange(len(xValues)), counts)
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(len(points))
+        candidates = self.order[rows[points], positions]
+        distances = np.abs(self.centers[rows[points], positions] - yValues[points])
+        inBand = distances < self.tolerances[candidates]
+        points, candidates, distances = points[inBand], candidates[inBand], distances[inBand]
+
+        # The first candidate of every point after sorting by distance and index wins, like the dense argmin
+        best = np.lexsort((candidates, distances, points))
+        first = np.ones(len(best), dtype=bool)
+        first[1:] = points[best[1:]] != points[best[:-1]]
+        best = best[first]
+        idealIndexes[points[best]] = candidates[best]
+        bestDistances = np.full(len(xValues), np.inf)
+        bestDistances[points[best]] = distances[best]
+
+        classified = idealIndexes >= 0
+        deltaY[classified] = bestDistances[classified]
+        return idealIndexes, deltaY
+
+
+@instrumented()
 def errorSquared(firstFunction, secondFunction):
     """
     This function calculates the squared error based on the distance between two functions.
     It returns the sum of squared distances.
     """
-    logging.info(f"Invoking errorSquared with firstFunction={firstFunction}, secondFunction={secondFunction}")
+    hotPathLog.debug("Invoking errorSquared with firstFunction=%s, secondFunction=%s", firstFunction, secondFunction)
     
     distances = secondFunction - firstFunction
     distances["y"] = distances["y"] ** 2
     return sum(distances["y"])
+
+
+def squaredErrorMatrix(trainMatrix, idealMatrix):
+    """
+    This function calculates the sum of squared errors for every pair of train and ideal columns.
+    It returns a (train x ideal) matrix computed in one BLAS pass as ||a||^2 + ||b||^2 - 2a.b.
+
+    The expansion is prone to cancellation, so every entry that could compete with the row minimum
+    is recomputed exactly from the differences. That keeps the chosen ideal functions identical to
+    the pairwise errorSquared loop.
+    """
+    trainMatrix = np.asarray(trainMatrix, dtype=np.float64)
+    idealMatrix = np.asarray(idealMatrix, dtype=np.float64)
+    _checkMatchingRows(trainMatrix, idealMatrix)
+
+    trainNorms = np.einsum("ij,ij->j", trainMatrix, trainMatrix)
+    idealNorms = np.einsum("ij,ij->j", idealMatrix, idealMatrix)
+    errors = trainNorms[:, None] + idealNorms[None, :]
+    errors -= 2.0 * (trainMatrix.T @ idealMatrix)
+    np.maximum(errors, 0.0, out=errors)
+
+    # Bound of the rounding error introduced by the expansion for every entry
+    slack = 4.0 * np.finfo(np.float64).eps * max(trainMatrix.shape[0], 1) * (trainNorms[:, None] + idealNorms[None, :])
+    rowCeiling = np.min(errors + slack, axis=1)
+    trainIndexes, idealIndexes = np.nonzero(errors - slack <= rowCeiling[:, None])
+    for trainIndex, idealIndex in zip(trainIndexes, idealIndexes):
+        distances = idealMatrix[:, idealIndex] - trainMatrix[:, trainIndex]
+        errors[trainIndex, idealIndex] = np.dot(distances, distances)
+
+    return errors
+
+
+def _checkMatchingRows(trainMatrix, idealMatrix):
+    """
+    Raises a ValueError when the train and ideal matrices don't have the same number of rows.
+    """
+    if trainMatrix.shape[0] != idealMatrix.shape[0]:
+        raise ValueError(f"Train and ideal data must have the same number of rows, "
+                         f"got {trainMatrix.shape[0]} and {idealMatrix.shape[0]}.")
+
+
+# Largest number of distances computed at once by the absolute distance losses, 8 MB of float64
+DISTANCE_BLOCK_ELEMENTS = 1 << 20
+
+
+def _absoluteDistanceReduction(trainMatrix, idealMatrix, reduce):
+    """
+    Applies a column reduction to the absolute distances of every training column to all ideal columns.
+    The ideal columns are processed in blocks of about DISTANCE_BLOCK_ELEMENTS distances, one training column
+    at a time, so memory doesn't grow with the number of ideal functions.
+    """
+    trainMatrix = np.asarray(trainMatrix, dtype=np.float64)
+    idealMatrix = np.asarray(idealMatrix, dtype=np.float64)
+    _checkMatchingRows(trainMatrix, idealMatrix)
+    errors = np.empty((trainMatrix.shape[1], idealMatrix.shape[1]))
+    blockColumns = max(1, DISTANCE_BLOCK_ELEMENTS // max(idealMatrix.shape[0], 1))
+    distances = np.empty((idealMatrix.shape[0], min(blockColumns, idealMatrix.shape[1])))
+    for start in range(0, idealMatrix.shape[1], blockColumns):
+        idealBlock = idealMatrix[:, start:start + blockColumns]
+        blockDistances = distances[:, :idealBlock.shape[1]]
+        for trainIndex in range(trainMatrix.shape[1]):
+            np.subtract(idealBlock, trainMatrix[:, trainIndex, None], out=blockDistances)
+            np.abs(blockDistances, out=blockDistances)
+            errors[trainIndex, start:start + idealBlock.shape[1]] = reduce(blockDistances)
+    return errors
+
+
+def weightedSquaredErrorMatrix(trainMatrix, idealMatrix, weights=None):
+    """
+    This function calculates the sum of row-weighted squared errors for every pair of train and ideal columns.
+    Scaling both matrices by the square root of the weights turns it into a plain squaredErrorMatrix.
+    Without weights it is the same as squaredErrorMatrix.
+    """
+    if weights is None:
+        return squaredErrorMatrix(trainMatrix, idealMatrix)
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.shape != (np.shape(trainMatrix)[0],):
+        raise ValueError(f"The weighted squared error needs one weight per row, got {weights.size} weights "
+                         f"for {np.shape(trainMatrix)[0]} rows.")
+    if np.any(weights < 0):
+        raise ValueError("The weights of the weighted squared error must not be negative.")
+    scale = np.sqrt(weights)[:, None]
+    return squaredErrorMatrix(np.asarray(trainMatrix) * scale, np.asarray(idealMatrix) * scale)
+
+
+def meanAbsoluteErrorMatrix(trainMatrix, idealMatrix):
+    """
+    This function calculates the mean absolute error for every pair of train and ideal columns.
+    """
+    return _absoluteDistanceReduction(trainMatrix, idealMatrix, lambda distances: distances.mean(axis=0))
+
+
+def maxAbsoluteErrorMatrix(trainMatrix, idealMatrix):
+    """
+    This function calculates the largest absolute error (Chebyshev distance) for every pair of train and ideal columns.
+    """
+    return _absoluteDistanceReduction(trainMatrix, idealMatrix, lambda distances: distances.max(axis=0))
+
+
+def huberLossMatrix(trainMatrix, idealMatrix, delta=1.0):
+    """
+    This function calculates the Huber loss for every pair of train and ideal columns: squared for distances
+    up to delta and linear beyond, so single outliers weigh less than with the squared error.
+    """
+    def huber(distances):
+        return np.where(distances <= delta, 0.5 * distances ** 2, delta * (distances - 0.5 * delta)).sum(axis=0)
+    return _absoluteDistanceReduction(trainMatrix, idealMatrix, huber)
+
+
+class LossFunction:
+    """
+    A loss function of the registry, selectable by name.
+
+    Attributes:
+        name (str): The name the loss is registered under.
+        batch (callable): Optional kernel batch(trainMatrix, idealMatrix, **options) returning the
+            (train x ideal) loss matrix in one vectorized pass.
+        pairwise (callable): Optional pairwise(trainFunction, candidateFunction) returning a single loss,
+            as used by minimiseLoss. It is the fallback for losses without a batch kernel.
+    """
+
+    def __init__(self, name, batch=None, pairwise=None):
+        """
+        Initializes the loss function, which needs at least one of the two implementations.
+        """
+        if batch is None and pairwise is None:
+            raise ValueError(f"Loss {name} needs a batch kernel or a pairwise function.")
+        self.name = name
+        self.batch = batch
+        self.pairwise = pairwise
+
+    @property
+    def vectorized(self):
+        """
+        Returns True when the loss can be computed for the whole train x ideal matrix at once.
+        """
+        return self.batch is not None
+
+    def matrix(self, trainFunctions, candidateFunctions, lossOptions=None):
+        """
+        Returns the (train x candidate) loss matrix, with the batch kernel when there is one and
+        one pairwise call per pair otherwise.
+        """
+        lossOptions = lossOptions or {}
+        if self.vectorized:
+            return self.batch(functionMatrix(trainFunctions), functionMatrix(candidateFunctions), **lossOptions)
+
+        errors = np.empty((len(trainFunctions), len(candidateFunctions)))
+        for trainIndex, trainFunction in enumerate(trainFunctions):
+            for candidateIndex, candidateFunction in enumerate(candidateFunctions):
+                errors[trainIndex, candidateIndex] = self.pairwise(trainFunction, candidateFunction, **lossOptions)
+        return errors
+
+    def __repr__(self):
+        """
+        Returns a string representation of the loss function.
+        """
+        return f"LossFunction {self.name} ({'vectorized' if self.vectorized else 'pairwise'})"
+
+
+LOSS_FUNCTIONS = {}
+
+
+def registerLoss(name, batch=None, pairwise=None):
+    """
+    This function registers a loss function under a name, replacing any loss of the same name.
+    Custom losses that can't be vectorized only pass a pairwise function and fall back to the pairwise loop.
+    It returns the registered LossFunction.
+    """
+    LOSS_FUNCTIONS[name] = LossFunction(name, batch=batch, pairwise=pairwise)
+    return LOSS_FUNCTIONS[name]
+
+
+def getLoss(loss):
+    """
+    This function returns the registered LossFunction of a name, or the LossFunction itself.
+    """
+    if isinstance(loss, LossFunction):
+        return loss
+    try:
+        return LOSS_FUNCTIONS[loss]
+    except KeyError:
+        raise ValueError(f"Unknown loss {loss}, expected one of {', '.join(LOSS_FUNCTIONS)}.") from None
+
+
+registerLoss("sse", batch=squaredErrorMatrix, pairwise=errorSquared)
+registerLoss("weighted_sse", batch=weightedSquaredErrorMatrix)
+registerLoss("mae", batch=meanAbsoluteErrorMatrix)
+registerLoss("max_abs", batch=maxAbsoluteErrorMatrix)
+registerLoss("huber", batch=huberLossMatrix)
+
+
+@instrumented()
+def minimiseLossBatch(trainFunctions, candidateFunctions, loss="sse", lossOptions=None):
+    """
+    This function finds, for every training function, the candidate function with the smallest loss.
+    The loss is looked up in the registry by name ("sse" by default, the least-squares criterion) and
+    the complete (train x candidate) loss matrix is computed in a single vectorized pass when possible.
+    It returns a list of IdealFunction objects (one per training function, in order) and the loss matrix.
+    """
+    trainFunctions = list(trainFunctions)
+    candidateFunctions = list(candidateFunctions)
+
+    errors = getLoss(loss).matrix(trainFunctions, candidateFunctions, lossOptions)
+    return chooseIdealFunctions(trainFunctions, candidateFunctions, errors), errors
+
+
+@instrumented()
+def minimiseLossParallel(trainFunctions, candidateFunctions, workers, loss="sse", lossOptions=None):
+    """
+    This function gives the same result as minimiseLossBatch, with the candidate columns sharded across a
+    pool of worker processes. The train and candidate matrices are placed in shared memory once, so the
+    workers attach to them instead of receiving a pickled copy. Losses without a batch kernel run serially.
+    It returns a list of IdealFunction objects (one per training function, in order) and the loss matrix.
+    """
+    lossFunction = getLoss(loss)
+    if not lossFunction.vectorized:
+        return minimiseLossBatch(trainFunctions, candidateFunctions, lossFunction, lossOptions)
+
+    trainFunctions = list(trainFunctions)
+    candidateFunctions = list(candidateFunctions)
+    trainMatrix = functionMatrix(trainFunctions)
+    idealMatrix = functionMatrix(candidateFunctions)
+    _checkMatchingRows(trainMatrix, idealMatrix)
+
+    # A few shards per worker keep the pool busy when shards take uneven time
+    shardCount = min(idealMatrix.shape[1], max(workers, 1) * 4)
+    boundaries = np.linspace(0, idealMatrix.shape[1], shardCount + 1).astype(int)
+
+    sharedBlocks = []
+    try:
+        specs = []
+        for matrix in (trainMatrix, idealMatrix):
+            sharedBlock = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+            sharedBlocks.append(sharedBlock)
+            np.ndarray(matrix.shape, dtype=np.float64, buffer=sharedBlock.buf, order="F")[:] = matrix
+            specs.append((sharedBlock.name, matrix.shape))
+
+        errors = np.empty((trainMatrix.shape[1], idealMatrix.shape[1]))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attachSharedMatrices, initargs=(specs,)) as executor:
+            shards = [(start, stop, lossFunction.batch, lossOptions or {})
+                      for start, stop in zip(boundaries[:-1], boundaries[1:]) if stop > start]
+            for (start, stop, _, _), shardErrors in zip(shards, executor.map(_lossShard, shards)):
+                errors[:, start:stop] = shardErrors
+    finally:
+        for sharedBlock in sharedBlocks:
+            sharedBlock.close()
+            sharedBlock.unlink()
+
+    return chooseIdealFunctions(trainFunctions, candidateFunctions, errors), errors
+
+
+_sharedMatrices = None
+
+
+def _attachSharedMatrices(specs):
+    """
+    Pool initializer attaching a worker process to the shared train and ideal matrices.
+    """
+    global _sharedMatrices
+    _sharedMatrices = []
+    for name, shape in specs:
+        # Pool workers share the parent's resource tracker, so the parent stays the only one unlinking the blocks
+        sharedBlock = shared_memory.SharedMemory(name=name)
+        _sharedMatrices.append((sharedBlock, np.ndarray(shape, dtype=np.float64, buffer=sharedBlock.buf, order="F")))
+
+
+def _lossShard(shard):
+    """
+    Computes the losses of all training functions against one range of candidate columns.
+    """
+    start, stop, batch, lossOptions = shard
+    (_, trainMatrix), (_, idealMatrix) = _sharedMatrices
+    return batch(trainMatrix, idealMatrix[:, start:stop], **lossOptions)
+
+
+def chooseIdealFunctions(trainFunctions, candidateFunctions, errors):
+    """
+    This function picks, for every training function, the candidate with the smallest error in the error matrix.
+    On ties the first candidate wins, like in minimiseLoss.
+    It returns a list of IdealFunction objects, one per training function, in order.
+    """
+    bestIndexes = np.argmin(errors, axis=1)
+
+    idealFunctions = []
+    for trainIndex, trainFunction in enumerate(trainFunctions):
+        candidateIndex = bestIndexes[trainIndex]
+        idealFunctions.append(IdealFunction(functionData=candidateFunctions[candidateIndex],
+                                            trainingFunction=trainFunction,
+                                            error=float(errors[trainIndex, candidateIndex])))
+    return idealFunctions
+
+
+def rankIdealFunctions(trainFunctions, candidateFunctions, errors, k):
+    """
+    This function ranks, for every training function, the k candidates with the smallest error in the error matrix,
+    best first and ties in candidate order, like minimiseLoss with topK.
+    It returns one list of IdealFunction objects per training function, in order.
+    """
+    k = min(k, len(candidateFunctions))
+    rankings = []
+    for trainIndex, trainFunction in enumerate(trainFunctions):
+        trainErrors = errors[trainIndex]
+        ranking = np.lexsort((np.arange(len(trainErrors)), trainErrors))[:k]
+        rankings.append([IdealFunction(functionData=candidateFunctions[candidateIndex], trainingFunction=trainFunction,
+                                       error=float(trainErrors[candidateIndex]))
+                         for candidateIndex in ranking])
+    return rankings
+
+
+def restoreIdealFunctions(trainFunctions, candidateFunctions, selection):
+    """
+    This function rebuilds the IdealFunction objects of a stored selection without computing any loss.
+    The selection is a list of (training function name, ideal function name, error) tuples, as stored by
+    writeSelectionState, and must have been made from the same training and candidate functions.
+    It returns a list of IdealFunction objects, one per training function, in order.
+    """
+    trainByName = {trainFunction.name: trainFunction for trainFunction in trainFunctions}
+    candidateByName = {candidateFunction.name: candidateFunction for candidateFunction in candidateFunctions}
+
+    idealFunctions = []
+    for trainName, idealName, error in selection:
+        if trainName not in trainByName or idealName not in candidateByName:
+            raise ValueError(f"The stored selection of {idealName} for {trainName} doesn't match the input functions.")
+        idealFunctions.append(IdealFunction(functionData=candidateByName[idealName],
+                                            trainingFunction=trainByName[trainName], error=error))
+    return idealFunctions
+
+
+class StreamingLossAccumulator:
+    """
+    Accumulates the squared errors and the largest absolute deviation of every train x ideal function pair
+    over row chunks, so the least-squares selection and the tolerances never need the full data sets in memory.
+
+    Attributes:
+        trainNames (list): The names of the training functions, in column order.
+        idealNames (list): The names of the ideal functions, in column order.
+        errors (numpy.ndarray): The (train x ideal) sum of squared errors accumulated so far.
+        largestDeviations (numpy.ndarray): The (train x ideal) largest absolute deviation found so far.
+        rows (int): The number of rows accumulated so far.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty accumulator.
+        """
+        self.trainNames = None
+        self.idealNames = None
+        self.errors = None
+        self.largestDeviations = None
+        self.rows = 0
+
+    def add(self, trainChunk, idealChunk):
+        """
+        Adds the squared errors of one pair of row-aligned chunks.
+
+        Args:
+            trainChunk (CoreFunction): A chunk of the training data.
+            idealChunk (CoreFunction): The chunk of the ideal data covering the same rows.
+        """
+        trainFunctions = trainChunk.functions
+        idealFunctions = idealChunk.functions
+        if self.errors is None:
+            self.trainNames = [function.name for function in trainFunctions]
+            self.idealNames = [function.name for function in idealFunctions]
+            self.errors = np.zeros((len(trainFunctions), len(idealFunctions)))
+            self.largestDeviations = np.zeros((len(trainFunctions), len(idealFunctions)))
+
+        if not np.array_equal(trainFunctions[0].xValues, idealFunctions[0].xValues):
+            raise ValueError(f"Train and ideal chunks are not aligned on x after row {self.rows}.")
+
+        trainMatrix = functionMatrix(trainFunctions)
+        idealMatrix = functionMatrix(idealFunctions)
+        for trainIndex in range(trainMatrix.shape[1]):
+            distances = idealMatrix - trainMatrix[:, trainIndex, None]
+            self.errors[trainIndex] += np.einsum("ij,ij->j", distances, distances)
+            np.maximum(self.largestDeviations[trainIndex], np.max(np.abs(distances), axis=0, initial=0.0),
+                       out=self.largestDeviations[trainIndex])
+        self.rows += trainMatrix.shape[0]
+
+
+@instrumented()
+def minimiseLossStreaming(trainCsvPath, idealCsvPath, chunkSize, onChunk=None):
+    """
+    This function finds the ideal function with the smallest squared error for every training function
+    while reading both CSV files in chunks. Only the chosen ideal columns are loaded afterwards, since the test
+    points are looked up in them. The training data is never held in full: the largest deviations are
+    accumulated with the errors, and the training functions of the result only carry their names.
+    An optional onChunk(trainChunk, idealChunk) callback is invoked for every chunk, e.g. to export it.
+    It returns a list of IdealFunction objects (one per training function, in order) and the error matrix.
+    """
+    accumulator = StreamingLossAccumulator()
+    chunks = itertools.zip_longest(CoreFunction.read_chunks(trainCsvPath, chunkSize),
+                                   CoreFunction.read_chunks(idealCsvPath, chunkSize))
+    for trainChunk, idealChunk in chunks:
+        if trainChunk is None or idealChunk is None:
+            raise ValueError(f"{trainCsvPath} and {idealCsvPath} don't have the same number of rows.")
+        accumulator.add(trainChunk, idealChunk)
+        if onChunk is not None:
+            onChunk(trainChunk, idealChunk)
+
+    if accumulator.errors is None:
+        raise ValueError(f"{trainCsvPath} doesn't contain any rows.")
+
+    bestIndexes = np.argmin(accumulator.errors, axis=1)
+    chosenNames = sorted({accumulator.idealNames[index] for index in bestIndexes})
+    idealFunctionsByName = {function.name: function for function in
+                            CoreFunction.from_dataframe(pd.read_csv(idealCsvPath, usecols=["x"] + chosenNames))}
+
+    idealFunctions = []
+    for trainIndex, trainName in enumerate(accumulator.trainNames):
+        candidateIndex = bestIndexes[trainIndex]
+        idealFunction = IdealFunction(functionData=idealFunctionsByName[accumulator.idealNames[candidateIndex]],
+                                      trainingFunction=Function.from_matrix(trainName, np.empty((0, 2)), 1),
+                                      error=float(accumulator.errors[trainIndex, candidateIndex]))
+        idealFunction._largestDeviation = float(accumulator.largestDeviations[trainIndex, candidateIndex])
+        idealFunctions.append(idealFunction)
+    return idealFunctions, accumulator.errors
+
+
+def classifyChunks(testChunks, idealFunctions, bandIndex=None, lookup="exact"):
+    """
+    This function classifies a test set that is streamed in chunks, one chunk at a time.
+    It yields the MappingResult of every chunk, in order.
+    """
+    for testChunk in testChunks:
+        yield classifyBatch(testChunk.functions[0], idealFunctions, bandIndex=bandIndex, lookup=lookup)
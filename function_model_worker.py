@@ -1,5 +1,18 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine
+from mapping_worker import DATABASE_PATH, writeFunctionTable
+
+# First bytes of a function catalog file, followed by the version
+CATALOG_MAGIC = b"FNCATLG"
+CATALOG_VERSION = 1
+
+# Every array of a catalog starts at a multiple of this many bytes
+CATALOG_ALIGNMENT = 64
 
 
 class CoreFunction:
@@ -7,50 +20,252 @@ class CoreFunction:
     A class to handle core functions.
     """
 
-    def __init__(self, csv_path):
+    def __init__(self, csv_path, cache_dir=None):
         """
         Constructs a CoreFunction object.
 
         Parameters:
             csv_path (str): The path to the input CSV file.
+            cache_dir (str): Optional directory of a binary cache of parsed CSV files. A cached copy of
+                the same file (same path, size, mtime and content hash) is memory-mapped instead of parsed.
+        """
+        try:
+            cache_path = _cache_path(csv_path, cache_dir) if cache_dir is not None else None
+            if cache_path is not None and self._load_cache(cache_path):
+                return
+            csv_data = pd.read_csv(csv_path)
+        except FileNotFoundError:
+            print(f"There is an issue while reading file {csv_path}")
+            raise
+
+        self._load_dataframe(csv_data)
+        if cache_path is not None:
+            self._write_cache(cache_path)
+
+    @classmethod
+    def from_dataframe(cls, csv_data):
+        """
+        Constructs a CoreFunction object from an already parsed data frame.
+
+        Parameters:
+            csv_data (pandas.DataFrame): The data with an "x" column followed by the y columns.
+        """
+        coreFunction = cls.__new__(cls)
+        coreFunction._load_dataframe(csv_data)
+        return coreFunction
+
+    @classmethod
+    def read_chunks(cls, csv_path, chunk_size):
         """
-        self.data_frames = []
+        Reads a CSV file in chunks, so that it never has to be fully held in memory.
 
+        Parameters:
+            csv_path (str): The path to the input CSV file.
+            chunk_size (int): The number of rows per chunk.
+
+        Yields:
+            CoreFunction: One object per chunk, whose functions are slices of the full functions.
+        """
         try:
-            self.csv_data = pd.read_csv(csv_path)
+            reader = pd.read_csv(csv_path, chunksize=chunk_size)
         except FileNotFoundError:
             print(f"There is an issue while reading file {csv_path}")
             raise
 
-        x_values = self.csv_data["x"]
+        with reader:
+            for csv_data in reader:
+                yield cls.from_dataframe(csv_data)
+
+    def _load_dataframe(self, csv_data):
+        """
+        Stores the data frame as one contiguous float64 matrix and creates one Function view per y column.
+
+        Parameters:
+            csv_data (pandas.DataFrame): The data with an "x" column followed by the y columns.
+        """
+        columns = ["x"] + [name_of_column for name_of_column in csv_data.columns if "x" not in name_of_column]
+        # Column-major, so that every function's x and y values are contiguous views
+        self._load_matrix(columns, np.asfortranarray(csv_data[columns].to_numpy(dtype=np.float64)))
+
+    def _load_matrix(self, columns, values):
+        """
+        Stores the matrix and creates one Function view per y column.
+
+        Parameters:
+            columns (list): The column names, starting with "x".
+            values (numpy.ndarray): The (rows x columns) float64 matrix.
+        """
+        self.columns = list(columns)
+        self.values = values
+        self.data_frames = [Function.from_matrix(name_of_column, self.values, index_of_column)
+                            for index_of_column, name_of_column in enumerate(self.columns[1:], start=1)]
+
+    @classmethod
+    def from_catalog(cls, catalog_path, source_fingerprint=None):
+        """
+        Constructs a CoreFunction object attached to a function catalog written by write_catalog.
+        The matrix and the x grid are read-only views of the memory-mapped file, so every process attached
+        to the same catalog shares one copy of the data in the page cache. All functions share the x grid
+        index of the catalog instead of sorting their x values themselves.
+        The fingerprint and the [size, mtime_ns] of the file the catalog was written from are kept as the
+        source_fingerprint and source_stat attributes.
+
+        Parameters:
+            catalog_path (str): The path of the catalog file.
+            source_fingerprint (str): Optional fingerprint the catalog must have been written with.
+
+        Raises:
+            ValueError: If the file isn't a catalog or its fingerprint doesn't match.
+        """
+        with open(catalog_path, "rb") as catalog_file:
+            buffer = mmap.mmap(catalog_file.fileno(), 0, access=mmap.ACCESS_READ)
+        prefix = len(CATALOG_MAGIC) + 9
+        if len(buffer) < prefix or buffer[:len(CATALOG_MAGIC)] != CATALOG_MAGIC or buffer[len(CATALOG_MAGIC)] != CATALOG_VERSION:
+            raise ValueError(f"{catalog_path} is not a function catalog of version {CATALOG_VERSION}.")
+        header_length = int.from_bytes(buffer[len(CATALOG_MAGIC) + 1:prefix], "little")
+        header = json.loads(buffer[prefix:prefix + header_length])
+        if source_fingerprint is not None and header["source"] != source_fingerprint:
+            raise ValueError(f"The function catalog {catalog_path} was written from different data.")
+
+        rows, column_count = header["rows"], len(header["columns"])
+        data_start = _alignCatalogOffset(prefix + header_length)
+        offsets = {name: data_start + offset for name, offset in header["offsets"].items()}
+        if offsets["values"] + rows * column_count * 8 > len(buffer):
+            raise ValueError(f"The function catalog {catalog_path} is truncated.")
+        sorted_x = np.frombuffer(buffer, dtype="<f8", count=rows, offset=offsets["sorted_x"])
+        order = np.frombuffer(buffer, dtype="<i8", count=rows, offset=offsets["order"])
+        # The columns are stored one after the other, which is a column-major matrix
+        values = np.frombuffer(buffer, dtype="<f8", count=rows * column_count, offset=offsets["values"]) \
+            .reshape(column_count, rows).T
+
+        coreFunction = cls.__new__(cls)
+        coreFunction._load_matrix(header["columns"], values)
+        coreFunction.source_fingerprint = header["source"]
+        coreFunction.source_stat = header.get("source_stat")
+        for function in coreFunction.data_frames:
+            function._xIndex = (sorted_x, order)
+        return coreFunction
+
+    def write_catalog(self, catalog_path, source_fingerprint=None, source_stat=None):
+        """
+        Writes the matrix to a function catalog file that from_catalog attaches to.
+        The file starts with a header holding the column names, the number of rows and the source fingerprint
+        and stat, followed by the x grid (its sorted values and their row order) and the matrix in column-major order.
+        The file is written under a temporary name first, so attached readers never see a partial catalog.
+
+        Parameters:
+            catalog_path (str): The path of the catalog file.
+            source_fingerprint (str): Optional fingerprint of the data the catalog is written from.
+            source_stat (list): Optional [size, mtime_ns] of the file the catalog is written from.
+        """
+        rows = len(self.values)
+        order = np.argsort(self.values[:, 0], kind="stable")
+        # The matrix is stored column after column, which is a view of a column-major matrix
+        sections = [("sorted_x", np.ascontiguousarray(self.values[order, 0], dtype="<f8")),
+                    ("order", order.astype("<i8")),
+                    ("values", np.asfortranarray(self.values, dtype="<f8").ravel(order="F"))]
+
+        # The offsets count from the end of the header, rounded up to the alignment
+        offsets = {}
+        position = 0
+        for name, section in sections:
+            offsets[name] = position
+            position = _alignCatalogOffset(position + section.nbytes)
+        header_bytes = json.dumps({"columns": self.columns, "rows": rows, "source": source_fingerprint,
+                                   "source_stat": source_stat, "offsets": offsets}).encode()
+        data_start = _alignCatalogOffset(len(CATALOG_MAGIC) + 9 + len(header_bytes))
+
+        temporary_path = f"{catalog_path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary_path, "wb") as catalog_file:
+                catalog_file.write(CATALOG_MAGIC + bytes([CATALOG_VERSION]) + len(header_bytes).to_bytes(8, "little"))
+                catalog_file.write(header_bytes)
+                for name, section in sections:
+                    catalog_file.write(b"\0" * (data_start + offsets[name] - catalog_file.tell()))
+                    catalog_file.write(section.data)
+            os.replace(temporary_path, catalog_path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+    def _load_cache(self, cache_path):
+        """
+        Memory-maps a cached copy of the parsed CSV file, if there is one.
+
+        Parameters:
+            cache_path (str): The path of the cached matrix, without extension.
 
-        for name_of_column, data_of_column in self.csv_data.items():
-            if "x" in name_of_column:
-                continue
-            subset = pd.concat([x_values, data_of_column], axis=1)
-            function = Function.from_dataframe(name_of_column, subset)
-            self.data_frames.append(function)
+        Returns:
+            bool: True if the cache was loaded.
+        """
+        try:
+            with open(cache_path + ".json") as header_file:
+                header = json.load(header_file)
+            values = np.load(cache_path + ".npy", mmap_mode="r")
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable dataset cache {cache_path}: {e}")
+            return False
+
+        if values.ndim != 2 or values.shape[1] != len(header["columns"]):
+            logging.warning(f"Ignoring dataset cache {cache_path} whose shape doesn't match its header")
+            return False
+        self._load_matrix(header["columns"], values)
+        return True
+
+    def _write_cache(self, cache_path):
+        """
+        Writes the matrix to the binary cache and removes the stale entries of the same CSV file.
+        A failure to write the cache is logged and otherwise ignored.
 
-    def to_sql(self, file_name, suffix):
+        Parameters:
+            cache_path (str): The path of the cached matrix, without extension.
+        """
+        cache_dir, cache_name = os.path.split(cache_path)
+        # Entries of the same source file share everything up to the content digest
+        prefix = cache_name.rsplit(".", 1)[0] + "."
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to temporary files of this process first, so concurrent readers never see a partial entry
+            # and concurrent writers never truncate each other's file
+            matrix_path = f"{cache_path}.npy.{os.getpid()}.tmp"
+            with open(matrix_path, "wb") as matrix_file:
+                np.save(matrix_file, self.values)
+            os.replace(matrix_path, cache_path + ".npy")
+            header_path = f"{cache_path}.json.{os.getpid()}.tmp"
+            with open(header_path, "w") as header_file:
+                json.dump({"columns": self.columns}, header_file)
+            os.replace(header_path, cache_path + ".json")
+
+            for file_name in os.listdir(cache_dir):
+                # The temporary files of other writers are left alone
+                if file_name.startswith(prefix) and not file_name.startswith(cache_name) and not file_name.endswith(".tmp"):
+                    os.remove(os.path.join(cache_dir, file_name))
+        except OSError as e:
+            logging.warning(f"Could not write dataset cache {cache_path}: {e}")
+
+    @property
+    def csv_data(self):
+        """
+        Returns the data as a data frame with the x column followed by the y columns.
+        """
+        return pd.DataFrame(self.values, columns=self.columns, copy=False)
+
+    def to_sql(self, file_name, suffix, if_exists="replace", database_path=DATABASE_PATH):
         """
         Converts the CSV data to SQL and saves it to disk.
+        The values are written straight from the matrix in one transaction, with an index on the X column.
 
         Parameters:
             file_name (str): The name of the output database file.
             suffix (str): The suffix to add to the column names in the database.
+            if_exists (str): What to do when the table exists, "append" is used for streamed chunks.
+            database_path (str): The path of the SQLite database file.
         """
-        db_engine = create_engine('sqlite:///output-data/solution.db', echo=False)
-
-        csv_data_copied = self.csv_data.copy()
-        csv_data_copied.columns = [name.capitalize() + suffix for name in csv_data_copied.columns]
-        csv_data_copied.set_index(csv_data_copied.columns[0], inplace=True)
-
-        csv_data_copied.to_sql(
-            file_name,
-            db_engine,
-            if_exists="replace",
-            index=True,
-        )
+        writeFunctionTable(file_name, [name.capitalize() + suffix for name in self.columns], self.values,
+                           ifExists=if_exists, databasePath=database_path)
 
     @property
     def functions(self):
@@ -72,6 +287,113 @@ class CoreFunction:
         return f"Contains {len(self.functions)} number of functions"
 
 
+def _cache_path(csv_path, cache_dir):
+    """
+    Returns the path, without extension, of the cache entry of a CSV file in its current state.
+    The entry is named after the file's absolute path and keyed by its size, modification time and content hash.
+
+    Parameters:
+        csv_path (str): The path to the input CSV file.
+        cache_dir (str): The directory of the cache.
+    """
+    file_stat = os.stat(csv_path)
+    digest = hashlib.blake2b(f"{file_stat.st_size}|{file_stat.st_mtime_ns}|".encode(), digest_size=16)
+    _hash_file(digest, csv_path)
+    source_digest = hashlib.blake2b(os.path.abspath(csv_path).encode(), digest_size=4).hexdigest()
+    base_name = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(cache_dir, f"{base_name}.{source_digest}.{digest.hexdigest()}")
+
+
+def _alignCatalogOffset(position):
+    """
+    Rounds a position in a catalog file up to the next multiple of CATALOG_ALIGNMENT.
+    """
+    return -(-position // CATALOG_ALIGNMENT) * CATALOG_ALIGNMENT
+
+
+def _hash_file(digest, path):
+    """
+    Feeds the content of a file into a hashlib digest, block by block.
+    """
+    with open(path, "rb") as data_file:
+        for block in iter(lambda: data_file.read(1 << 20), b""):
+            digest.update(block)
+
+
+def fileDigest(path):
+    """
+    Calculates the content hash of a file, which inputFingerprint combines and function catalogs are keyed by.
+
+    Args:
+        path (str): The path to the file.
+
+    Returns:
+        A hexadecimal string.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    _hash_file(digest, path)
+    return digest.hexdigest()
+
+
+def inputFingerprint(csvPaths, *settings, fileDigests=None):
+    """
+    Calculates a fingerprint of the content of some CSV files and the settings they are processed with.
+    Unlike the cache key, it only depends on the content, so touching or copying a file keeps its fingerprint.
+
+    Args:
+        csvPaths (list): The paths to the input CSV files.
+        *settings: Values that change the result of processing the files, such as the name of the loss.
+        fileDigests (dict): Optional content hashes of some of the files by path, as returned by fileDigest,
+            which aren't hashed again.
+
+    Returns:
+        A hexadecimal string.
+    """
+    fileDigests = fileDigests or {}
+    digest = hashlib.blake2b(digest_size=16)
+    for csv_path in csvPaths:
+        file_digest = fileDigests.get(csv_path) or fileDigest(csv_path)
+        digest.update(bytes.fromhex(file_digest))
+    digest.update(json.dumps([str(setting) for setting in settings]).encode())
+    return digest.hexdigest()
+
+
+def openCatalog(csvPath, catalogPath):
+    """
+    Attaches to the function catalog of a CSV file, which is shared by every run on the host that uses the same
+    catalog path. A missing catalog, or one written from other content, is rebuilt from the CSV file first.
+    While the size and modification time of the CSV file are those it was written from, the file isn't hashed.
+
+    Args:
+        csvPath (str): The path to the input CSV file.
+        catalogPath (str): The path of the catalog file.
+
+    Returns:
+        A CoreFunction object attached to the catalog. Its source_fingerprint is the fileDigest of the CSV file.
+    """
+    file_stat = os.stat(csvPath)
+    source_stat = [file_stat.st_size, file_stat.st_mtime_ns]
+    catalog = None
+    try:
+        catalog = CoreFunction.from_catalog(catalogPath)
+    except FileNotFoundError:
+        logging.info(f"Writing the function catalog {catalogPath} of {csvPath}")
+    except (OSError, ValueError, KeyError) as e:
+        logging.info(f"Rewriting the function catalog {catalogPath}: {e}")
+    if catalog is not None and catalog.source_fingerprint is not None and catalog.source_stat == source_stat:
+        return catalog
+
+    fingerprint = fileDigest(csvPath)
+    if catalog is not None:
+        if catalog.source_fingerprint == fingerprint:
+            return catalog
+        logging.info(f"Rewriting the function catalog {catalogPath}, which was written from different data")
+
+    CoreFunction(csv_path=csvPath).write_catalog(catalogPath, source_fingerprint=fingerprint, source_stat=source_stat)
+    # Attaching to the written file instead of keeping the parsed copy lets this run share the pages too
+    return CoreFunction.from_catalog(catalogPath, source_fingerprint=fingerprint)
+
+
 class CoreFunctionIterator():
     """
     An iterator that iterates through the functions in a CoreFunctionObject.
@@ -138,12 +460,22 @@ class Function:
 
         Methods:
         -------
-        locateYBasedOnX(x):
-            Returns the Y value based on the given X value.
+        locateYBasedOnX(x, tolerance=None):
+            Returns the Y value(s) based on the given X value(s).
+        locateRows(x, tolerance=None):
+            Returns the row positions of the given X value(s) and a mask of the ones found.
+        interpolateYBasedOnX(x, method="linear"):
+            Returns the Y value(s) interpolated at X value(s) that don't need to be on the grid.
         name():
             Returns the name of the function.
+        xValues():
+            Returns the X values as a float64 NumPy array.
+        yValues():
+            Returns the Y values as a float64 NumPy array.
         from_dataframe(name, dataframe):
             Creates a new Function object from a pandas DataFrame.
+        from_matrix(name, matrix, column):
+            Creates a new Function object viewing one column of a shared matrix.
         __iter__():
             Returns an iterator that iterates over the function's Y values.
         __sub__(second):
@@ -152,6 +484,8 @@ class Function:
             Returns a string representation of the Function object.
     """
     
+    __slots__ = ("_name", "_dataframe", "_matrix", "_column", "_xIndex", "_interpolation")
+
     def __init__(self, name):
         """
         Initialize Function object with given name.
@@ -160,17 +494,169 @@ class Function:
         self._name = name
         self.dataframe = pd.DataFrame()
 
-    def locateYBasedOnX(self, x):
+    @property
+    def dataframe(self):
+        """
+        Returns the data frame holding the X and Y values of the function.
+        For a function viewing a shared matrix, the data frame is built on first access.
+        """
+        if self._dataframe is None:
+            self._dataframe = pd.DataFrame({"x": self._matrix[:, 0], "y": self._matrix[:, self._column]})
+        return self._dataframe
+
+    @dataframe.setter
+    def dataframe(self, value):
+        """
+        Sets the data frame of the function and drops everything cached from the previous one.
+        The function stops viewing a shared matrix.
+        :param value: Data frame with an "x" and a "y" column
+        """
+        self._dataframe = value
+        self._matrix = None
+        self._column = None
+        self._invalidateCaches()
+
+    def _shareData(self, function):
+        """
+        Makes this function use the same data as another function, without copying it.
+        :param function: Function object whose data is shared
+        """
+        self._dataframe = function._dataframe
+        self._matrix = function._matrix
+        self._column = function._column
+        self._invalidateCaches()
+        # The X values are the same, and so is their index
+        self._xIndex = function._xIndex
+
+    def _invalidateCaches(self):
+        """
+        Drops the values cached from the data frame, such as the sorted X index.
+        """
+        self._xIndex = None
+        self._interpolation = {}
+
+    @property
+    def xValues(self):
+        """
+        Returns the X values of the function as a float64 NumPy array.
+        """
+        if self._matrix is not None:
+            return self._matrix[:, 0]
+        return self.dataframe["x"].to_numpy(dtype=np.float64)
+
+    @property
+    def yValues(self):
+        """
+        Returns the Y values of the function as a float64 NumPy array.
+        """
+        if self._matrix is not None:
+            return self._matrix[:, self._column]
+        return self.dataframe["y"].to_numpy(dtype=np.float64)
+
+    def _sortedXIndex(self):
+        """
+        Returns the lazily built (sorted X values, original row positions) index of the function.
+        The sort is stable, so for duplicated X values the first row of the data frame wins.
+        """
+        if self._xIndex is None:
+            xValues = self.xValues
+            order = np.argsort(xValues, kind="stable")
+            self._xIndex = (xValues[order], order)
+        return self._xIndex
+
+    def locateRows(self, x, tolerance=None):
+        """
+        Returns the row positions of the given X value(s) together with a mask telling which were found.
+        Without a tolerance an exact match is required, otherwise the nearest X within the tolerance is used.
+        :param x: X value or array of X values
+        :param tolerance: Largest accepted absolute distance between X values, None for exact matches
+        :return: Tuple of (row positions, found mask), both shaped like x
+        """
+        sortedX, order = self._sortedXIndex()
+        x = np.asarray(x, dtype=np.float64)
+        if len(sortedX) == 0:
+            return np.zeros(x.shape, dtype=np.intp), np.zeros(x.shape, dtype=bool)
+
+        right = np.searchsorted(sortedX, x, side="left")
+        right = np.minimum(right, len(sortedX) - 1)
+        if tolerance is None:
+            nearest = right
+            found = sortedX[nearest] == x
+        else:
+            left = np.maximum(right - 1, 0)
+            useLeft = np.abs(x - sortedX[left]) <= np.abs(sortedX[right] - x)
+            nearest = np.where(useLeft, left, right)
+            found = np.abs(sortedX[nearest] - x) <= tolerance
+        return order[nearest], found
+
+    def locateYBasedOnX(self, x, tolerance=None):
         """
         Returns the Y value based on X value from the data frame. If the value is not found, it raises an IndexError.
-        :param x: X value
+        An array of X values returns an array with all the matching Y values.
+        :param x: X value or array of X values
+        :param tolerance: Largest accepted absolute distance between X values, None for exact matches
         :return: Y value
         """
-        searchKey = self.dataframe["x"] == x
-        try:
-            return self.dataframe.loc[searchKey].iat[0, 1]
-        except IndexError:
+        positions, found = self.locateRows(x, tolerance)
+        if not np.all(found):
             raise IndexError("Y value not found for given X value.")
+        return self.yValues[positions]
+
+    def _interpolationGrid(self):
+        """
+        Returns the lazily built (unique sorted X values, row positions) grid used for interpolation.
+        For duplicated X values the first row of the data frame wins, like in locateYBasedOnX.
+        """
+        if "grid" not in self._interpolation:
+            sortedX, order = self._sortedXIndex()
+            gridX, firstPositions = np.unique(sortedX, return_index=True)
+            self._interpolation["grid"] = (gridX, order[firstPositions])
+        return self._interpolation["grid"]
+
+    def _cubicSecondDerivatives(self):
+        """
+        Returns the lazily computed second derivatives of the natural cubic spline through the grid.
+        The tridiagonal system is solved once with the Thomas algorithm.
+        """
+        if "cubic" not in self._interpolation:
+            gridX, gridRows = self._interpolationGrid()
+            gridY = self.yValues[gridRows]
+            count = len(gridX)
+            secondDerivatives = np.zeros(count)
+            if count > 2:
+                steps = np.diff(gridX)
+                slopes = np.diff(gridY) / steps
+                diagonal = 2.0 * (steps[:-1] + steps[1:])
+                rightSide = 6.0 * np.diff(slopes)
+                # Forward elimination, the sub- and super-diagonals are both steps[1:-1]
+                for row in range(1, count - 2):
+                    factor = steps[row] / diagonal[row - 1]
+                    diagonal[row] -= factor * steps[row]
+                    rightSide[row] -= factor * rightSide[row - 1]
+                inner = np.empty(count - 2)
+                inner[-1] = rightSide[-1] / diagonal[-1]
+                for row in range(count - 4, -1, -1):
+                    inner[row] = (rightSide[row] - steps[row + 1] * inner[row + 1]) / diagonal[row]
+                secondDerivatives[1:-1] = inner
+            self._interpolation["cubic"] = secondDerivatives
+        return self._interpolation["cubic"]
+
+    def interpolateYBasedOnX(self, x, method="linear", outOfRange="raise"):
+        """
+        Returns the Y value(s) at X value(s) that don't need to be on the grid of the function.
+        X values on the grid return exactly the same Y value as locateYBasedOnX. Nothing is extrapolated:
+        X values outside the range of the grid raise an IndexError, or give NaN with outOfRange="nan".
+        The nearest method also accepts X values up to half a grid step past the first and last grid points.
+        :param x: X value or array of X values
+        :param method: "nearest", "linear" or "cubic" (natural cubic spline)
+        :param outOfRange: "raise" or "nan", what X values outside the range of the grid give
+        :return: Y value
+        """
+        if method not in ("nearest", "linear", "cubic"):
+            raise ValueError(f"Unknown interpolation method {method}.")
+        gridX, gridRows = self._interpolationGrid()
+        secondDerivatives = self._cubicSecondDerivatives() if method == "cubic" else None
+        return interpolateOnGrid(gridX, gridRows, self.yValues, x, method, secondDerivatives, outOfRange)
 
     @property
     def name(self):
@@ -206,6 +692,23 @@ class Function:
         dataFunction.dataframe.columns = ["x", "y"]
         return dataFunction
 
+    @classmethod
+    def from_matrix(cls, name, matrix, column):
+        """
+        Returns a Function object viewing one column of a shared matrix, without copying it.
+        :param name: Name of the function
+        :param matrix: Float64 matrix whose first column holds the X values
+        :param column: Index of the column holding the Y values
+        :return: Function object
+        """
+        dataFunction = cls.__new__(cls)
+        dataFunction._name = name
+        dataFunction._dataframe = None
+        dataFunction._matrix = matrix
+        dataFunction._column = column
+        dataFunction._invalidateCaches()
+        return dataFunction
+
     def __repr__(self):
         """
         Returns a string representation of the Function object.
@@ -232,10 +735,13 @@ class IdealFunction(Function):
         toleranceFactor: Property that returns the current tolerance factor.
         toleranceFactor.setter: Setter for the tolerance factor.
         largestDeviation: Property that returns the largest deviation between the training function
-        and the ideal function.
+        and the ideal function. It is computed once and cached until the ideal data or the training
+        function changes.
 
     """
 
+    __slots__ = ("_training_function", "error", "toleranceValue", "_tolerance", "_largestDeviation")
+
     def __init__(self, functionData, trainingFunction, error):
         """
         Initializes the IdealFunction instance.
@@ -246,12 +752,37 @@ class IdealFunction(Function):
             error (float): The error tolerance for the ideal function.
         """
         super().__init__(functionData.name)
-        self.dataframe = functionData.dataframe
+        self._shareData(functionData)
         self.training_function = trainingFunction
         self.error = error
         self.toleranceValue = 1
         self._tolerance = 1
 
+    def _invalidateCaches(self):
+        """
+        Drops the cached X index and the cached largest deviation.
+        """
+        super()._invalidateCaches()
+        self._largestDeviation = None
+
+    @property
+    def training_function(self):
+        """
+        Returns the training function used to calculate the ideal function.
+        """
+        return self._training_function
+
+    @training_function.setter
+    def training_function(self, value):
+        """
+        Sets the training function and drops the cached largest deviation.
+
+        Args:
+            value (Function): The new training function.
+        """
+        self._training_function = value
+        self._largestDeviation = None
+
     def determineLargestDeviation(self, idealFunction, trainFunction):
         """
         Calculates the largest deviation between the training function and the ideal function.
@@ -312,12 +843,284 @@ class IdealFunction(Function):
     def largestDeviation(self):
         """
         Calculates the largest deviation between the training function and the ideal function.
+        The value is cached, so the data frames are only compared once.
 
         Returns:
             The largest deviation between the training function and the ideal function.
         """
-        return self.determineLargestDeviation(self, self.training_function)
+        if self._largestDeviation is None:
+            self._largestDeviation = self.determineLargestDeviation(self, self.training_function)
+        return self._largestDeviation
+
+
+def interpolateOnGrid(gridX, gridRows, values, x, method, secondDerivatives=None, outOfRange="raise"):
+    """
+    Interpolates values at X value(s) between the points of a grid, as described in Function.interpolateYBasedOnX.
+    The values can be the Y values of one function, or a (rows x functions) matrix of functions sharing the grid,
+    in which case every X value is located once and the result has one column per function.
+
+    Args:
+        gridX (numpy.ndarray): The unique sorted X values of the grid.
+        gridRows (numpy.ndarray): The rows of the values holding the grid points, in the order of gridX.
+        values (numpy.ndarray): The Y values, or the matrix of Y values, by row.
+        x: X value or array of X values.
+        method (str): "nearest", "linear" or "cubic".
+        secondDerivatives (numpy.ndarray): The second derivatives of the cubic spline at the grid points,
+            shaped like values[gridRows]. Only needed for "cubic".
+        outOfRange (str): "raise" to raise an IndexError for X values outside the range of the grid,
+            "nan" to give them NaN.
+
+    Returns:
+        The interpolated Y value(s).
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if outOfRange not in ("raise", "nan"):
+        raise ValueError(f"Unknown out of range policy {outOfRange}.")
+    if len(gridX) == 0:
+        if outOfRange == "raise":
+            raise IndexError("Y value not found for given X value.")
+        return np.full(x.shape + values.shape[1:], np.nan)
+
+    # The nearest grid point of an X value up to half a step past the ends is the first or last one
+    low, high = gridX[0], gridX[-1]
+    if method == "nearest" and len(gridX) > 1:
+        low, high = low - (gridX[1] - gridX[0]) / 2, high + (gridX[-1] - gridX[-2]) / 2
+    inRange = (x >= low) & (x <= high)
+    allInRange = bool(np.all(inRange))
+    if not allInRange:
+        if outOfRange == "raise":
+            raise IndexError("Y value not found for given X value.")
+        # Out of range X values are looked up at the first grid point and replaced by NaN at the end
+        x = np.where(inRange, x, gridX[0])
+
+    if len(gridX) == 1:
+        firstY = values[gridRows[0]]
+        y = np.broadcast_to(firstY, x.shape + np.shape(firstY)).copy() if x.ndim else firstY
+    else:
+        # Segment [left, left + 1] containing every X, the last grid point closes the last segment
+        left = np.clip(np.searchsorted(gridX, x, side="right") - 1, 0, len(gridX) - 2)
+        step = gridX[left + 1] - gridX[left]
+        t = (x - gridX[left]) / step
+
+        if method == "nearest":
+            y = values[gridRows[np.where(t <= 0.5, left, left + 1)]]
+        else:
+            leftY, rightY = values[gridRows[left]], values[gridRows[left + 1]]
+            if values.ndim > 1:
+                # One row per X value, broadcast over the columns of the functions
+                step, t = step[..., np.newaxis], t[..., np.newaxis]
+            y = leftY + t * (rightY - leftY)
+            if method == "cubic":
+                y = y + ((t ** 3 - t) * secondDerivatives[left + 1] +
+                         ((1 - t) ** 3 - (1 - t)) * secondDerivatives[left]) * step ** 2 / 6.0
+            y = np.where(t == 1.0, rightY, y)
+
+    if allInRange:
+        return y
+    return np.where(inRange[..., np.newaxis] if values.ndim > 1 else inRange, y, np.nan)
+
+
+def sharesGrid(functions):
+    """
+    Tells whether a list of functions have the same X values in the same row order, so one lookup of an X value
+    finds the row of all of them. Columns of one CoreFunction matrix share it without comparing any value.
+
+    Args:
+        functions (list): A list of `Function` objects.
+
+    Returns:
+        True if the functions share their X grid.
+    """
+    matrix = functions[0]._matrix
+    if matrix is not None and all(function._matrix is matrix for function in functions):
+        return True
+    xValues = functions[0].xValues
+    return all(np.array_equal(function.xValues, xValues) for function in functions[1:])
+
+
+def locateYMatrix(functions, x, method="exact", outOfRange="raise"):
+    """
+    Returns the Y values of a list of functions at an array of X values as a (points x functions) matrix.
+    When the functions share their X grid, every X value is located once for all of them;
+    functions on different grids are looked up one by one.
+    It raises an IndexError when an X value can't be looked up, like locateYBasedOnX, except for X values
+    outside the range of the grid of an interpolation method with outOfRange="nan", which give NaN.
+
+    Args:
+        functions (list): A list of `Function` objects.
+        x (numpy.ndarray): The X values.
+        method (str): "exact" for X values on the grid, or an interpolation method of interpolateYBasedOnX.
+        outOfRange (str): "raise" or "nan", see interpolateYBasedOnX. The exact lookup always raises.
+
+    Returns:
+        A (points x functions) NumPy array.
+    """
+    functions = list(functions)
+    if not functions:
+        raise ValueError("At least one function is required to look up Y values.")
+    if not sharesGrid(functions):
+        if method == "exact":
+            return np.column_stack([function.locateYBasedOnX(x) for function in functions])
+        return np.column_stack([function.interpolateYBasedOnX(x, method=method, outOfRange=outOfRange)
+                                for function in functions])
+
+    values = functionMatrix(functions)
+    if method == "exact":
+        rows, found = functions[0].locateRows(x)
+        if not np.all(found):
+            raise IndexError("Y value not found for given X value.")
+        return values[rows]
+    if method not in ("nearest", "linear", "cubic"):
+        raise ValueError(f"Unknown interpolation method {method}.")
+    gridX, gridRows = functions[0]._interpolationGrid()
+    secondDerivatives = None
+    if method == "cubic":
+        secondDerivatives = np.column_stack([function._cubicSecondDerivatives() for function in functions])
+    return interpolateOnGrid(gridX, gridRows, values, x, method, secondDerivatives, outOfRange)
+
+
+def functionMatrix(functions):
+    """
+    Stacks the y values of a list of functions into a dense (rows x functions) float64 matrix.
+    All functions are expected to share the same x grid, in the same row order. When the functions
+    are consecutive columns of one CoreFunction matrix, a view of that matrix is returned without copying.
+
+    Args:
+        functions (list): A list of `Function` objects.
+
+    Returns:
+        A (rows x functions) NumPy array, which must be treated as read-only.
+    """
+    functions = list(functions)
+    if not functions:
+        raise ValueError("At least one function is required to build a function matrix.")
+
+    matrix = functions[0]._matrix
+    if matrix is not None and all(function._matrix is matrix for function in functions):
+        columns = [function._column for function in functions]
+        if columns == list(range(columns[0], columns[0] + len(columns))):
+            return matrix[:, columns[0]:columns[0] + len(columns)]
+        return matrix[:, columns]
+    return np.column_stack([function.yValues for function in functions])
+
+
+def precomputeLargestDeviations(idealFunctions):
+    """
+    Calculates the largest deviation of a list of ideal functions in a single vectorized pass
+    and stores it in their cache, so later tolerance reads don't touch the data frames.
+    Ideal functions whose largest deviation is already cached, such as those of a streamed selection, are kept.
+
+    Args:
+        idealFunctions (list): A list of `IdealFunction` objects.
+
+    Returns:
+        A NumPy array with the largest deviation of every ideal function, in order.
+    """
+    idealFunctions = list(idealFunctions)
+    pending = [idealFunction for idealFunction in idealFunctions if idealFunction._largestDeviation is None]
+    if len(pending) < len(idealFunctions):
+        precomputeLargestDeviations(pending)
+        return np.array([idealFunction.largestDeviation for idealFunction in idealFunctions])
+    if not idealFunctions:
+        return np.empty(0)
+
+    rowCounts = {len(idealFunction.yValues) for idealFunction in idealFunctions}
+    rowCounts.update(len(idealFunction.training_function.yValues) for idealFunction in idealFunctions)
+    if len(rowCounts) != 1:
+        # The functions don't share a grid, so fall back to the per-function comparison
+        return np.array([idealFunction.largestDeviation for idealFunction in idealFunctions])
+
+    idealMatrix = functionMatrix(idealFunctions)
+    trainMatrix = functionMatrix([idealFunction.training_function for idealFunction in idealFunctions])
+    deviations = np.max(np.abs(trainMatrix - idealMatrix), axis=0)
+    for idealFunction, deviation in zip(idealFunctions, deviations):
+        idealFunction._largestDeviation = deviation
+    return deviations
+
+
+class MappingResult:
+    """
+    The columnar result of classifying test points against a list of ideal functions.
+    Every point costs 26 bytes in four arrays instead of three Python objects, and the ideal functions are
+    referenced once in the name table instead of once per point.
+    Iterating over a MappingResult yields the points in the dict form used before,
+    {"point": {"x": x, "y": y}, "classification": IdealFunction or None, "delta_y": delta y or None},
+    which is only meant for small results and code that hasn't moved to the arrays yet.
+
+    Attributes:
+        xValues (numpy.ndarray): The x values of the points.
+        yValues (numpy.ndarray): The y values of the points.
+        deltaY (numpy.ndarray): The distance of every point to its ideal function, NaN for unclassified points.
+        idealIndexes (numpy.ndarray): The int16 index of the ideal function of every point in idealFunctions,
+            -1 for unclassified points.
+        idealFunctions (tuple): The name table, the IdealFunction objects the ideal indexes refer to.
+    """
+
+    __slots__ = ("xValues", "yValues", "deltaY", "idealIndexes", "idealFunctions")
+
+    def __init__(self, xValues, yValues, idealIndexes, deltaY, idealFunctions):
+        """
+        Initializes the result from its columns, which must have the same length.
+        """
+        self.idealFunctions = tuple(idealFunctions)
+        if len(self.idealFunctions) > np.iinfo(np.int16).max:
+            raise ValueError(f"A mapping result can refer to at most {np.iinfo(np.int16).max} ideal functions.")
+        self.xValues = np.asarray(xValues, dtype=np.float64)
+        self.yValues = np.asarray(yValues, dtype=np.float64)
+        self.idealIndexes = np.asarray(idealIndexes).astype(np.int16, copy=False)
+        self.deltaY = np.asarray(deltaY, dtype=np.float64)
+        if not len(self.xValues) == len(self.yValues) == len(self.idealIndexes) == len(self.deltaY):
+            raise ValueError("The columns of a mapping result must have the same length.")
+
+    @classmethod
+    def concatenate(cls, results, idealFunctions=None):
+        """
+        Joins results over the same ideal functions into one, in order.
+        The ideal functions are only needed when there are no results.
+        """
+        results = list(results)
+        if not results:
+            return cls(np.empty(0), np.empty(0), np.empty(0, dtype=np.int16), np.empty(0), idealFunctions or ())
+        return cls(*(np.concatenate(column) for column in zip(*(result.columns for result in results))),
+                   results[0].idealFunctions)
 
+    @property
+    def columns(self):
+        """
+        Returns the tuple of arrays (x, y, ideal index, delta y).
+        """
+        return self.xValues, self.yValues, self.idealIndexes, self.deltaY
+
+    @property
+    def idealNames(self):
+        """
+        Returns the names of the ideal functions the ideal indexes refer to.
+        """
+        return [idealFunction.name for idealFunction in self.idealFunctions]
+
+    def __len__(self):
+        """
+        Returns the number of points.
+        """
+        return len(self.xValues)
+
+    def __iter__(self):
+        """
+        Yields every point in the dict form, converted to Python floats one point at a time.
+        """
+        for x, y, idealIndex, deltaY in zip(self.xValues.tolist(), self.yValues.tolist(),
+                                            self.idealIndexes.tolist(), self.deltaY.tolist()):
+            if idealIndex < 0:
+                yield {"point": {"x": x, "y": y}, "classification": None, "delta_y": None}
+            else:
+                yield {"point": {"x": x, "y": y}, "classification": self.idealFunctions[idealIndex], "delta_y": deltaY}
+
+    def __repr__(self):
+        """
+        Returns a string representation of the MappingResult object.
+        """
+        classified = int(np.count_nonzero(self.idealIndexes >= 0))
+        return f"MappingResult({len(self)} points, {classified} classified, ideal functions {self.idealNames})"
 
 
 class FunctionIterator:
@@ -0,0 +1,247 @@
+import functools
+import json
+import threading
+import time
+import tracemalloc
+
+
+class SpanStatistics:
+    """
+    The aggregated measurements of all runs of one named span.
+
+    Attributes:
+        calls (int): How often the span ran.
+        wall (float): The total wall time in seconds.
+        cpu (float): The total CPU time of the process in seconds, including the time of worker threads.
+        rows (int): The total number of rows the span processed.
+        peakBytes (int): The highest memory traced by tracemalloc during a single run, or None when memory isn't traced.
+    """
+
+    __slots__ = ("calls", "wall", "cpu", "rows", "peakBytes")
+
+    def __init__(self):
+        """
+        Initializes empty measurements.
+        """
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.rows = 0
+        self.peakBytes = None
+
+    def to_dict(self):
+        """
+        Returns the measurements as a JSON serializable dictionary.
+        """
+        return {
+            "calls": self.calls,
+            "wall_s": self.wall,
+            "cpu_s": self.cpu,
+            "rows": self.rows,
+            "rows_per_s": self.rows / self.wall if self.rows and self.wall > 0 else None,
+            "peak_bytes": self.peakBytes,
+        }
+
+
+class _Span:
+    """
+    Context manager measuring one run of a span. Nested spans on the same thread each report the
+    tracemalloc peak reached while they ran, including the peaks of their children.
+    """
+
+    __slots__ = ("_instrumentation", "_name", "rows", "_wall", "_cpu", "peakBytes")
+
+    def __init__(self, instrumentation, name, rows):
+        self._instrumentation = instrumentation
+        self._name = name
+        self.rows = rows
+        self.peakBytes = 0
+
+    def __enter__(self):
+        stack = self._instrumentation._stack()
+        if self._instrumentation.traceMemory and tracemalloc.is_tracing():
+            # Hand the peak reached so far to the enclosing span, then measure this span from scratch
+            if stack:
+                stack[-1].peakBytes = max(stack[-1].peakBytes, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        stack.append(self)
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        stack = self._instrumentation._stack()
+        stack.pop()
+        peakBytes = None
+        if self._instrumentation.traceMemory and tracemalloc.is_tracing():
+            peakBytes = max(self.peakBytes, tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1].peakBytes = max(stack[-1].peakBytes, peakBytes)
+        self._instrumentation._record(self._name, wall, cpu, self.rows, peakBytes)
+        return False
+
+
+class _DisabledSpan:
+    """
+    Shared no-op context manager returned while the instrumentation is disabled.
+    """
+
+    __slots__ = ("rows",)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_DISABLED_SPAN = _DisabledSpan()
+
+
+class Instrumentation:
+    """
+    Collects timing, memory and counter measurements of named pipeline stages and hot functions.
+    While disabled, spans and counters cost a single attribute check.
+
+    Attributes:
+        enabled (bool): Whether measurements are collected.
+        traceMemory (bool): Whether the tracemalloc peak of every span is recorded.
+        spans (dict): The SpanStatistics of every span, by name.
+        counters (dict): The value of every counter, by name.
+    """
+
+    def __init__(self, enabled=False, traceMemory=False):
+        """
+        Initializes the instrumentation, which is disabled by default.
+        """
+        self.enabled = False
+        self.traceMemory = False
+        self.spans = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._startedTracing = False
+        self._started = None
+        if enabled:
+            self.enable(traceMemory=traceMemory)
+
+    def enable(self, traceMemory=False):
+        """
+        Starts collecting measurements. With traceMemory, tracemalloc is started (if it isn't running yet)
+        to record memory peaks, which slows down allocations noticeably.
+        """
+        self.traceMemory = traceMemory
+        if traceMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._startedTracing = True
+        self._started = time.perf_counter()
+        self.enabled = True
+
+    def disable(self):
+        """
+        Stops collecting measurements. The measurements collected so far are kept.
+        """
+        self.enabled = False
+        if self._startedTracing:
+            tracemalloc.stop()
+            self._startedTracing = False
+
+    def reset(self):
+        """
+        Clears all measurements.
+        """
+        with self._lock:
+            self.spans = {}
+            self.counters = {}
+        self._started = time.perf_counter() if self.enabled else None
+
+    def span(self, name, rows=0):
+        """
+        Returns a context manager measuring a run of the span `name`. The rows can be given up front
+        or set on the returned object before the block ends.
+        """
+        if not self.enabled:
+            return _DISABLED_SPAN
+        return _Span(self, name, rows)
+
+    def count(self, name, value=1):
+        """
+        Adds a value to the counter `name`.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def instrumented(self, name=None, rows=None):
+        """
+        Decorator measuring every call of a function as a span, named after the function by default.
+        `rows` is an optional callable receiving the call arguments and returning the number of rows processed.
+        """
+        def decorator(function):
+            spanName = name or function.__name__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with _Span(self, spanName, rows(*args, **kwargs) if rows is not None else 0):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def report(self):
+        """
+        Returns all measurements as a JSON serializable run report.
+        """
+        with self._lock:
+            spans = {name: statistics.to_dict() for name, statistics in self.spans.items()}
+            counters = dict(self.counters)
+        return {
+            "wall_s": time.perf_counter() - self._started if self._started is not None else None,
+            "trace_memory": self.traceMemory,
+            "spans": spans,
+            "counters": counters,
+        }
+
+    def writeReport(self, path):
+        """
+        Writes the run report as JSON to a file.
+        """
+        with open(path, "w") as reportFile:
+            json.dump(self.report(), reportFile, indent=2)
+
+    def _stack(self):
+        """
+        Returns the stack of open spans of the current thread.
+        """
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _record(self, name, wall, cpu, rows, peakBytes):
+        """
+        Adds the measurements of one span run to the statistics of the span.
+        """
+        with self._lock:
+            statistics = self.spans.get(name)
+            if statistics is None:
+                statistics = self.spans[name] = SpanStatistics()
+            statistics.calls += 1
+            statistics.wall += wall
+            statistics.cpu += cpu
+            statistics.rows += rows or 0
+            if peakBytes is not None:
+                statistics.peakBytes = peakBytes if statistics.peakBytes is None else max(statistics.peakBytes, peakBytes)
+
+
+# The process-wide instrumentation used by the workers and main.py, disabled unless a run report is requested
+INSTRUMENTATION = Instrumentation()
+span = INSTRUMENTATION.span
+count = INSTRUMENTATION.count
+instrumented = INSTRUMENTATION.instrumented
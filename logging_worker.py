@@ -0,0 +1,87 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import time
+
+
+class RateLimitedLogger:
+    """
+    Debug channel for hot code paths, which emits at most one message per interval.
+    The message is formatted lazily by the logging module, so a call that is filtered out by the log level or
+    suppressed by the rate limit costs a level check and a clock read, not a string formatting.
+    The number of suppressed calls is appended to the next emitted message. The counters aren't locked, so with
+    concurrent callers the number of suppressed calls is approximate.
+
+    Attributes:
+        logger (logging.Logger): The logger the messages are emitted to at DEBUG level.
+        interval (float): The minimum number of seconds between two emitted messages.
+    """
+
+    def __init__(self, logger, interval=1.0):
+        """
+        Initializes the channel for a logger.
+        """
+        self.logger = logger
+        self.interval = interval
+        self._nextEmit = 0.0
+        self._suppressed = 0
+
+    def debug(self, message, *args):
+        """
+        Logs a %-style message with its arguments at DEBUG level, unless a message was emitted less than
+        an interval ago.
+        """
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        now = time.monotonic()
+        if now < self._nextEmit:
+            self._suppressed += 1
+            return
+        self._nextEmit = now + self.interval
+        suppressed, self._suppressed = self._suppressed, 0
+        if suppressed:
+            message += " (%d similar messages suppressed)"
+            args += (suppressed,)
+        self.logger.debug(message, *args)
+
+
+class InProcessQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that puts the records on the queue as they are. The stdlib QueueHandler formats every record
+    on the logging thread, so it can be pickled for another process; a queue read by a thread of the same process
+    doesn't need that, and the formatting moves to the thread of the QueueListener.
+    The arguments of a message are formatted when the listener handles it, so they must not be changed after
+    the logging call.
+    """
+
+    def prepare(self, record):
+        """
+        Returns the record unchanged, without formatting it.
+        """
+        return record
+
+
+def startQueueLogging(handlers, level=logging.INFO, logger=None):
+    """
+    This function routes the records of a logger (the root logger by default) through a queue to the given handlers.
+    The logging calls only put the record on the queue, while a background thread does the formatting and the
+    file and stream I/O. It returns the started QueueListener; stopping it flushes the remaining records, which
+    also happens at interpreter exit.
+    """
+    logger = logger if logger is not None else logging.getLogger()
+    logQueue = queue.SimpleQueue()
+    logger.setLevel(level)
+    logger.addHandler(InProcessQueueHandler(logQueue))
+    listener = logging.handlers.QueueListener(logQueue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(stopQueueLogging, listener)
+    return listener
+
+
+def stopQueueLogging(listener):
+    """
+    This function stops a QueueListener after it has handled all queued records. Stopping it twice is harmless.
+    """
+    if listener._thread is not None:
+        listener.stop()
@@ -1,12 +1,20 @@
+import argparse
 import logging
 import math
+import numpy as np
 import pandas as pd
 import sys
 import unittest
-from function_model_worker import CoreFunction
-from mapping_worker import writeToSqlite
-from calculations_worker import minimiseLoss, findClassification, errorSquared
-from visualisation_worker import plotIdealFunctions, createPlottingPointBasedOnIdealFunction
+from function_model_worker import CoreFunction, Function, MappingResult, precomputeLargestDeviations, inputFingerprint, openCatalog
+from mapping_worker import configureDatabase, writeClassificationToSqlite, clearMappedRows, unmappedPointsMask, removeStaleMappedRows, readSelectionState, writeSelectionState
+from calculations_worker import rankIdealFunctions, minimiseLossBatch, minimiseLossParallel, minimiseLossStreaming, classifyBatchChunks, classifyChunks, \
+    restoreIdealFunctions, ToleranceBandIndex, LOOKUP_POLICIES, LOSS_FUNCTIONS
+from visualisation_worker import plotIdealFunctions, createPlottingPointBasedOnIdealFunction, plotClassificationsByIdealFunction, \
+    BackgroundPlotter
+from instrumentation_worker import INSTRUMENTATION, span
+from logging_worker import startQueueLogging, stopQueueLogging
+from pipeline_worker import PipelineStage
+from service_worker import ClassificationService, parseAddress, runService
 
 
 """
@@ -16,6 +24,18 @@ This script provides the following functionalities:
 3. Visualize logical graphs
 """
 
+# With the auto plot mode, test data up to this many points gets one figure per point
+PER_POINT_PLOT_LIMIT = 200
+
+# Test points may deviate from their ideal function by the largest training deviation times this factor
+TOLERANCE_FACTOR = math.sqrt(2)
+
+# The test points are classified in chunks of this many rows, each written to SQLite while the next is classified
+PIPELINE_CHUNK_ROWS = 65536
+
+# Largest number of chunks waiting for the SQLite writer, which bounds the memory a slow disk can hold up
+MAX_PENDING_WRITES = 4
+
 class CsvConversionException(Exception):
     """
     Exception raised when there is an error converting csv to dataset
@@ -40,90 +60,372 @@ def test_suit():
     """
     unittest.main(module='test-cases.calculation_worker-test', exit=False)
 
+def parseArguments():
+    """
+    This function parses the command line options of the script
+    """
+    parser = argparse.ArgumentParser(description="Maps test data to the ideal functions that best fit the training data")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="Stream the CSV files in chunks of this many rows to keep memory bounded")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of workers used to select the ideal functions and classify the test data")
+    parser.add_argument("--processes", action="store_true",
+                        help="Classify the test data in worker processes instead of threads, with --workers")
+    parser.add_argument("--loss", choices=sorted(LOSS_FUNCTIONS), default="sse",
+                        help="Loss used to select the ideal functions, sse is the least-squares criterion")
+    parser.add_argument("--weights", default=None, metavar="PATH",
+                        help="CSV file with the weight of every training row in its last column, in the row order of "
+                             "train.csv, used by the weighted_sse loss")
+    parser.add_argument("--top-k", type=int, default=None,
+                        help="Log the k best candidate ideal functions of every training function for diagnostics")
+    parser.add_argument("--lookup", choices=LOOKUP_POLICIES, default="exact",
+                        help="How the ideal functions are looked up at test x values that are not on their grid")
+    parser.add_argument("--band-index", action="store_true",
+                        help="Index the tolerance bands of the ideal functions, so every test point only visits the "
+                             "ideal functions whose band can contain it. It only pays off for many ideal functions "
+                             "with narrow, rarely overlapping bands, and needs the exact lookup")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directory of a binary cache of the parsed CSV files, memory-mapped on warm runs")
+    parser.add_argument("--ideal-catalog", default=None, metavar="PATH",
+                        help="Attach to a read-only memory-mapped catalog of ideal.csv at this path instead of parsing it, "
+                             "so concurrent runs share one copy. It is written first when it is missing or stale")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Reuse the stored ideal selection while the training and ideal data and the loss and "
+                             "lookup settings are unchanged, and only classify the test points that aren't mapped yet")
+    parser.add_argument("--no-plots", action="store_true", help="Don't create the HTML plots")
+    parser.add_argument("--show-plots", action="store_true",
+                        help="Open the HTML plots in a browser once they are saved, instead of only saving them")
+    parser.add_argument("--plot-mode", choices=["auto", "per-point", "aggregated"], default="auto",
+                        help="Plot the test data with one figure per point, or with one figure per ideal function whose "
+                             f"size doesn't grow with the test data. auto uses per-point up to {PER_POINT_PLOT_LIMIT} points")
+    parser.add_argument("--fast-sqlite", action="store_true",
+                        help="Write solution.db with a write-ahead log and without syncing to disk, which is much faster "
+                             "but can lose the latest writes on a power loss")
+    parser.add_argument("--serve", default=None, metavar="ADDRESS",
+                        help="Instead of mapping test.csv, classify points sent as JSON or CSV lines to stdio, "
+                             "unix:PATH or tcp:HOST:PORT until the input ends or the service is interrupted")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO",
+                        help="Level of the log written to output-data/main.log and stdout. DEBUG adds sampled per-call messages")
+    parser.add_argument("--report", default=None,
+                        help="Write a JSON run report with the time, rows and calls of every stage to this file")
+    parser.add_argument("--report-memory", action="store_true",
+                        help="Also record the peak memory of every stage in the run report (slows the run down)")
+    arguments = parser.parse_args()
+    if arguments.chunk_size and arguments.loss != "sse":
+        parser.error("--chunk-size only supports the sse loss")
+    if arguments.chunk_size and arguments.incremental:
+        parser.error("--incremental can't be combined with --chunk-size")
+    if arguments.chunk_size and arguments.ideal_catalog:
+        parser.error("--ideal-catalog can't be combined with --chunk-size")
+    if arguments.weights and arguments.loss != "weighted_sse":
+        parser.error("--weights is only used by the weighted_sse loss")
+    if arguments.loss == "weighted_sse" and not arguments.weights:
+        parser.error("the weighted_sse loss needs --weights")
+    if arguments.workers > 1 and arguments.chunk_size:
+        parser.error("--workers can't be combined with --chunk-size")
+    if arguments.top_k and arguments.chunk_size:
+        parser.error("--top-k can't be combined with --chunk-size")
+    if arguments.top_k and arguments.incremental:
+        parser.error("--top-k can't be combined with --incremental, which can reuse the stored selection")
+    if arguments.band_index and arguments.lookup != "exact":
+        parser.error("--band-index only supports the exact lookup")
+    if arguments.serve:
+        try:
+            parseAddress(arguments.serve)
+        except ValueError as e:
+            parser.error(str(e))
+    return arguments
+
+def exportChunksToSql(sql_writer):
+    """
+    This function returns a minimiseLossStreaming callback that exports every ideal and training chunk to SQLite
+    on the SQLite writer stage
+    """
+    if_exists = "replace"
+
+    def exportChunk(train_chunk, ideal_chunk):
+        nonlocal if_exists
+        sql_writer.submit(exportTablesToSql, ideal_chunk, train_chunk, if_exists)
+        if_exists = "append"
+
+    return exportChunk
+
+def exportTablesToSql(ideal_dataset, train_dataset, if_exists="replace"):
+    """
+    This function writes the ideal and training tables to SQLite, it runs on the SQLite writer stage
+    """
+    try:
+        with span("to_sql", rows=len(ideal_dataset.values) + len(train_dataset.values)):
+            ideal_dataset.to_sql(file_name="ideal", suffix=" (ideal function)", if_exists=if_exists)
+            train_dataset.to_sql(file_name="training", suffix=" (training function)", if_exists=if_exists)
+    except Exception as e:
+        raise CsvConversionException("Error occurred while converting CSV to SQLite") from e
+
+def readWeights(weights_path):
+    """
+    This function reads the weight of every training row from the last column of a CSV file
+    """
+    try:
+        return pd.read_csv(weights_path).iloc[:, -1].to_numpy(dtype=np.float64)
+    except Exception as e:
+        raise CsvConversionException(f"Error occurred while reading the weights {weights_path}") from e
+
+def storeSelection(fingerprint, ideal_functions):
+    """
+    This function stores a new selection of ideal functions and drops the mapping made with the previous one,
+    it runs on the SQLite writer stage
+    """
+    try:
+        writeSelectionState(fingerprint, ideal_functions)
+        clearMappedRows()
+    except Exception as e:
+        raise MappingSQLWriteException("Error occurred while storing the selected ideal functions") from e
+
+def writeMapping(classification):
+    """
+    This function writes the mapping of one chunk of test points to SQLite, it runs on the SQLite writer stage
+    """
+    try:
+        with span("write_mapping", rows=len(classification)):
+            writeClassificationToSqlite(classification)
+    except Exception as e:
+        raise MappingSQLWriteException("Error occurred while writing the mapping to SQLite") from e
+
 if __name__ == '__main__':
     #invoke test suite
     # test_suit() Commented out as it is currently not needed
 
+    arguments = parseArguments()
 
-    # Configure logging
-    logger = logging.getLogger()
-    #INFO level logs can be enabled, when needed. {INFO}
-    logger.setLevel(logging.INFO)
+    # Configure logging, the file and stdout handlers run on a background thread behind a queue
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     file_handler = logging.FileHandler('output-data/main.log')
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
-    stream_handler = logging.StreamHandler(sys.stdout)
+    # The service answers on stdout when it serves stdio, so the log goes to stderr then
+    stream_handler = logging.StreamHandler(sys.stderr if arguments.serve == "stdio" else sys.stdout)
     stream_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
+    log_listener = startQueueLogging([file_handler, stream_handler], level=arguments.log_level)
+
+    if arguments.report:
+        INSTRUMENTATION.enable(traceMemory=arguments.report_memory)
+
+    # All tables of the run are written through the same engine, configured once
+    configureDatabase(fastWrites=arguments.fast_sqlite)
 
     # Input data declaration
     ideal_csv_path = "input-data/ideal.csv"
     train_csv_path = "input-data/train.csv"
     test_csv_path = "input-data/test.csv"
 
+    # The plots are saved on a background thread while the mapping is computed and written
+    plotter = BackgroundPlotter(enabled=not arguments.no_plots)
+    # All writes to SQLite run in order on one background thread, while the next CPU stage runs
+    sql_writer = PipelineStage("sqlite", maxPending=MAX_PENDING_WRITES)
+
     try:
-        # Read csv files and convert them to dataset using CoreFunction class
-        logging.info("Converting CSV files to dataset using CoreFunction class")
-        try:
-            ideal_csv_dataset = CoreFunction(csv_path=ideal_csv_path)
-            train_csv_dataset = CoreFunction(csv_path=train_csv_path)
-            test_csv_dataset = CoreFunction(csv_path=test_csv_path)
-        except Exception as e:
-            raise CsvConversionException("Error occurred while converting CSV to dataset using CoreFunction class") from e
+        if arguments.chunk_size:
+            # Stream the training and ideal data, exporting every chunk to SQLite while the errors accumulate
+            logging.info(f"Finding the best fitting functions while streaming chunks of {arguments.chunk_size} rows")
+            try:
+                with span("selection"):
+                    ideal_functions, _ = minimiseLossStreaming(trainCsvPath=train_csv_path, idealCsvPath=ideal_csv_path,
+                                                               chunkSize=arguments.chunk_size,
+                                                               onChunk=None if arguments.serve else exportChunksToSql(sql_writer))
+            except Exception as e:
+                raise IdealFunctionException("Error occurred while finding the best fitting function") from e
+        else:
+            # Read csv files and convert them to dataset using CoreFunction class
+            logging.info("Converting CSV files to dataset using CoreFunction class")
+            try:
+                with span("load") as load_span:
+                    if arguments.ideal_catalog:
+                        ideal_csv_dataset = openCatalog(ideal_csv_path, arguments.ideal_catalog)
+                    else:
+                        ideal_csv_dataset = CoreFunction(csv_path=ideal_csv_path, cache_dir=arguments.cache_dir)
+                    train_csv_dataset = CoreFunction(csv_path=train_csv_path, cache_dir=arguments.cache_dir)
+                    load_span.rows = len(ideal_csv_dataset.values) + len(train_csv_dataset.values)
+            except Exception as e:
+                raise CsvConversionException("Error occurred while converting CSV to dataset using CoreFunction class") from e
+
+        # The stored selection and mapping can be reused as long as the inputs and settings they were made from are
+        # unchanged. The ideal catalog already knows the content hash of ideal.csv.
+        file_digests = {ideal_csv_path: ideal_csv_dataset.source_fingerprint} if arguments.ideal_catalog else None
+        fingerprint = inputFingerprint([train_csv_path, ideal_csv_path] + ([arguments.weights] if arguments.weights else []),
+                                       arguments.loss, TOLERANCE_FACTOR, arguments.lookup, fileDigests=file_digests)
+        stored_selection = readSelectionState() if arguments.incremental else None
+        selection_reused = stored_selection is not None and stored_selection[0] == fingerprint
+
+        if selection_reused:
+            # The ideal and training tables in SQLite are still current as well
+            logging.info("The training and ideal data are unchanged, reusing the stored ideal functions")
+            try:
+                ideal_functions = restoreIdealFunctions(trainFunctions=train_csv_dataset,
+                                                        candidateFunctions=ideal_csv_dataset.functions,
+                                                        selection=stored_selection[1])
+            except Exception as e:
+                raise IdealFunctionException("Error occurred while restoring the stored ideal functions") from e
+        elif not arguments.chunk_size:
+            if not arguments.serve:
+                # Convert the csv files to SQLite with bulk inserts, in the background while the selection runs
+                logging.info("Converting CSV files to SQLite in the background")
+                sql_writer.submit(exportTablesToSql, ideal_csv_dataset, train_csv_dataset)
+
+            # Compute the ideal functions for all training functions in one vectorized pass
+            logging.info("Finding the best fitting functions")
+            loss_options = {"weights": readWeights(arguments.weights)} if arguments.weights else None
+            try:
+                with span("selection", rows=len(train_csv_dataset.values)):
+                    if arguments.workers > 1:
+                        ideal_functions, loss_matrix = minimiseLossParallel(trainFunctions=train_csv_dataset,
+                                                                            candidateFunctions=ideal_csv_dataset.functions,
+                                                                            workers=arguments.workers, loss=arguments.loss,
+                                                                            lossOptions=loss_options)
+                    else:
+                        ideal_functions, loss_matrix = minimiseLossBatch(trainFunctions=train_csv_dataset,
+                                                                         candidateFunctions=ideal_csv_dataset.functions,
+                                                                         loss=arguments.loss, lossOptions=loss_options)
+            except Exception as e:
+                raise IdealFunctionException("Error occurred while finding the best fitting function") from e
+
+            if arguments.top_k:
+                # Rank the best candidates of every training function by the selection loss to spot close runners-up
+                rankings = rankIdealFunctions(list(train_csv_dataset), ideal_csv_dataset.functions, loss_matrix,
+                                              arguments.top_k)
+                for train_function, candidates in zip(train_csv_dataset, rankings):
+                    ranking = ", ".join(f"{candidate.name} ({candidate.error:.4f})" for candidate in candidates)
+                    logging.info(f"Best {len(candidates)} candidates for {train_function.name}: {ranking}")
 
-        # Convert the csv files to SQLite using pandas
-        logging.info("Converting CSV files to SQLite using pandas")
         try:
-            ideal_csv_dataset.to_sql(file_name="ideal", suffix=" (ideal function)")
-            train_csv_dataset.to_sql(file_name="training", suffix=" (training function)")
+            for ideal_function in ideal_functions:
+                # Set the tolerance factor to the square root of 2
+                ideal_function.toleranceFactor = TOLERANCE_FACTOR
+            # Compute the tolerances of all ideal functions once, so later reads are served from the cache
+            with span("tolerances"):
+                precomputeLargestDeviations(ideal_functions)
         except Exception as e:
-            raise CsvConversionException("Error occurred while converting CSV to SQLite using pandas") from e
+            raise IdealFunctionException("Error occurred while finding the best fitting function") from e
+
+        if not selection_reused and not arguments.serve:
+            # A new selection invalidates the stored mapping, so the test data is mapped from scratch.
+            # The service doesn't write a mapping, so it leaves the database of the last run as it is
+            sql_writer.submit(storeSelection, fingerprint, ideal_functions)
+
+        # On request, index the tolerance bands so every point only visits the candidates
+        band_index = None
+        if arguments.band_index:
+            logging.info(f"Indexing the tolerance bands of {len(ideal_functions)} ideal functions")
+            with span("band_index"):
+                band_index = ToleranceBandIndex(ideal_functions)
+
 
-        # Compute the ideal functions for the provided data and store them in a list
-        ideal_functions = []
-        for train_function in train_csv_dataset:
-            # Find the best fitting function
-            logging.info("Finding the best fitting function")
+        if arguments.serve:
+            # Everything the classification reads is computed once, then the points are classified as they arrive
+            service = ClassificationService(ideal_functions, bandIndex=band_index, lookup=arguments.lookup)
+            runService(service, arguments.serve)
+        elif selection_reused:
+            logging.info("Keeping the plot of the unchanged ideal functions")
+        elif arguments.no_plots:
+            logging.info("Skipping the plot of the ideal functions")
+        elif arguments.chunk_size:
+            # The plot shows all training points, which a streamed run never holds in memory
+            logging.info("Skipping the plot of the ideal functions for the streamed training data")
+        else:
+            # Plot the ideal functions on the graph and save to an HTML file
+            logging.info("Plotting the ideal functions on the graph and saving to an HTML file in the background")
+            plotter.submit(plotIdealFunctions, list(ideal_functions), "ideal-functions-vs-training-data",
+                           openBrowser=arguments.show_plots)
+
+        if arguments.serve:
+            # The service has answered the points, there is no test data to map
+            pass
+        elif arguments.chunk_size:
+            # Classify the test data chunk by chunk and write every chunk as soon as it is classified
+            logging.info("Classifying the streamed test data and writing the mapping to SQLite")
+            test_chunks = CoreFunction.read_chunks(test_csv_path, arguments.chunk_size)
+            for classification in classifyChunks(test_chunks, ideal_functions, bandIndex=band_index,
+                                                 lookup=arguments.lookup):
+                INSTRUMENTATION.count("test_points", len(classification))
+                sql_writer.submit(writeMapping, classification)
+            # One figure per test point can't be bounded, so the test plot is only built for in-memory runs
+            logging.info("Skipping the test data plot for the streamed test data")
+        else:
+            # Fetch the test CSV datasets and plot
+            logging.info("Fetching the test CSV datasets and plotting")
             try:
-                ideal_function = minimiseLoss(trainFunction=train_function,
-                                              listOfCandidateFunctions=ideal_csv_dataset.functions,
-                                              lossFunction=errorSquared)
-                # Set the tolerance factor to the square root of 2
-                ideal_function.toleranceFactor = math.sqrt(2)
-                # Add the ideal function to the list of ideal functions
-                ideal_functions.append(ideal_function)
+                with span("load") as load_span:
+                    test_csv_dataset = CoreFunction(csv_path=test_csv_path, cache_dir=arguments.cache_dir)
+                    load_span.rows = len(test_csv_dataset.values)
             except Exception as e:
-                raise IdealFunctionException("Error occurred while finding the best fitting function") from e
+                raise CsvConversionException("Error occurred while converting CSV to dataset using CoreFunction class") from e
+            test_dataset_points = test_csv_dataset.functions[0]
 
+            if arguments.incremental:
+                # Only the test points that aren't in the mapping table yet need to be classified, which can only be
+                # read once the pending writes, such as the clearing of a stale mapping, are done
+                with span("wait_sqlite"):
+                    sql_writer.drain()
+                # The mapping of test rows that were changed or removed since the last run is dropped first
+                removed = removeStaleMappedRows(test_dataset_points.xValues, test_dataset_points.yValues)
+                if removed:
+                    logging.info(f"Removed the mapping of {removed} test points that are no longer in the test data")
+                unmapped = unmappedPointsMask(test_dataset_points.xValues, test_dataset_points.yValues)
+                logging.info(f"Classifying {np.count_nonzero(unmapped)} of {len(unmapped)} test points that aren't mapped yet")
+                test_dataset_points = Function.from_matrix(test_dataset_points.name,
+                                                           np.column_stack([test_dataset_points.xValues[unmapped],
+                                                                            test_dataset_points.yValues[unmapped]]), 1)
 
-        # Plot the ideal functions on the graph and save to an HTML file
-        logging.info("Plotting the ideal functions on the graph and saving to an HTML file")
-        plotIdealFunctions(ideal_functions, "ideal-functions-vs-training-data")
+            test_point_count = len(test_dataset_points.xValues)
+            INSTRUMENTATION.count("test_points", test_point_count)
+            if arguments.incremental:
+                # The plot shows all test points, which an incremental run doesn't classify
+                logging.info("Skipping the test data plot for the incremental run")
+            elif arguments.no_plots:
+                logging.info("Skipping the test data plot")
+            plot_test_data = not arguments.incremental and not arguments.no_plots
 
-        # Fetch the test CSV datasets and plot
-        logging.info("Fetching the test CSV datasets and plotting")
-        test_dataset_points = test_csv_dataset.functions[0]
+            # Find the best classification function and the delta y for the test points chunk by chunk, every chunk
+            # is written to SQLite while the next one is classified
+            logging.info("Classifying the test data and writing the mapping to SQLite")
+            classification_chunks = []
+            with span("classification", rows=test_point_count):
+                for classification in classifyBatchChunks(testFunction=test_dataset_points, idealFunctions=ideal_functions,
+                                                          chunkSize=PIPELINE_CHUNK_ROWS, workers=arguments.workers,
+                                                          useProcesses=arguments.processes, bandIndex=band_index,
+                                                          lookup=arguments.lookup):
+                    sql_writer.submit(writeMapping, classification)
+                    if plot_test_data:
+                        classification_chunks.append(classification)
 
-        test_dataset_ideal_function_points = []
-        for point in test_dataset_points:
-            # Find the best classification function and the delta y for each point in the test dataset
-            ideal_function, y_delta = findClassification(point=point, idealFunctions=ideal_functions)
-            
-            # Create a dictionary containing the point, the classification function and the delta y
-            result = {"point": point, "classification": ideal_function, "delta_y": y_delta}
-            # Add the dictionary to the list of ideal function points
-            test_dataset_ideal_function_points.append(result)
+            if plot_test_data and (arguments.plot_mode == "per-point" or
+                                   (arguments.plot_mode == "auto" and test_point_count <= PER_POINT_PLOT_LIMIT)):
+                # Plot the test data into the Bokeh graph
+                logging.info("Plotting the test data into the Bokeh graph in the background")
+                plotter.submit(createPlottingPointBasedOnIdealFunction,
+                               MappingResult.concatenate(classification_chunks, ideal_functions),
+                               "test-functions-vs-ideal-functions", openBrowser=arguments.show_plots)
+            elif plot_test_data:
+                # Plot the test data into one Bokeh figure per ideal function
+                logging.info("Plotting the test data into the Bokeh graph, aggregated by ideal function, in the background")
+                plotter.submit(plotClassificationsByIdealFunction,
+                               MappingResult.concatenate(classification_chunks, ideal_functions),
+                               "test-functions-vs-ideal-functions", openBrowser=arguments.show_plots)
 
-        # Plot the test data into the Bokeh graph
-        logging.info("Plotting the test data into the Bokeh graph")
-        createPlottingPointBasedOnIdealFunction(test_dataset_ideal_function_points, "test-functions-vs-ideal-functions")
+        logging.info("Waiting for the SQLite writes to finish")
+        with span("wait_sqlite"):
+            sql_writer.wait()
 
-        # Write the mapping to SQLite to export as a .db file
-        logging.info("Writing the mapping to SQLite to export as a .db file")
-        writeToSqlite(test_dataset_ideal_function_points)
+        if plotter.enabled:
+            logging.info("Waiting for the plots to be saved")
+            with span("wait_plots"):
+                plotter.wait()
 
     except Exception as e:
         logging.error(str(e))
         raise MappingSQLWriteException("Error occurred while executing the script. Check the log file for details.") from e
+    finally:
+        if arguments.report:
+            # The report is written for failed runs too, to see which stage was reached
+            INSTRUMENTATION.writeReport(arguments.report)
+            logging.info(f"Wrote the run report to {arguments.report}")
+        stopQueueLogging(log_listener)
 
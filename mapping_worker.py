@@ -1,26 +1,139 @@
+import functools
+import itertools
 import logging
+import numpy as np
 from sqlalchemy import create_engine, Table, Column, String, Float, MetaData
 import sqlalchemy as db
+from instrumentation_worker import INSTRUMENTATION, instrumented
+
+DATABASE_PATH = 'output-data/solution.db'
+
+metadata = db.MetaData()
+
+mappingTableSchema = Table('mappingData', metadata,
+                Column('X (test function)', Float, primary_key=False),
+                Column('Y (test function)', Float),
+                Column('Delta Y (test function)', Float),
+                Column('Best ideal function', String(50))
+                )
+
+selectionStateSchema = Table('selectionState', metadata,
+                Column('Fingerprint', String(64)),
+                Column('Training function', String(50)),
+                Column('Ideal function', String(50)),
+                Column('Error', Float),
+                Column('Largest deviation', Float),
+                Column('Tolerance', Float)
+                )
+
+INSERT_MAPPING_SQL = ('INSERT INTO "mappingData" ("X (test function)", "Y (test function)", '
+                      '"Delta Y (test function)", "Best ideal function") VALUES (?, ?, ?, ?)')
 
 class DataSaveError(Exception):
     pass
 
-def writeToSqlite(data):
+@functools.lru_cache(maxsize=None)
+def getDatabaseEngine(databasePath=DATABASE_PATH):
+    '''
+    This function returns the pooled engine of a database file, creating it on first use
+
+    Parameters:
+    databasePath: str
     '''
-    This function saves the mapped testdata to the database
+    return create_engine(f'sqlite:///{databasePath}', echo=False)
+
+def configureDatabase(databasePath=DATABASE_PATH, fastWrites=False):
     '''
-    dbEngine = create_engine('sqlite:///output-data/solution.db', echo=False)
-    metadata = db.MetaData()
+    This function sets the write pragmas of every connection of the engine of a database file.
+    With fastWrites the database uses a write-ahead log and doesn't wait for the disk after a commit, which
+    makes writes much faster but can lose the latest transactions on a power loss. It is meant for databases
+    that are rebuilt from the input files anyway. The write-ahead log mode stays set in the database file.
 
-    mappingTableSchema = Table('mappingData', metadata,
-                    Column('X (test function)', Float, primary_key=False),
-                    Column('Y (test function)', Float),
-                    Column('Delta Y (test function)', Float),
-                    Column('Best ideal function', String(50))
-                    )
+    Parameters:
+    databasePath: str
+    fastWrites: bool
+    '''
+    dbEngine = getDatabaseEngine(databasePath)
+    if fastWrites and not getattr(dbEngine, "_fastWrites", False):
+        @db.event.listens_for(dbEngine, "connect")
+        def setFastWritePragmas(dbapiConnection, connectionRecord):
+            cursor = dbapiConnection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=OFF")
+            cursor.close()
 
-    metadata.create_all(dbEngine)
+        dbEngine._fastWrites = True
+        # Pooled connections were opened without the pragmas
+        dbEngine.dispose()
+    return dbEngine
 
+@instrumented()
+def writeFunctionTable(tableName, columns, values, ifExists="replace", databasePath=DATABASE_PATH, chunkSize=None):
+    '''
+    This function writes a matrix of function values to a table in a single transaction, with one FLOAT column
+    per function and an index on the first (x) column, like pandas.DataFrame.to_sql with the x column as index.
+    The rows are bound in chunks with executemany instead of going through pandas and SQLAlchemy row by row.
+    NaN values are stored as NULL. It returns the number of rows written.
+
+    Parameters:
+    tableName: str
+    columns: list of column names, the first one is the x column
+    values: (rows x columns) array
+    ifExists: str, "fail", "replace" or "append", like pandas.DataFrame.to_sql
+    databasePath: str
+    chunkSize: int, number of rows bound per executemany call, by default about a million values per chunk
+    '''
+    if ifExists not in ("fail", "replace", "append"):
+        raise ValueError(f"Invalid if_exists value {ifExists}")
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim != 2 or values.shape[1] != len(columns):
+        raise ValueError(f"Expected a matrix with {len(columns)} columns, got the shape {values.shape}")
+    if chunkSize is None:
+        chunkSize = max(1, 1000000 // len(columns))
+
+    quotedTable = _quote_identifier(tableName)
+    quotedColumns = [_quote_identifier(column) for column in columns]
+    insertSql = f'INSERT INTO {quotedTable} ({", ".join(quotedColumns)}) VALUES ({", ".join("?" * len(columns))})'
+
+    connection = getDatabaseEngine(databasePath).raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("BEGIN")
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (tableName,))
+        exists = cursor.fetchone() is not None
+        if exists and ifExists == "fail":
+            raise ValueError(f"Table {tableName} already exists.")
+        if exists and ifExists == "replace":
+            cursor.execute(f"DROP TABLE {quotedTable}")
+            exists = False
+        if not exists:
+            cursor.execute(f'CREATE TABLE {quotedTable} ({", ".join(column + " FLOAT" for column in quotedColumns)})')
+        for start in range(0, len(values), chunkSize):
+            cursor.executemany(insertSql, values[start:start + chunkSize].tolist())
+        if not exists:
+            # Built after the rows are in, which is faster than updating it row by row
+            indexName = _quote_identifier(f"ix_{tableName}_{columns[0]}")
+            cursor.execute(f"CREATE INDEX {indexName} ON {quotedTable} ({quotedColumns[0]})")
+        connection.commit()
+    except Exception as e:
+        connection.rollback()
+        raise DataSaveError(f"Error saving data: {str(e)}")
+    finally:
+        connection.close()
+    return len(values)
+
+def _quote_identifier(name):
+    '''
+    This function quotes a table, column or index name for SQLite
+    '''
+    return '"' + name.replace('"', '""') + '"'
+
+def writeToSqlite(data, databasePath=DATABASE_PATH):
+    '''
+    This function saves the mapped testdata to the database. The data is an iterable of point dicts, such as the
+    compatibility view of a MappingResult; writeClassificationToSqlite writes a MappingResult without creating them
+    '''
+    rows = []
     for singleRaw in data:
         point = singleRaw["point"]
         classification = singleRaw["classification"]
@@ -33,10 +146,222 @@ def writeToSqlite(data):
             classificationName = "-"
             yDelta = -1
 
+        rows.append((float(point["x"]), float(point["y"]), float(yDelta), classificationName))
+
+    return insert_mapped_rows(getDatabaseEngine(databasePath), rows)
+
+def writeClassificationToSqlite(result, databasePath=DATABASE_PATH, chunkSize=100000):
+    '''
+    This function saves a MappingResult to the database in a single transaction
+
+    Parameters:
+    result: MappingResult as returned by classifyBatch
+    databasePath: str
+    chunkSize: int, number of rows bound per executemany call
+    '''
+    # The last entry of the name table is used for points without a classification, whose ideal index -1
+    # selects it directly
+    nameTable = np.array([name.replace("y", "Y") for name in result.idealNames] + ["-"], dtype=object)
+    names = nameTable[result.idealIndexes]
+    deltaY = np.where(result.idealIndexes >= 0, result.deltaY, -1.0)
+
+    rows = zip(result.xValues.tolist(), result.yValues.tolist(), deltaY.tolist(), names.tolist())
+    return insert_mapped_rows(getDatabaseEngine(databasePath), rows, chunkSize=chunkSize)
+
+@instrumented()
+def insert_mapped_rows(dbEngine, rows, chunkSize=100000):
+    '''
+    This function inserts mapped testdata rows to the database with executemany inside one transaction.
+    A chunk that fails is rolled back and retried row by row, so only the faulty rows are skipped.
+    Failures are reported once as a summary. It returns a tuple (written rows, failed rows).
+
+    Parameters:
+    dbEngine: sqlalchemy.engine.Engine
+    rows: iterable of (x_test, y_test, delta_y, ideal_n_y) tuples
+    chunkSize: int
+    '''
+    metadata.create_all(dbEngine)
+
+    writtenRows = 0
+    failedRows = 0
+    errorMessages = {}
+
+    connection = dbEngine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("BEGIN")
+        rows = iter(rows)
+        for chunk in iter(lambda: list(itertools.islice(rows, chunkSize)), []):
+            written, failed = _insert_chunk(cursor, INSERT_MAPPING_SQL, chunk, errorMessages)
+            writtenRows, failedRows = writtenRows + written, failedRows + failed
+        connection.commit()
+    except Exception as e:
+        connection.rollback()
+        raise DataSaveError(f"Error saving data: {str(e)}")
+    finally:
+        connection.close()
+
+    INSTRUMENTATION.count("mapped_rows_written", writtenRows)
+    INSTRUMENTATION.count("mapped_rows_failed", failedRows)
+    if failedRows:
+        summary = "; ".join(f"{message} ({count}x)" for message, count in errorMessages.items())
+        logging.error(f"Saved {writtenRows} mapped rows, {failedRows} rows failed: {summary}")
+    return writtenRows, failedRows
+
+def _insert_chunk(cursor, sql, chunk, errorMessages):
+    '''
+    This function inserts one chunk of rows, falling back to row by row inserts when the chunk fails
+    '''
+    cursor.execute("SAVEPOINT mapping_chunk")
+    try:
+        cursor.executemany(sql, chunk)
+        cursor.execute("RELEASE SAVEPOINT mapping_chunk")
+        return len(chunk), 0
+    except Exception:
+        cursor.execute("ROLLBACK TO SAVEPOINT mapping_chunk")
+        cursor.execute("RELEASE SAVEPOINT mapping_chunk")
+
+    written = 0
+    for row in chunk:
         try:
-            insert_mapped_test_data(dbEngine, mappingTableSchema, point["x"], point["y"], yDelta, classificationName)
-        except DataSaveError as e:
-            logging.error(str(e))
+            cursor.execute(sql, row)
+            written += 1
+        except Exception as e:
+            message = str(e)
+            errorMessages[message] = errorMessages.get(message, 0) + 1
+    return written, len(chunk) - written
+
+def clearMappedRows(databasePath=DATABASE_PATH):
+    '''
+    This function removes all rows of the mapping table, so a full run doesn't append to the rows of earlier runs
+
+    Parameters:
+    databasePath: str
+    '''
+    dbEngine = getDatabaseEngine(databasePath)
+    metadata.create_all(dbEngine)
+    with dbEngine.begin() as con:
+        con.execute(mappingTableSchema.delete())
+
+def unmappedPointsMask(xValues, yValues, databasePath=DATABASE_PATH):
+    '''
+    This function returns a boolean array that is True for every test point that isn't in the mapping table yet.
+    A point that occurs n times in the mapping table covers its first n occurrences in the test points, so a
+    repeated test point that was appended to the test data is mapped again
+
+    Parameters:
+    xValues: array of the x values of the test points
+    yValues: array of the y values of the test points
+    databasePath: str
+    '''
+    dbEngine = getDatabaseEngine(databasePath)
+    metadata.create_all(dbEngine)
+    with dbEngine.connect() as con:
+        mapped = con.execute(db.select(mappingTableSchema.c['X (test function)'],
+                                       mappingTableSchema.c['Y (test function)'])).fetchall()
+    points = _pointKeys(xValues, yValues)
+    if not mapped:
+        return np.ones(len(points), dtype=bool)
+    return _occurrences(points) >= _timesIn(points, _pointKeys(*np.array(mapped, dtype=np.float64).T))
+
+def removeStaleMappedRows(xValues, yValues, databasePath=DATABASE_PATH):
+    '''
+    This function removes the mapping rows of points that are no longer in the test data, or that are mapped more
+    often than they occur in it, so an incremental run drops the mapping of changed and removed test rows.
+    Of the rows of a point, the oldest ones are kept. It returns the number of removed rows
+
+    Parameters:
+    xValues: array of the x values of the test points
+    yValues: array of the y values of the test points
+    databasePath: str
+    '''
+    dbEngine = getDatabaseEngine(databasePath)
+    metadata.create_all(dbEngine)
+    with dbEngine.begin() as con:
+        mapped = con.execute(db.text('SELECT rowid, "X (test function)", "Y (test function)" FROM "mappingData" '
+                                     'ORDER BY rowid')).fetchall()
+        if not mapped:
+            return 0
+        rowIds, mappedX, mappedY = np.array(mapped, dtype=np.float64).T
+        mappedPoints = _pointKeys(mappedX, mappedY)
+        stale = rowIds[_occurrences(mappedPoints) >= _timesIn(mappedPoints, _pointKeys(xValues, yValues))]
+        if len(stale):
+            con.execute(db.text('DELETE FROM "mappingData" WHERE rowid = :rowid'),
+                        [{"rowid": int(rowId)} for rowId in stale])
+    return len(stale)
+
+def _pointKeys(xValues, yValues):
+    '''
+    This function views every (x, y) pair as one complex number, so NumPy can sort and compare the pairs as single values
+    '''
+    return np.column_stack([np.asarray(xValues, dtype=np.float64),
+                            np.asarray(yValues, dtype=np.float64)]).view(np.complex128).ravel()
+
+def _occurrences(points):
+    '''
+    This function returns the occurrence of every point among the equal points before it, 0 for the first one
+    '''
+    order = np.argsort(points, kind="stable")
+    sortedPoints = points[order]
+    positions = np.arange(len(points))
+    groupStarts = np.maximum.accumulate(np.where(np.r_[True, sortedPoints[1:] != sortedPoints[:-1]], positions, 0))
+    occurrences = np.empty(len(points), dtype=np.intp)
+    occurrences[order] = positions - groupStarts
+    return occurrences
+
+def _timesIn(points, otherPoints):
+    '''
+    This function returns how often every point occurs in another array of points
+    '''
+    if len(otherPoints) == 0:
+        return np.zeros(len(points), dtype=np.intp)
+    uniquePoints, counts = np.unique(otherPoints, return_counts=True)
+    found = np.minimum(np.searchsorted(uniquePoints, points), len(uniquePoints) - 1)
+    return np.where(uniquePoints[found] == points, counts[found], 0)
+
+def writeSelectionState(fingerprint, idealFunctions, databasePath=DATABASE_PATH):
+    '''
+    This function replaces the stored selection with the chosen ideal functions and the fingerprint of the
+    inputs they were chosen from
+
+    Parameters:
+    fingerprint: str, as returned by inputFingerprint
+    idealFunctions: list of IdealFunction objects, one per training function
+    databasePath: str
+    '''
+    dbEngine = getDatabaseEngine(databasePath)
+    metadata.create_all(dbEngine)
+    rows = [{"Fingerprint": fingerprint,
+             "Training function": idealFunction.training_function.name,
+             "Ideal function": idealFunction.name,
+             "Error": float(idealFunction.error),
+             "Largest deviation": float(idealFunction.largestDeviation),
+             "Tolerance": float(idealFunction.tolerance)} for idealFunction in idealFunctions]
+    try:
+        with dbEngine.begin() as con:
+            con.execute(selectionStateSchema.delete())
+            con.execute(selectionStateSchema.insert(), rows)
+    except Exception as e:
+        raise DataSaveError(f"Error saving data: {str(e)}")
+
+def readSelectionState(databasePath=DATABASE_PATH):
+    '''
+    This function returns the stored selection as a tuple (fingerprint, list of (training function name,
+    ideal function name, error) tuples), or None when no selection has been stored yet
+
+    Parameters:
+    databasePath: str
+    '''
+    dbEngine = getDatabaseEngine(databasePath)
+    if not db.inspect(dbEngine).has_table(selectionStateSchema.name):
+        return None
+    with dbEngine.connect() as con:
+        rows = con.execute(db.select(selectionStateSchema.c['Fingerprint'], selectionStateSchema.c['Training function'],
+                                     selectionStateSchema.c['Ideal function'], selectionStateSchema.c['Error'])
+                           .order_by(db.text("rowid"))).fetchall()
+    if not rows:
+        return None
+    return rows[0][0], [(trainName, idealName, error) for _, trainName, idealName, error in rows]
 
 def insert_mapped_test_data(dbEngine, mappingTableSchema, x_test, y_test, delta_y, ideal_n_y):
     '''
@@ -0,0 +1,94 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+"""
+This module runs the I/O stages of the mapping, such as the SQLite writes and the HTML plots, concurrently with
+the CPU stages. Every stage runs the calls it is given in order on its own thread, so a stage that writes to
+SQLite never competes with itself for the database, and the caller goes on with the next CPU step right away.
+"""
+
+
+class PipelineStage:
+    """
+    One stage of a pipeline, which runs the calls it is given one after another on a background thread.
+    At most `maxPending` calls wait for the stage; submitting another one blocks until a call has finished,
+    so a fast producer can't queue an unbounded amount of data for a slow stage.
+    Once a call has failed, the calls queued after it are skipped and the error is raised to the caller by the
+    next submit, drain or wait.
+    The calls must only be given data that isn't changed afterwards.
+
+    Attributes:
+        name (str): The name of the stage, used for its thread.
+        maxPending (int): The largest number of calls waiting for the stage, None for no limit.
+        enabled (bool): Whether the stage runs anything; a disabled stage ignores everything it is given.
+    """
+
+    def __init__(self, name, maxPending=None, enabled=True):
+        """
+        Initializes the stage. The thread is started with the first call.
+        """
+        self.name = name
+        self.maxPending = maxPending
+        self.enabled = enabled
+        self._executor = None
+        self._futures = []
+        self._failure = None
+        self._slots = threading.BoundedSemaphore(maxPending) if maxPending else None
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queues a call of a function, unless the stage is disabled. It returns the Future of the call, or None.
+        """
+        if not self.enabled:
+            return None
+        self._raiseFailure()
+        if self._slots is not None:
+            self._slots.acquire()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.name)
+        future = self._executor.submit(self._run, function, args, kwargs)
+        if self._slots is not None:
+            future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+        return future
+
+    def _run(self, function, args, kwargs):
+        """
+        Runs one call on the stage thread, unless an earlier call has failed.
+        """
+        if self._failure is not None:
+            return None
+        try:
+            return function(*args, **kwargs)
+        except BaseException as e:
+            self._failure = e
+            raise
+
+    def drain(self):
+        """
+        Waits until all queued calls have finished and raises the first error of a failed call.
+        The stage keeps accepting calls afterwards.
+        """
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.exception()
+        self._raiseFailure()
+
+    def wait(self):
+        """
+        Waits until all queued calls have finished, stops the thread and raises the first error of a failed call.
+        """
+        try:
+            self.drain()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    def _raiseFailure(self):
+        """
+        Raises the error of the first failed call, if there is one.
+        """
+        if self._failure is not None:
+            raise self._failure
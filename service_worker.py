@@ -0,0 +1,321 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import stat
+import sys
+import threading
+import numpy as np
+from calculations_worker import classifyPoints, locateY, checkBandIndexLookup
+from function_model_worker import sharesGrid
+
+
+"""
+This module classifies test points as they arrive, instead of reading them from test.csv.
+Every line of input is one point, either as JSON ({"x": 1.0, "y": 2.0}, with an optional "id" that is echoed)
+or as CSV (1.0,2.0). Every point gets one line of output in the same format and order: a JSON object with
+the ideal function and delta y (null without a classification), or a CSV line x,y,delta y,ideal function
+using -1 and "-" without a classification, like the mapping table.
+"""
+
+
+# Marks the end of the input in the queue of parsed requests
+_END_OF_INPUT = object()
+
+
+class ClassificationService:
+    """
+    Classifies newline-delimited test points against a fixed set of ideal functions in micro-batches.
+    Whatever input has arrived while the previous batch was classified forms the next batch, so a lone point
+    is answered right away and a busy stream is classified in vectorized batches of up to `batchSize` points.
+    The parsed input waits in a queue of at most `maxPendingChunks` chunks; when it is full the connection
+    isn't read any further until the results have been written, which pushes back on the client.
+
+    Attributes:
+        idealFunctions (list): The IdealFunction objects the points are classified against.
+        bandIndex (ToleranceBandIndex): Optional band index over the ideal functions.
+        lookup (str): The lookup policy for off-grid x values.
+        batchSize (int): The largest number of points classified at once.
+        maxPendingChunks (int): The largest number of parsed input chunks waiting to be classified.
+        pointsServed (int): The number of points answered so far.
+    """
+
+    def __init__(self, idealFunctions, bandIndex=None, lookup="exact", batchSize=4096, maxPendingChunks=16):
+        """
+        Initializes the service and computes everything the classification reads only once.
+        """
+        checkBandIndexLookup(bandIndex, lookup)
+        self.idealFunctions = list(idealFunctions)
+        self.bandIndex = bandIndex
+        self.lookup = lookup
+        self.batchSize = batchSize
+        self.maxPendingChunks = maxPendingChunks
+        self.pointsServed = 0
+        self._tolerances = [idealFunction.tolerance for idealFunction in self.idealFunctions]
+        # The functions whose grids decide which x values the exact lookup finds, one for a shared grid
+        self._gridFunctions = self.idealFunctions[:1] if sharesGrid(self.idealFunctions) else self.idealFunctions
+        # Builds the x index and interpolation caches now instead of on the first request
+        for idealFunction in self.idealFunctions:
+            locateY(idealFunction, np.empty(0), lookup)
+        self._jsonNames = [json.dumps(idealFunction.name) for idealFunction in self.idealFunctions]
+        self._csvNames = [idealFunction.name.replace("y", "Y") for idealFunction in self.idealFunctions]
+
+    async def serveStream(self, readChunk, write):
+        """
+        Answers all points of one input stream. `readChunk` is a coroutine function returning the next bytes of
+        input (b"" at the end) and `write` a coroutine function writing bytes of output.
+        """
+        queue = asyncio.Queue(maxsize=self.maxPendingChunks)
+        reader = asyncio.ensure_future(self._readRequests(readChunk, queue))
+        try:
+            await self._answerRequests(queue, write)
+        finally:
+            reader.cancel()
+
+    async def _readRequests(self, readChunk, queue):
+        """
+        Splits the input into lines and queues the parsed requests of every chunk. The end of the input is
+        queued as _END_OF_INPUT and a failure to read as the exception.
+        """
+        remainder = b""
+        try:
+            while True:
+                data = await readChunk()
+                if not data:
+                    break
+                lines = (remainder + data).split(b"\n")
+                remainder = lines.pop()
+                if lines:
+                    await queue.put(parseRequests(lines))
+            if remainder.strip():
+                await queue.put(parseRequests([remainder]))
+        except Exception as e:
+            await queue.put(e)
+            return
+        await queue.put(_END_OF_INPUT)
+
+    async def _answerRequests(self, queue, write):
+        """
+        Classifies the queued requests in micro-batches and writes the answers in input order.
+        """
+        end = None
+        while end is None:
+            chunk = await queue.get()
+            if not isinstance(chunk, list):
+                end = chunk
+                break
+            requests = chunk
+            # Everything that is already queued joins the batch, without waiting for more input
+            while len(requests) < self.batchSize and not queue.empty():
+                chunk = queue.get_nowait()
+                if not isinstance(chunk, list):
+                    end = chunk
+                    break
+                requests = requests + chunk
+            await write(self.answer(requests))
+        if isinstance(end, Exception):
+            raise end
+
+    def answer(self, requests):
+        """
+        Classifies a list of parsed requests, as returned by parseRequests, and returns the output lines as bytes.
+        """
+        valid = [index for index, request in enumerate(requests) if request[0] is not None]
+        xValues = np.fromiter((requests[index][1] for index in valid), dtype=np.float64, count=len(valid))
+        yValues = np.fromiter((requests[index][2] for index in valid), dtype=np.float64, count=len(valid))
+        idealIndexes, deltaY, errors = self._classify(xValues, yValues)
+
+        answers = [None] * len(requests)
+        for position, index in enumerate(valid):
+            answers[index] = self._formatAnswer(requests[index], idealIndexes[position], deltaY[position], errors.get(position))
+        for index, request in enumerate(requests):
+            if request[0] is None:
+                answers[index] = self._formatError(request)
+        self.pointsServed += len(requests)
+        return ("\n".join(answers) + "\n").encode() if answers else b""
+
+    def _classify(self, xValues, yValues):
+        """
+        Classifies arrays of points. When a point can't be looked up, only the points whose x value isn't on the
+        grid of the ideal functions fail, and the rest of the batch is still classified at once. It returns the
+        ideal indexes, the delta y values and a dict of error messages by position.
+        """
+        try:
+            result = classifyPoints(xValues, yValues, self.idealFunctions, self._tolerances, self.bandIndex, self.lookup)
+            return result.idealIndexes.tolist(), result.deltaY.tolist(), {}
+        except IndexError as e:
+            error = str(e)
+
+        # Only the exact lookup fails on a point, and only for an x value missing from a grid
+        found = np.ones(len(xValues), dtype=bool)
+        for idealFunction in self._gridFunctions:
+            found &= idealFunction.locateRows(xValues)[1]
+        idealIndexes = np.full(len(xValues), -1, dtype=np.int16)
+        deltaY = np.full(len(xValues), np.nan)
+        result = classifyPoints(xValues[found], yValues[found], self.idealFunctions, self._tolerances, self.bandIndex,
+                                self.lookup)
+        idealIndexes[found] = result.idealIndexes
+        deltaY[found] = result.deltaY
+        return idealIndexes.tolist(), deltaY.tolist(), dict.fromkeys(np.flatnonzero(~found).tolist(), error)
+
+    def _formatAnswer(self, request, idealIndex, deltaY, error):
+        """
+        Returns the output line of a classified request.
+        """
+        kind, x, y, requestId = request
+        if kind == "json":
+            prefix = '{"id": %s, ' % requestId if requestId is not None else "{"
+            if error is not None:
+                return '%s"x": %r, "y": %r, "error": %s}' % (prefix, x, y, json.dumps(error))
+            if idealIndex < 0:
+                return '%s"x": %r, "y": %r, "ideal": null, "delta_y": null}' % (prefix, x, y)
+            return '%s"x": %r, "y": %r, "ideal": %s, "delta_y": %r}' % (prefix, x, y, self._jsonNames[idealIndex], deltaY)
+        if error is not None:
+            return "error,%s" % error.replace("\n", " ")
+        if idealIndex < 0:
+            return "%r,%r,-1,-" % (x, y)
+        return "%r,%r,%r,%s" % (x, y, deltaY, self._csvNames[idealIndex])
+
+    def _formatError(self, request):
+        """
+        Returns the output line of a request that couldn't be parsed.
+        """
+        _, message, isJson, _ = request
+        if isJson:
+            return json.dumps({"error": message})
+        return "error,%s" % message
+
+
+def parseRequests(lines):
+    """
+    This function parses lines of input into requests. A request is a tuple ("json" or "csv", x, y, id), where the
+    id is the JSON encoded id of the point or None. A line that can't be parsed, or has a non-finite x or y, gives
+    (None, error message, whether it looked like JSON, None). Blank lines are skipped.
+    """
+    requests = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line[:1] == b"{":
+            try:
+                point = json.loads(line)
+                requestId = json.dumps(point["id"]) if "id" in point else None
+                requests.append(("json", *_parseCoordinates(point["x"], point["y"]), requestId))
+            except (ValueError, KeyError, TypeError) as e:
+                requests.append((None, f"Invalid point {line[:80].decode(errors='replace')}: {e}", True, None))
+        else:
+            try:
+                x, y = line.split(b",")
+                requests.append(("csv", *_parseCoordinates(x, y), None))
+            except ValueError as e:
+                requests.append((None, f"Invalid point {line[:80].decode(errors='replace')}: {e}", False, None))
+    return requests
+
+
+def _parseCoordinates(x, y):
+    """
+    Converts the x and y values of a point to floats. Infinite and NaN values can't be classified and have no
+    JSON representation, so they raise a ValueError like values that aren't numbers.
+    """
+    x, y = float(x), float(y)
+    if not (math.isfinite(x) and math.isfinite(y)):
+        raise ValueError("x and y must be finite numbers")
+    return x, y
+
+
+def parseAddress(address):
+    """
+    This function parses a service address: "stdio", "unix:PATH" or "tcp:HOST:PORT".
+    It returns a tuple (kind, arguments).
+    """
+    if address == "stdio":
+        return "stdio", ()
+    kind, _, rest = address.partition(":")
+    if kind == "unix" and rest:
+        return "unix", (rest,)
+    if kind == "tcp":
+        host, _, port = rest.rpartition(":")
+        if host and port.isdigit():
+            return "tcp", (host, int(port))
+    raise ValueError(f"Invalid service address {address}, expected stdio, unix:PATH or tcp:HOST:PORT")
+
+
+async def serveStdio(service, inputStream=None, outputStream=None):
+    """
+    This function answers the points of the standard input (or another binary stream) on the standard output.
+    A thread reads the input, since asyncio can't wait on regular files and terminals.
+    """
+    inputStream = inputStream if inputStream is not None else sys.stdin.buffer
+    outputStream = outputStream if outputStream is not None else sys.stdout.buffer
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue(maxsize=service.maxPendingChunks)
+
+    def readInput():
+        # read1 returns what is available instead of waiting for a full buffer, which keeps the latency low
+        read = getattr(inputStream, "read1", inputStream.read)
+        while True:
+            data = read(1 << 16)
+            asyncio.run_coroutine_threadsafe(chunks.put(data), loop).result()
+            if not data:
+                break
+
+    threading.Thread(target=readInput, name="service-stdin", daemon=True).start()
+
+    async def write(data):
+        outputStream.write(data)
+        outputStream.flush()
+
+    await service.serveStream(chunks.get, write)
+
+
+async def serveSocket(service, kind, arguments, ready=None):
+    """
+    This function answers the points of every connection to a Unix or TCP socket, until it is cancelled.
+    `ready` is an optional asyncio.Event that is set once the server accepts connections.
+    """
+    async def handleConnection(reader, writer):
+        peer = writer.get_extra_info("peername") or "unix socket"
+
+        async def write(data):
+            writer.write(data)
+            await writer.drain()
+
+        try:
+            await service.serveStream(lambda: reader.read(1 << 16), write)
+        except ConnectionError as e:
+            logging.warning(f"Connection from {peer} closed: {e}")
+        finally:
+            writer.close()
+
+    if kind == "unix":
+        # A socket left behind by an earlier run is replaced, any other file at the path is left alone
+        try:
+            if stat.S_ISSOCK(os.stat(arguments[0]).st_mode):
+                os.unlink(arguments[0])
+        except FileNotFoundError:
+            pass
+        server = await asyncio.start_unix_server(handleConnection, path=arguments[0])
+    else:
+        server = await asyncio.start_server(handleConnection, host=arguments[0], port=arguments[1])
+    logging.info(f"Classifying points sent to {kind} socket {':'.join(str(argument) for argument in arguments)}")
+    async with server:
+        if ready is not None:
+            ready.set()
+        await server.serve_forever()
+
+
+def runService(service, address):
+    """
+    This function runs the service on an address (see parseAddress) until the input ends or it is interrupted.
+    """
+    kind, arguments = parseAddress(address)
+    try:
+        if kind == "stdio":
+            asyncio.run(serveStdio(service))
+        else:
+            asyncio.run(serveSocket(service, kind, arguments))
+    except KeyboardInterrupt:
+        pass
+    logging.info(f"Classification service answered {service.pointsServed} points")
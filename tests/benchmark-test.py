@@ -0,0 +1,71 @@
+import tempfile
+import tracemalloc
+import unittest
+from unittest import mock
+
+import sys
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+import benchmark
+from benchmark import compareReports, runBenchmark
+
+
+class BenchmarkUnitTest(unittest.TestCase):
+    def testCompareReports(self):
+        """Tests that only the stages slower than the baseline by more than the tolerance are regressions."""
+        report = {"stages": {"selection": {"wall_s": 1.3}, "classification": {"wall_s": 1.2},
+                             "plots": {"wall_s": 5.0}, "sqlite": {"wall_s": 0.5}}}
+        baseline = {"stages": {"selection": {"wall_s": 1.0}, "classification": {"wall_s": 1.0},
+                               "sqlite": {"wall_s": 0.0}}}
+
+        self.assertEqual(compareReports(report, baseline, tolerance=1.25), ["selection"])
+        self.assertAlmostEqual(report["stages"]["selection"]["baseline_ratio"], 1.3)
+        self.assertAlmostEqual(report["stages"]["classification"]["baseline_ratio"], 1.2)
+        # Stages missing from the baseline, or without a measured baseline time, aren't compared
+        self.assertNotIn("baseline_ratio", report["stages"]["plots"])
+        self.assertNotIn("baseline_ratio", report["stages"]["sqlite"])
+
+    def testCompareWithEmptyBaseline(self):
+        """Tests that a baseline without stages reports no regressions."""
+        self.assertEqual(compareReports({"stages": {"selection": {"wall_s": 1.0}}}, {}, tolerance=1.25), [])
+
+    def testCompareDifferentConfigs(self):
+        """Tests that reports of runs with different configs are refused."""
+        config = {"rows": 400, "ideal_columns": 50, "train_columns": 4, "test_points": 100, "plots": False,
+                  "memory_pass": True}
+        report = {"config": config, "stages": {"selection": {"wall_s": 1.0}}}
+
+        self.assertEqual(compareReports(report, {"config": dict(config), "stages": {"selection": {"wall_s": 1.0}}},
+                                        tolerance=1.25), [])
+        for option, value in (("rows", 4000), ("memory_pass", False)):
+            with self.assertRaises(ValueError):
+                compareReports(report, {"config": {**config, option: value}, "stages": {"selection": {"wall_s": 2.0}}},
+                               tolerance=1.25)
+
+    def testMemoryTracedSeparately(self):
+        """Tests that the stages are timed without tracemalloc and the peak memory comes from a second run."""
+        tracing = []
+        originalClassify = benchmark.classifyBatch
+
+        def classifyBatch(*args, **kwargs):
+            tracing.append(tracemalloc.is_tracing())
+            return originalClassify(*args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(benchmark, "classifyBatch", classifyBatch):
+            report = runBenchmark(directory, rows=40, idealColumns=6, trainColumns=2, testPoints=20)
+            self.assertEqual(tracing, [False, True])
+            self.assertTrue(report["config"]["memory_pass"])
+            self.assertGreater(report["stages"]["classification"]["peak_bytes"], 0)
+            self.assertEqual(report["stages"]["classification"]["calls"], 1)
+
+            tracing.clear()
+            report = runBenchmark(directory, rows=40, idealColumns=6, trainColumns=2, testPoints=20, traceMemory=False)
+            self.assertEqual(tracing, [False])
+            self.assertIsNone(report["stages"]["classification"]["peak_bytes"])
+
+
+if __name__ == '__main__':
+    unittest.main()
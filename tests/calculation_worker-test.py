@@ -1,4 +1,6 @@
+import math
 import unittest
+import numpy as np
 import pandas as pd
 import logging
 
@@ -8,8 +10,11 @@ import os
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
 
-from calculations_worker import errorSquared
-from function_model_worker import CoreFunction
+from calculations_worker import errorSquared, minimiseLoss, minimiseLossBatch, findClassification, classifyBatch, \
+    minimiseLossStreaming, minimiseLossParallel, classifyChunks, classifyBatchParallel, classifyBatchChunks, ToleranceBandIndex, \
+    LOSS_FUNCTIONS, registerLoss, rankCandidates, rankIdealFunctions
+import calculations_worker
+from function_model_worker import CoreFunction, Function, IdealFunction, MappingResult
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -45,5 +50,264 @@ class MyUnitTest(unittest.TestCase):
         # Test to ensure that the function returns zero when given the same function twice
         self.assertEqual(errorSquared(self.func1, self.func1), 0.0)
 
+    def testMinimiseLossBatch(self):
+        """Tests that the batch selection picks the same ideal functions as minimiseLoss."""
+        trainDataset = CoreFunction('input-data/train.csv')
+        idealDataset = CoreFunction('input-data/ideal.csv')
+
+        idealFunctions, errors = minimiseLossBatch(trainDataset, idealDataset.functions)
+
+        self.assertEqual(errors.shape, (len(trainDataset.functions), len(idealDataset.functions)))
+        for trainFunction, idealFunction in zip(trainDataset, idealFunctions):
+            expected = minimiseLoss(trainFunction, idealDataset.functions, errorSquared)
+            self.assertEqual(idealFunction.name, expected.name)
+            self.assertAlmostEqual(idealFunction.error, expected.error, places=6)
+
+    def testTopKRanking(self):
+        """Tests that the early-abandon ranking returns the k smallest squared errors in order."""
+        trainDataset = CoreFunction('input-data/train.csv')
+        idealDataset = CoreFunction('input-data/ideal.csv')
+        _, errors = minimiseLossBatch(trainDataset, idealDataset.functions)
+
+        for trainIndex, trainFunction in enumerate(trainDataset):
+            expectedOrder = np.argsort(errors[trainIndex], kind="stable")[:5]
+            ranking = rankCandidates(trainFunction, idealDataset.functions, 5, blockSize=32)
+            self.assertEqual([function.name for function in ranking],
+                             [idealDataset.functions[index].name for index in expectedOrder])
+            np.testing.assert_allclose([function.error for function in ranking], errors[trainIndex, expectedOrder], rtol=1e-9)
+
+            # The pairwise path gives the same ranking
+            pairwise = minimiseLoss(trainFunction, idealDataset.functions, lambda first, second: errorSquared(first, second), topK=5)
+            self.assertEqual([function.name for function in pairwise], [function.name for function in ranking])
+
+    def testRankIdealFunctions(self):
+        """Tests that the ranking of a loss matrix starts with the selection and follows the selection loss."""
+        trainDataset = CoreFunction('input-data/train.csv')
+        idealDataset = CoreFunction('input-data/ideal.csv')
+        idealFunctions, errors = minimiseLossBatch(trainDataset, idealDataset.functions, loss="mae")
+
+        rankings = rankIdealFunctions(list(trainDataset), idealDataset.functions, errors, 3)
+        for trainIndex, (idealFunction, ranking) in enumerate(zip(idealFunctions, rankings)):
+            expectedOrder = np.argsort(errors[trainIndex], kind="stable")[:3]
+            self.assertEqual(ranking[0].name, idealFunction.name)
+            self.assertEqual([function.name for function in ranking],
+                             [idealDataset.functions[index].name for index in expectedOrder])
+            self.assertEqual([function.error for function in ranking], list(errors[trainIndex, expectedOrder]))
+
+    def testLossRegistry(self):
+        """Tests the batch loss kernels against their pairwise definitions."""
+        trainDataset = CoreFunction('input-data/train.csv')
+        idealDataset = CoreFunction('input-data/ideal.csv')
+        trainFunction, candidateFunction = trainDataset.functions[0], idealDataset.functions[3]
+        distances = candidateFunction.yValues - trainFunction.yValues
+
+        expectedLosses = {
+            "sse": np.sum(distances ** 2),
+            "weighted_sse": np.sum(distances ** 2),
+            "mae": np.mean(np.abs(distances)),
+            "max_abs": np.max(np.abs(distances)),
+            "huber": np.sum(np.where(np.abs(distances) <= 1.0, 0.5 * distances ** 2, np.abs(distances) - 0.5)),
+        }
+        for name, expectedLoss in expectedLosses.items():
+            _, errors = minimiseLossBatch([trainFunction], idealDataset.functions, loss=name)
+            self.assertAlmostEqual(errors[0, 3], expectedLoss, places=6)
+
+        weights = np.zeros(len(distances))
+        weights[:10] = 2.0
+        _, errors = minimiseLossBatch([trainFunction], idealDataset.functions, loss="weighted_sse", lossOptions={"weights": weights})
+        self.assertAlmostEqual(errors[0, 3], 2.0 * np.sum(distances[:10] ** 2), places=6)
+
+    def testAbsoluteLossesInBlocks(self):
+        """Tests that the absolute distance losses give the same matrix when the ideal columns are split in blocks."""
+        trainDataset = CoreFunction('input-data/train.csv')
+        idealDataset = CoreFunction('input-data/ideal.csv')
+        expected = {name: minimiseLossBatch(trainDataset, idealDataset.functions, loss=name)[1] for name in ("mae", "max_abs", "huber")}
+
+        blockElements = calculations_worker.DISTANCE_BLOCK_ELEMENTS
+        calculations_worker.DISTANCE_BLOCK_ELEMENTS = 7 * len(trainDataset.values)
+        try:
+            for name, expectedErrors in expected.items():
+                np.testing.assert_allclose(minimiseLossBatch(trainDataset, idealDataset.functions, loss=name)[1], expectedErrors,
+                                           rtol=1e-12)
+        finally:
+            calculations_worker.DISTANCE_BLOCK_ELEMENTS = blockElements
+
+        with self.assertRaises(ValueError):
+            minimiseLossBatch(trainDataset, idealDataset.functions, loss="weighted_sse", lossOptions={"weights": np.ones(3)})
+
+    def testCustomPairwiseLoss(self):
+        """Tests that a loss without a batch kernel falls back to the pairwise loop."""
+        trainDataset = CoreFunction('input-data/train.csv')
+        idealDataset = CoreFunction('input-data/ideal.csv')
+        loss = registerLoss("test_pairwise_sse", pairwise=errorSquared)
+        try:
+            self.assertFalse(loss.vectorized)
+            idealFunctions, errors = minimiseLossBatch(trainDataset, idealDataset.functions, loss="test_pairwise_sse")
+            expectedFunctions, expectedErrors = minimiseLossBatch(trainDataset, idealDataset.functions)
+            self.assertEqual([function.name for function in idealFunctions], [function.name for function in expectedFunctions])
+            np.testing.assert_allclose(errors, expectedErrors, rtol=1e-6)
+        finally:
+            del LOSS_FUNCTIONS["test_pairwise_sse"]
+
+    def testMinimiseLossParallel(self):
+        """Tests that the sharded multi-process selection picks the same ideal functions as the serial one."""
+        trainDataset = CoreFunction('input-data/train.csv')
+        idealDataset = CoreFunction('input-data/ideal.csv')
+
+        expectedFunctions, _ = minimiseLossBatch(trainDataset, idealDataset.functions)
+        idealFunctions, errors = minimiseLossParallel(trainDataset, idealDataset.functions, workers=2)
+
+        self.assertEqual(errors.shape, (len(trainDataset.functions), len(idealDataset.functions)))
+        self.assertEqual([function.name for function in idealFunctions], [function.name for function in expectedFunctions])
+        self.assertEqual([function.error for function in idealFunctions], [function.error for function in expectedFunctions])
+
+    def testClassifyBatch(self):
+        """Tests that the batch classification matches findClassification point by point."""
+        trainDataset = CoreFunction('input-data/train.csv')
+        idealDataset = CoreFunction('input-data/ideal.csv')
+        testFunction = CoreFunction('input-data/test.csv').functions[0]
+        idealFunctions, _ = minimiseLossBatch(trainDataset, idealDataset.functions)
+        for idealFunction in idealFunctions:
+            idealFunction.toleranceFactor = 2 ** 0.5
+
+        xValues, yValues, idealIndexes, deltaY = classifyBatch(testFunction, idealFunctions).columns
+
+        self.assertEqual(len(xValues), len(testFunction.dataframe))
+        for index, point in enumerate(testFunction):
+            classification, distance = findClassification(point, idealFunctions)
+            if classification is None:
+                self.assertEqual(idealIndexes[index], -1)
+                self.assertTrue(math.isnan(deltaY[index]))
+            else:
+                self.assertIs(idealFunctions[idealIndexes[index]], classification)
+                self.assertEqual(deltaY[index], distance)
+
+    def testClassifyBatchParallel(self):
+        """Tests that the chunked parallel classification merges back to the batch result."""
+        trainDataset = CoreFunction('input-data/train.csv')
+        idealDataset = CoreFunction('input-data/ideal.csv')
+        testFunction = CoreFunction('input-data/test.csv').functions[0]
+        idealFunctions, _ = minimiseLossBatch(trainDataset, idealDataset.functions)
+
+        expected = classifyBatch(testFunction, idealFunctions)
+        for useProcesses in (False, True):
+            result = classifyBatchParallel(testFunction, idealFunctions, workers=2, chunkSize=16, useProcesses=useProcesses)
+            self.assertEqual(result.idealFunctions, expected.idealFunctions)
+            for expectedColumn, column in zip(expected.columns, result.columns):
+                np.testing.assert_array_equal(column, expectedColumn)
+
+    def testClassifyBatchChunks(self):
+        """Tests that the chunks of the pipelined classification join up to the batch result."""
+        trainDataset = CoreFunction('input-data/train.csv')
+        idealDataset = CoreFunction('input-data/ideal.csv')
+        testFunction = CoreFunction('input-data/test.csv').functions[0]
+        idealFunctions, _ = minimiseLossBatch(trainDataset, idealDataset.functions)
+
+        expected = classifyBatch(testFunction, idealFunctions)
+        for workers, useProcesses in ((1, False), (3, False), (3, True)):
+            chunks = list(classifyBatchChunks(testFunction, idealFunctions, chunkSize=16, workers=workers,
+                                              useProcesses=useProcesses))
+            self.assertEqual([len(chunk) for chunk in chunks], [16] * 6 + [4])
+            for expectedColumn, column in zip(expected.columns, MappingResult.concatenate(chunks).columns):
+                np.testing.assert_array_equal(column, expectedColumn)
+
+    def testToleranceBandIndex(self):
+        """Tests that the band index classifies like checking every ideal function."""
+        trainDataset = CoreFunction('input-data/train.csv')
+        idealDataset = CoreFunction('input-data/ideal.csv')
+        # Every ideal function twice, so that ties between overlapping bands are exercised too
+        idealFunctions = [IdealFunction(functionData=function, trainingFunction=trainDataset.functions[index % 4], error=0.0)
+                          for index, function in enumerate(idealDataset.functions * 2)]
+        for idealFunction in idealFunctions:
+            idealFunction.toleranceFactor = 2 ** 0.5
+
+        gridX = idealDataset.functions[0].xValues
+        generator = np.random.default_rng(0)
+        testFunction = Function.from_dataframe("y", pd.DataFrame(data={
+            "x": gridX[generator.integers(0, len(gridX), 2000)], "y": generator.normal(0, 20, 2000)}))
+
+        bandIndex = ToleranceBandIndex(idealFunctions)
+        expected = classifyBatch(testFunction, idealFunctions)
+        result = classifyBatch(testFunction, idealFunctions, bandIndex=bandIndex)
+        for expectedColumn, column in zip(expected.columns, result.columns):
+            np.testing.assert_array_equal(column, expectedColumn)
+
+        # The vectorized row searches agree with a binary search of every row
+        rows = bandIndex._locateGridRows(testFunction.xValues)
+        for side in ("left", "right"):
+            expectedPositions = [np.searchsorted(bandIndex.centers[row], y, side=side)
+                                 for row, y in zip(rows, testFunction.yValues)]
+            np.testing.assert_array_equal(bandIndex._searchRows(rows, testFunction.yValues, side), expectedPositions)
+
+        for point in list(testFunction)[:50]:
+            self.assertEqual(findClassification(point, idealFunctions, bandIndex=bandIndex),
+                             findClassification(point, idealFunctions))
+
+        with self.assertRaises(IndexError):
+            bandIndex.query(0.05, 0.0)
+
+    def testClassifyWithLookupPolicy(self):
+        """Tests that off-grid test points are classified with an interpolated lookup."""
+        trainDataset = CoreFunction('input-data/train.csv')
+        idealDataset = CoreFunction('input-data/ideal.csv')
+        testFunction = CoreFunction('input-data/test.csv').functions[0]
+        idealFunctions, _ = minimiseLossBatch(trainDataset, idealDataset.functions)
+        for idealFunction in idealFunctions:
+            idealFunction.toleranceFactor = 2 ** 0.5
+
+        # On the grid every policy gives the exact result
+        expected = classifyBatch(testFunction, idealFunctions)
+        np.testing.assert_array_equal(classifyBatch(testFunction, idealFunctions, lookup="linear").idealIndexes, expected.idealIndexes)
+
+        noisyFunction = Function.from_dataframe("y", pd.DataFrame(data={"x": testFunction.xValues + 1e-7,
+                                                                        "y": testFunction.yValues}))
+        with self.assertRaises(IndexError):
+            classifyBatch(noisyFunction, idealFunctions)
+        noisy = classifyBatch(noisyFunction, idealFunctions, lookup="nearest")
+        np.testing.assert_array_equal(noisy.idealIndexes, expected.idealIndexes)
+
+        linear = classifyBatch(noisyFunction, idealFunctions, lookup="linear")
+        for index, point in enumerate(list(noisyFunction)[:20]):
+            classification, distance = findClassification(point, idealFunctions, lookup="linear")
+            self.assertEqual(-1 if classification is None else idealFunctions.index(classification), linear.idealIndexes[index])
+
+        # Points just past the ends of the grid are on the nearest end point, or unclassified when interpolated
+        gridX = idealFunctions[0].xValues
+        edgeX = np.array([gridX.min() - 1e-9, gridX.max() + 1e-9, gridX.max() + 1.0])
+        edgeY = np.array([idealFunctions[0].locateYBasedOnX(gridX.min()), idealFunctions[0].locateYBasedOnX(gridX.max()), 0.0])
+        edgeFunction = Function.from_dataframe("y", pd.DataFrame(data={"x": edgeX, "y": edgeY}))
+        nearest = classifyBatch(edgeFunction, idealFunctions, lookup="nearest")
+        np.testing.assert_array_equal(nearest.idealIndexes[:2], [0, 0])
+        self.assertEqual(nearest.idealIndexes[2], -1)
+        with self.assertLogs(level="WARNING") as logs:
+            interpolated = classifyBatch(edgeFunction, idealFunctions, lookup="linear")
+        np.testing.assert_array_equal(interpolated.idealIndexes, [-1, -1, -1])
+        self.assertIn("3 test points are outside the x range", logs.output[0])
+        self.assertEqual(findClassification({"x": edgeX[1], "y": edgeY[1]}, idealFunctions, lookup="nearest")[0],
+                         idealFunctions[0])
+        self.assertEqual(findClassification({"x": edgeX[1], "y": edgeY[1]}, idealFunctions, lookup="cubic"), (None, None))
+
+    def testStreamingMatchesBatch(self):
+        """Tests that the chunked selection and classification match the in-memory ones."""
+        trainDataset = CoreFunction('input-data/train.csv')
+        idealDataset = CoreFunction('input-data/ideal.csv')
+        expectedFunctions, expectedErrors = minimiseLossBatch(trainDataset, idealDataset.functions)
+
+        idealFunctions, errors = minimiseLossStreaming('input-data/train.csv', 'input-data/ideal.csv', chunkSize=64)
+
+        self.assertEqual([function.name for function in idealFunctions], [function.name for function in expectedFunctions])
+        np.testing.assert_allclose(errors, expectedErrors, rtol=1e-9)
+        # The training data isn't loaded again, the largest deviations come from the streamed chunks
+        for idealFunction, expectedFunction in zip(idealFunctions, expectedFunctions):
+            self.assertEqual(idealFunction.training_function.name, expectedFunction.training_function.name)
+            self.assertEqual(len(idealFunction.training_function.yValues), 0)
+            self.assertAlmostEqual(idealFunction.largestDeviation, expectedFunction.largestDeviation, places=12)
+
+        expected = classifyBatch(CoreFunction('input-data/test.csv').functions[0], idealFunctions)
+        chunks = list(classifyChunks(CoreFunction.read_chunks('input-data/test.csv', 30), idealFunctions))
+        self.assertEqual(len(chunks), 4)
+        for expectedColumn, column in zip(expected.columns, MappingResult.concatenate(chunks).columns):
+            np.testing.assert_array_equal(column, expectedColumn)
+
 if __name__ == '__main__':
     unittest.main()
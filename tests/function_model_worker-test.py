@@ -0,0 +1,229 @@
+import unittest
+import numpy as np
+import pandas as pd
+import logging
+import tempfile
+from unittest import mock
+
+import sys
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from function_model_worker import CoreFunction, Function, IdealFunction, MappingResult, functionMatrix, \
+    precomputeLargestDeviations, openCatalog, locateYMatrix, sharesGrid, fileDigest, inputFingerprint
+
+logging.basicConfig(level=logging.DEBUG)
+
+class FunctionModelUnitTest(unittest.TestCase):
+    def setUp(self):
+        """Sets up dummy data for testing."""
+        # Unsorted and duplicated x values on purpose
+        data = {"x": [0.3, 0.1, 0.2, 0.1], "y": [3.0, 1.0, 2.0, 4.0]}
+        self.function = Function.from_dataframe("y1", pd.DataFrame(data=data))
+
+    def testLocateYBasedOnX(self):
+        """Tests the exact lookup of single and multiple x values."""
+        self.assertEqual(self.function.locateYBasedOnX(0.2), 2.0)
+        # The first row wins for duplicated x values
+        self.assertEqual(self.function.locateYBasedOnX(0.1), 1.0)
+        np.testing.assert_array_equal(self.function.locateYBasedOnX(np.array([0.3, 0.1, 0.2])), [3.0, 1.0, 2.0])
+
+        with self.assertRaises(IndexError):
+            self.function.locateYBasedOnX(0.25)
+
+    def testLocateYBasedOnXWithTolerance(self):
+        """Tests the lookup of x values with floating point noise."""
+        self.assertEqual(self.function.locateYBasedOnX(0.2 + 1e-12, tolerance=1e-9), 2.0)
+        with self.assertRaises(IndexError):
+            self.function.locateYBasedOnX(0.25, tolerance=1e-9)
+
+    def testInterpolateYBasedOnX(self):
+        """Tests the interpolated lookup of x values that are not on the grid."""
+        grid = np.linspace(0.0, 10.0, 101)
+        function = Function.from_dataframe("y1", pd.DataFrame(data={"x": grid, "y": np.sin(grid)}))
+        offGrid = np.array([0.0, 0.04, 3.33, 7.77, 10.0])
+
+        for method, precision in (("nearest", 0.06), ("linear", 2e-3), ("cubic", 1e-3)):
+            # Grid points return exactly the stored y values
+            np.testing.assert_array_equal(function.interpolateYBasedOnX(grid, method=method), np.sin(grid))
+            np.testing.assert_allclose(function.interpolateYBasedOnX(offGrid, method=method), np.sin(offGrid), atol=precision)
+
+        self.assertEqual(function.interpolateYBasedOnX(0.04, method="nearest"), np.sin(0.0))
+        with self.assertRaises(IndexError):
+            function.interpolateYBasedOnX(10.5)
+        # Nearest accepts half a grid step past the ends, out of range values can give NaN instead of raising
+        self.assertEqual(function.interpolateYBasedOnX(10.04, method="nearest"), np.sin(10.0))
+        np.testing.assert_array_equal(function.interpolateYBasedOnX(np.array([-0.1, 5.0, 10.06]), method="nearest", outOfRange="nan"),
+                                      [np.nan, np.sin(5.0), np.nan])
+        np.testing.assert_array_equal(function.interpolateYBasedOnX(np.array([5.0, 10.0 + 1e-9]), outOfRange="nan"),
+                                      [np.sin(5.0), np.nan])
+
+    def testLocateYMatrix(self):
+        """Tests that functions sharing a grid are looked up together, with the same values as one by one."""
+        idealDataset = CoreFunction('input-data/ideal.csv')
+        functions = idealDataset.functions[:5]
+        self.assertTrue(sharesGrid(functions))
+        x = np.concatenate([functions[0].xValues[::7], [-19.95, 0.01, 19.9]])
+
+        for method in ("nearest", "linear", "cubic"):
+            expected = np.column_stack([function.interpolateYBasedOnX(x, method=method) for function in functions])
+            np.testing.assert_allclose(locateYMatrix(functions, x, method), expected, rtol=1e-12, atol=1e-12)
+        onGrid = functions[0].xValues[::-3]
+        expected = np.column_stack([function.locateYBasedOnX(onGrid) for function in functions])
+        np.testing.assert_array_equal(locateYMatrix(functions, onGrid), expected)
+        with self.assertRaises(IndexError):
+            locateYMatrix(functions, x)
+
+        # A function on another grid is looked up on its own
+        mixedFunctions = [self.function, Function.from_dataframe("y2", pd.DataFrame(data={"x": [0.1, 0.2, 0.3], "y": [5.0, 6.0, 7.0]}))]
+        self.assertFalse(sharesGrid(mixedFunctions))
+        np.testing.assert_array_equal(locateYMatrix(mixedFunctions, np.array([0.3, 0.1])), [[3.0, 7.0], [1.0, 5.0]])
+
+    def testIndexIsRebuiltWhenDataframeChanges(self):
+        """Tests that replacing the data frame invalidates the cached x index."""
+        self.assertEqual(self.function.locateYBasedOnX(0.3), 3.0)
+        self.function.dataframe = pd.DataFrame(data={"x": [0.3], "y": [9.0]})
+        self.assertEqual(self.function.locateYBasedOnX(0.3), 9.0)
+
+    def testLargestDeviationIsCached(self):
+        """Tests the cached largest deviation and its invalidation."""
+        train = Function.from_dataframe("y1", pd.DataFrame(data={"x": [1.0, 2.0], "y": [1.0, 1.0]}))
+        ideal = Function.from_dataframe("y2", pd.DataFrame(data={"x": [1.0, 2.0], "y": [1.5, 3.0]}))
+        idealFunction = IdealFunction(functionData=ideal, trainingFunction=train, error=0.0)
+
+        self.assertEqual(idealFunction.largestDeviation, 2.0)
+        idealFunction.toleranceFactor = 2
+        self.assertEqual(idealFunction.tolerance, 4.0)
+
+        idealFunction.training_function = Function.from_dataframe("y3", pd.DataFrame(data={"x": [1.0, 2.0], "y": [1.5, 2.0]}))
+        self.assertEqual(idealFunction.largestDeviation, 1.0)
+
+        idealFunction.dataframe = pd.DataFrame(data={"x": [1.0, 2.0], "y": [1.5, 2.5]})
+        self.assertEqual(idealFunction.largestDeviation, 0.5)
+
+    def testPrecomputeLargestDeviations(self):
+        """Tests that the vectorized deviations match the per-function ones."""
+        train = Function.from_dataframe("y1", pd.DataFrame(data={"x": [1.0, 2.0], "y": [1.0, 1.0]}))
+        idealFunctions = [
+            IdealFunction(functionData=Function.from_dataframe("y2", pd.DataFrame(data={"x": [1.0, 2.0], "y": [1.5, 3.0]})),
+                          trainingFunction=train, error=0.0),
+            IdealFunction(functionData=Function.from_dataframe("y3", pd.DataFrame(data={"x": [1.0, 2.0], "y": [-2.0, 1.0]})),
+                          trainingFunction=train, error=0.0),
+        ]
+        expected = [idealFunction.determineLargestDeviation(idealFunction, train) for idealFunction in idealFunctions]
+
+        np.testing.assert_array_equal(precomputeLargestDeviations(idealFunctions), expected)
+        self.assertEqual([idealFunction.largestDeviation for idealFunction in idealFunctions], expected)
+
+    def testCoreFunctionSharesOneMatrix(self):
+        """Tests that the functions of a CoreFunction are views of its matrix."""
+        coreFunction = CoreFunction.from_dataframe(pd.DataFrame(data={"x": [1.0, 2.0], "y1": [3.0, 4.0], "y2": [5.0, 6.0]}))
+        first, second = coreFunction.functions
+
+        self.assertEqual(coreFunction.columns, ["x", "y1", "y2"])
+        self.assertTrue(np.shares_memory(first.yValues, coreFunction.values))
+        self.assertTrue(np.shares_memory(functionMatrix(coreFunction.functions), coreFunction.values))
+        self.assertEqual(second.locateYBasedOnX(2.0), 6.0)
+        self.assertEqual(list(second.dataframe["y"]), [5.0, 6.0])
+
+        idealFunction = IdealFunction(functionData=second, trainingFunction=first, error=0.0)
+        self.assertTrue(np.shares_memory(idealFunction.yValues, coreFunction.values))
+        self.assertEqual(idealFunction.largestDeviation, 2.0)
+
+    def testMappingResult(self):
+        """Tests the columns of a mapping result and its view in the dict form."""
+        idealFunctions = [Function("y7"), Function("y12")]
+        first = MappingResult(np.array([1.0, 2.0]), np.array([4.0, 5.0]), np.array([1, -1]), np.array([0.5, np.nan]),
+                              idealFunctions)
+        second = MappingResult(np.array([3.0]), np.array([6.0]), np.array([0]), np.array([0.25]), idealFunctions)
+
+        result = MappingResult.concatenate([first, second])
+
+        self.assertEqual(result.idealIndexes.dtype, np.int16)
+        self.assertEqual(len(result), 3)
+        self.assertEqual(result.idealNames, ["y7", "y12"])
+        self.assertEqual(list(result), [
+            {"point": {"x": 1.0, "y": 4.0}, "classification": idealFunctions[1], "delta_y": 0.5},
+            {"point": {"x": 2.0, "y": 5.0}, "classification": None, "delta_y": None},
+            {"point": {"x": 3.0, "y": 6.0}, "classification": idealFunctions[0], "delta_y": 0.25}])
+        self.assertEqual(len(MappingResult.concatenate([], idealFunctions)), 0)
+        with self.assertRaises(ValueError):
+            MappingResult(np.array([1.0]), np.array([4.0, 5.0]), np.array([0]), np.array([0.5]), idealFunctions)
+
+    def testBinaryCache(self):
+        """Tests that a cached CSV file is memory-mapped and refreshed when the file changes."""
+        with tempfile.TemporaryDirectory() as directory:
+            csvPath = os.path.join(directory, "ideal.csv")
+            cacheDir = os.path.join(directory, "cache")
+            pd.DataFrame(data={"x": [1.0, 2.0], "y1": [3.0, 4.0]}).to_csv(csvPath, index=False)
+
+            parsed = CoreFunction(csvPath, cache_dir=cacheDir)
+            cached = CoreFunction(csvPath, cache_dir=cacheDir)
+            self.assertIsInstance(cached.values, np.memmap)
+            self.assertEqual(cached.columns, parsed.columns)
+            np.testing.assert_array_equal(cached.values, parsed.values)
+            self.assertEqual(cached.functions[0].locateYBasedOnX(2.0), 4.0)
+
+            pd.DataFrame(data={"x": [1.0, 2.0], "y1": [3.0, 5.0]}).to_csv(csvPath, index=False)
+            os.utime(csvPath, ns=(0, 0))
+            del cached
+            refreshed = CoreFunction(csvPath, cache_dir=cacheDir)
+            self.assertEqual(refreshed.functions[0].locateYBasedOnX(2.0), 5.0)
+            self.assertEqual(len(os.listdir(cacheDir)), 2)
+
+    def testFunctionCatalog(self):
+        """Tests that a catalog is attached read-only with a shared x index and rewritten when the CSV file changes."""
+        with tempfile.TemporaryDirectory() as directory:
+            csvPath = os.path.join(directory, "ideal.csv")
+            catalogPath = os.path.join(directory, "ideal.catalog")
+            pd.DataFrame(data={"x": [0.2, 0.1, 0.3], "y1": [3.0, 4.0, 5.0], "y2": [6.0, 7.0, 8.0]}).to_csv(csvPath, index=False)
+
+            parsed = CoreFunction(csvPath)
+            catalog = openCatalog(csvPath, catalogPath)
+            self.assertEqual(catalog.columns, parsed.columns)
+            np.testing.assert_array_equal(catalog.values, parsed.values)
+            self.assertFalse(catalog.values.flags.writeable)
+            self.assertTrue(catalog.values.flags.f_contiguous)
+            self.assertIs(catalog.functions[0]._sortedXIndex()[0], catalog.functions[1]._sortedXIndex()[0])
+            np.testing.assert_array_equal(catalog.functions[1].locateYBasedOnX(np.array([0.1, 0.3])), [7.0, 8.0])
+
+            pd.DataFrame(data={"x": [0.1], "y1": [9.0]}).to_csv(csvPath, index=False)
+            refreshed = openCatalog(csvPath, catalogPath)
+            self.assertEqual(refreshed.columns, ["x", "y1"])
+            self.assertEqual(refreshed.functions[0].locateYBasedOnX(0.1), 9.0)
+            # The catalog attached before the rewrite keeps its data
+            self.assertEqual(catalog.functions[1].locateYBasedOnX(0.3), 8.0)
+            self.assertEqual(os.listdir(directory).count("ideal.catalog"), 1)
+
+            with open(catalogPath, "wb") as catalogFile:
+                catalogFile.write(b"not a catalog")
+            with self.assertRaises(ValueError):
+                CoreFunction.from_catalog(catalogPath)
+
+    def testCatalogDigestReused(self):
+        """Tests that an unchanged CSV file isn't hashed again and that its catalog digest feeds the fingerprint."""
+        with tempfile.TemporaryDirectory() as directory:
+            csvPath = os.path.join(directory, "ideal.csv")
+            catalogPath = os.path.join(directory, "ideal.catalog")
+            pd.DataFrame(data={"x": [0.1, 0.2], "y1": [3.0, 4.0]}).to_csv(csvPath, index=False)
+            digest = fileDigest(csvPath)
+
+            self.assertEqual(openCatalog(csvPath, catalogPath).source_fingerprint, digest)
+            with mock.patch("function_model_worker.fileDigest", wraps=fileDigest) as hashed, \
+                    mock.patch.object(CoreFunction, "write_catalog") as written:
+                catalog = openCatalog(csvPath, catalogPath)
+                self.assertEqual(hashed.call_count, 0)
+                self.assertEqual(inputFingerprint([csvPath], "sse", fileDigests={csvPath: catalog.source_fingerprint}),
+                                 inputFingerprint([csvPath], "sse"))
+                self.assertEqual(hashed.call_count, 1)
+
+                # A touched file with the same content is hashed, but the catalog is kept
+                os.utime(csvPath, ns=(0, 0))
+                self.assertEqual(openCatalog(csvPath, catalogPath).source_fingerprint, digest)
+                self.assertEqual(hashed.call_count, 2)
+                written.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+import sys
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from instrumentation_worker import Instrumentation
+
+
+class InstrumentationUnitTest(unittest.TestCase):
+    def testDisabledInstrumentationRecordsNothing(self):
+        """Tests that spans, counters and decorated functions record nothing while disabled."""
+        instrumentation = Instrumentation()
+
+        @instrumentation.instrumented()
+        def double(value):
+            return 2 * value
+
+        with instrumentation.span("stage", rows=10):
+            self.assertEqual(double(2), 4)
+        instrumentation.count("points", 5)
+
+        self.assertEqual(instrumentation.spans, {})
+        self.assertEqual(instrumentation.counters, {})
+
+    def testSpansAndCounters(self):
+        """Tests that spans aggregate calls and rows, and that counters add up."""
+        instrumentation = Instrumentation(enabled=True)
+
+        @instrumentation.instrumented(rows=lambda values: len(values))
+        def total(values):
+            return sum(values)
+
+        with instrumentation.span("stage") as stage:
+            total([1, 2, 3])
+            total([4])
+            stage.rows = 4
+        instrumentation.count("points", 3)
+        instrumentation.count("points")
+
+        report = instrumentation.report()
+        self.assertEqual(report["spans"]["total"]["calls"], 2)
+        self.assertEqual(report["spans"]["total"]["rows"], 4)
+        self.assertEqual(report["spans"]["stage"]["rows"], 4)
+        self.assertGreaterEqual(report["spans"]["stage"]["wall_s"], report["spans"]["total"]["wall_s"])
+        self.assertEqual(report["counters"], {"points": 4})
+
+    def testNestedMemoryPeaks(self):
+        """Tests that a span reports the memory peak of its nested spans."""
+        instrumentation = Instrumentation(enabled=True, traceMemory=True)
+        try:
+            with instrumentation.span("outer"):
+                with instrumentation.span("inner"):
+                    data = bytearray(4 * 1024 * 1024)
+                del data
+                with instrumentation.span("small"):
+                    pass
+        finally:
+            instrumentation.disable()
+
+        spans = instrumentation.report()["spans"]
+        self.assertGreaterEqual(spans["inner"]["peak_bytes"], 4 * 1024 * 1024)
+        self.assertGreaterEqual(spans["outer"]["peak_bytes"], spans["inner"]["peak_bytes"])
+        self.assertLess(spans["small"]["peak_bytes"], 1024 * 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import threading
+import unittest
+import logging
+
+import sys
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from logging_worker import RateLimitedLogger, startQueueLogging, stopQueueLogging
+
+
+class ReprCounter:
+    """Counts how often it is formatted into a message."""
+    calls = 0
+
+    def __repr__(self):
+        ReprCounter.calls += 1
+        return "counter"
+
+
+class ThreadRecorder:
+    """Records the thread it is formatted on."""
+    threads = []
+
+    def __repr__(self):
+        ThreadRecorder.threads.append(threading.current_thread())
+        return "recorder"
+
+
+class LoggingWorkerUnitTest(unittest.TestCase):
+    def testRateLimitedLogger(self):
+        """Tests that only the first message of an interval is formatted and the rest are counted."""
+        logger = logging.getLogger("logging_worker_test.rate_limited")
+        channel = RateLimitedLogger(logger, interval=3600)
+        ReprCounter.calls = 0
+
+        with self.assertLogs(logger, level="DEBUG") as captured:
+            for _ in range(5):
+                channel.debug("Invoking with %r", ReprCounter())
+            channel._nextEmit = 0.0
+            channel.debug("Invoking with %r", ReprCounter())
+
+        self.assertEqual(len(captured.records), 2)
+        self.assertEqual(captured.output[1], "DEBUG:logging_worker_test.rate_limited:Invoking with counter (4 similar messages suppressed)")
+        self.assertEqual(ReprCounter.calls, 2)
+
+        # Filtered out by the level, nothing is formatted or counted
+        logger.setLevel(logging.INFO)
+        try:
+            channel._nextEmit = 0.0
+            channel.debug("Invoking with %r", ReprCounter())
+        finally:
+            logger.setLevel(logging.NOTSET)
+        self.assertEqual(ReprCounter.calls, 2)
+        self.assertEqual(channel._suppressed, 0)
+
+    def testQueueLogging(self):
+        """Tests that records reach the handlers through the queue once the listener is stopped."""
+        logger = logging.getLogger("logging_worker_test.queue")
+        logger.propagate = False
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        listener = startQueueLogging([handler], level=logging.INFO, logger=logger)
+        try:
+            logger.info("mapped %d points", 3)
+            logger.debug("not emitted")
+        finally:
+            stopQueueLogging(listener)
+            stopQueueLogging(listener)
+            logger.handlers.clear()
+
+        self.assertEqual([record.getMessage() for record in records], ["mapped 3 points"])
+
+    def testQueueLoggingFormatsInBackground(self):
+        """Tests that the message of a queued record is formatted on the listener thread, not the logging one."""
+        logger = logging.getLogger("logging_worker_test.background")
+        logger.propagate = False
+        handler = logging.StreamHandler(open(os.devnull, "w"))
+        ThreadRecorder.threads = []
+        listener = startQueueLogging([handler], level=logging.INFO, logger=logger)
+        try:
+            logger.info("classified %r", ThreadRecorder())
+        finally:
+            stopQueueLogging(listener)
+            logger.handlers.clear()
+            handler.stream.close()
+
+        self.assertEqual(len(ThreadRecorder.threads), 1)
+        self.assertIsNot(ThreadRecorder.threads[0], threading.current_thread())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import glob
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import unittest
+
+import sys
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(SCRIPT_DIR)
+
+
+class MainUnitTest(unittest.TestCase):
+    def setUp(self):
+        """Copies the scripts and the input data to a scratch directory, so the runs don't touch output-data."""
+        self.directory = tempfile.TemporaryDirectory()
+        for path in glob.glob(os.path.join(REPOSITORY_DIR, "*.py")):
+            shutil.copy(path, self.directory.name)
+        shutil.copytree(os.path.join(REPOSITORY_DIR, "input-data"), os.path.join(self.directory.name, "input-data"))
+        os.makedirs(os.path.join(self.directory.name, "output-data"))
+        self.databasePath = os.path.join(self.directory.name, "output-data", "solution.db")
+
+    def tearDown(self):
+        """Removes the scratch directory."""
+        self.directory.cleanup()
+
+    def runMain(self, *options, input=None):
+        """Runs main.py in the scratch directory and returns its standard output."""
+        completed = subprocess.run([sys.executable, "main.py", "--no-plots", *options], cwd=self.directory.name,
+                                   input=input, capture_output=True, check=True, timeout=300)
+        return completed.stdout
+
+    def fetchTables(self):
+        """Returns the rows of every table of solution.db by table name."""
+        with sqlite3.connect(self.databasePath) as connection:
+            tables = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            return {table: connection.execute(f'SELECT * FROM "{table}"').fetchall() for table in tables}
+
+    def testServingLeavesDatabaseUnchanged(self):
+        """Tests that the service answers points without rewriting the tables or clearing the mapping."""
+        self.runMain()
+        before = self.fetchTables()
+        self.assertEqual(len(before["mappingData"]), 100)
+
+        output = self.runMain("--serve", "stdio", input=b"0.1,0.73\n")
+
+        self.assertEqual(len(output.splitlines()), 1)
+        self.assertEqual(self.fetchTables(), before)
+
+    def testRepeatedTestPoints(self):
+        """Tests that every test row is mapped once, in incremental and full runs, with a repeated point appended."""
+        self.runMain("--incremental")
+        testCsvPath = os.path.join(self.directory.name, "input-data", "test.csv")
+        with open(testCsvPath) as testCsv:
+            firstPoint = testCsv.read().splitlines()[1]
+        with open(testCsvPath, "a") as testCsv:
+            testCsv.write(firstPoint + "\n")
+
+        output = self.runMain("--incremental")
+        self.assertIn(b"Classifying 1 of 101 test points", output)
+        self.assertEqual(len(self.fetchTables()["mappingData"]), 101)
+
+        # A full run maps every row again, without the rows of the earlier runs
+        output = self.runMain()
+        self.assertNotIn(b"rows failed", output)
+        self.assertEqual(len(self.fetchTables()["mappingData"]), 101)
+
+        # A different lookup policy invalidates the stored mapping
+        output = self.runMain("--incremental", "--lookup", "nearest")
+        self.assertIn(b"Classifying 101 of 101 test points", output)
+        self.assertEqual(len(self.fetchTables()["mappingData"]), 101)
+
+
+    def testChangedTestPoints(self):
+        """Tests that an incremental run replaces the mapping of a changed test row instead of keeping it."""
+        self.runMain("--incremental")
+        testCsvPath = os.path.join(self.directory.name, "input-data", "test.csv")
+        with open(testCsvPath) as testCsv:
+            lines = testCsv.read().splitlines()
+        oldX, oldY = (float(value) for value in lines[1].split(","))
+        lines[1] = f"{oldX},{oldY + 0.5}"
+        lines.append(lines[2])
+        with open(testCsvPath, "w") as testCsv:
+            testCsv.write("\n".join(lines) + "\n")
+
+        output = self.runMain("--incremental")
+        self.assertIn(b"Removed the mapping of 1 test points", output)
+        self.assertIn(b"Classifying 2 of 101 test points", output)
+        mappedPoints = [row[:2] for row in self.fetchTables()["mappingData"]]
+        self.assertEqual(len(mappedPoints), 101)
+        self.assertNotIn((oldX, oldY), mappedPoints)
+        self.assertIn((oldX, oldY + 0.5), mappedPoints)
+
+    def testWeightedLoss(self):
+        """Tests that the weighted_sse loss reads its weights, and that equal weights select like sse."""
+        weightsPath = os.path.join(self.directory.name, "input-data", "weights.csv")
+        with open(os.path.join(self.directory.name, "input-data", "train.csv")) as trainCsv:
+            rowCount = len(trainCsv.read().splitlines()) - 1
+        with open(weightsPath, "w") as weightsCsv:
+            weightsCsv.write("weight\n" + "2.0\n" * rowCount)
+
+        self.runMain()
+        expected = [row[1:3] for row in self.fetchTables()["selectionState"]]
+        self.runMain("--loss", "weighted_sse", "--weights", weightsPath)
+        self.assertEqual([row[1:3] for row in self.fetchTables()["selectionState"]], expected)
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.runMain("--loss", "weighted_sse")
+
+if __name__ == '__main__':
+    unittest.main()
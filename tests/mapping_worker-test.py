@@ -0,0 +1,102 @@
+import unittest
+import numpy as np
+import sqlite3
+import tempfile
+import logging
+
+import sys
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from function_model_worker import Function, IdealFunction, MappingResult
+from mapping_worker import writeClassificationToSqlite, insert_mapped_rows, getDatabaseEngine, unmappedPointsMask, \
+    removeStaleMappedRows,     writeSelectionState, readSelectionState, writeFunctionTable, DataSaveError
+
+logging.basicConfig(level=logging.DEBUG)
+
+class MappingWorkerUnitTest(unittest.TestCase):
+    def setUp(self):
+        """Creates a temporary database for every test."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.databasePath = os.path.join(self.directory.name, "solution.db")
+
+    def tearDown(self):
+        """Removes the temporary database."""
+        getDatabaseEngine(self.databasePath).dispose()
+        self.directory.cleanup()
+
+    def fetchRows(self):
+        """Returns all rows of the mapping table."""
+        with sqlite3.connect(self.databasePath) as connection:
+            return connection.execute('SELECT * FROM mappingData').fetchall()
+
+    def testWriteClassificationToSqlite(self):
+        """Tests that a mapping result is written with names and dashes."""
+        idealFunctions = [Function("y7"), Function("y12")]
+        result = MappingResult(np.array([1.0, 2.0, 3.0]), np.array([4.0, 5.0, 6.0]),
+                               np.array([1, -1, 0]), np.array([0.5, np.nan, 0.25]), idealFunctions)
+
+        self.assertEqual(writeClassificationToSqlite(result, databasePath=self.databasePath), (3, 0))
+        self.assertEqual(self.fetchRows(), [(1.0, 4.0, 0.5, "Y12"), (2.0, 5.0, -1.0, "-"), (3.0, 6.0, 0.25, "Y7")])
+
+    def testFailedRowsAreSkipped(self):
+        """Tests that a faulty row doesn't prevent the rest of its chunk from being written."""
+        rows = [(1.0, 2.0, 3.0, "Y1"), (1.0, [2.0], 3.0, "Y1"), (5.0, 6.0, 7.0, "Y2")]
+
+        self.assertEqual(insert_mapped_rows(getDatabaseEngine(self.databasePath), rows, chunkSize=2), (2, 1))
+        self.assertEqual(self.fetchRows(), [(1.0, 2.0, 3.0, "Y1"), (5.0, 6.0, 7.0, "Y2")])
+
+    def testRepeatedPointsAreMappedOncePerRow(self):
+        """Tests that repeated test points get one row each and that the mask counts how often a point is mapped."""
+        dbEngine = getDatabaseEngine(self.databasePath)
+        self.assertEqual(insert_mapped_rows(dbEngine, [(1.0, 2.0, 3.0, "Y1"), (1.0, 2.0, 3.0, "Y1"), (5.0, 6.0, 7.0, "Y2")]),
+                         (3, 0))
+        self.assertEqual(len(self.fetchRows()), 3)
+
+        xValues = np.array([1.0, 5.0, 1.0, 1.0, 5.0, 8.0])
+        yValues = np.array([2.0, 6.0, 2.0, 2.0, 6.0, 9.0])
+        np.testing.assert_array_equal(unmappedPointsMask(xValues, yValues, databasePath=self.databasePath),
+                                      [False, False, False, True, True, True])
+
+    def testRemoveStaleMappedRows(self):
+        """Tests that the rows of points no longer in the test data, or mapped too often, are removed, newest first."""
+        dbEngine = getDatabaseEngine(self.databasePath)
+        insert_mapped_rows(dbEngine, [(1.0, 2.0, 3.0, "Y1"), (5.0, 6.0, 7.0, "Y2"), (1.0, 2.0, 4.0, "Y3"), (8.0, 9.0, 0.5, "Y4")])
+
+        xValues = np.array([1.0, 8.0, 3.0])
+        yValues = np.array([2.0, 9.0, 4.0])
+        self.assertEqual(removeStaleMappedRows(xValues, yValues, databasePath=self.databasePath), 2)
+        self.assertEqual(sorted(self.fetchRows()), [(1.0, 2.0, 3.0, "Y1"), (8.0, 9.0, 0.5, "Y4")])
+        np.testing.assert_array_equal(unmappedPointsMask(xValues, yValues, databasePath=self.databasePath),
+                                      [False, False, True])
+        self.assertEqual(removeStaleMappedRows(xValues, yValues, databasePath=self.databasePath), 0)
+
+    def testSelectionStateRoundTrip(self):
+        """Tests that the stored selection is read back in order with its fingerprint."""
+        self.assertIsNone(readSelectionState(self.databasePath))
+        train = Function.from_matrix("y1", np.array([[0.0, 1.0], [1.0, 2.0]]), 1)
+        idealFunctions = [IdealFunction(Function.from_matrix(name, np.array([[0.0, 1.5], [1.0, 2.0]]), 1), train, error)
+                          for name, error in (("y9", 0.25), ("y3", 0.5))]
+
+        writeSelectionState("abc", idealFunctions, databasePath=self.databasePath)
+        writeSelectionState("def", idealFunctions, databasePath=self.databasePath)
+        self.assertEqual(readSelectionState(self.databasePath), ("def", [("y1", "y9", 0.25), ("y1", "y3", 0.5)]))
+
+    def testWriteFunctionTable(self):
+        """Tests that function tables are replaced, appended to and indexed on x, with NaN stored as NULL."""
+        columns = ["X (ideal function)", "Y1 (ideal function)"]
+        writeFunctionTable("ideal", columns, np.array([[9.0, 9.0]]), databasePath=self.databasePath)
+        writeFunctionTable("ideal", columns, np.array([[1.0, 2.0], [3.0, np.nan]]), databasePath=self.databasePath, chunkSize=1)
+        writeFunctionTable("ideal", columns, np.array([[5.0, 6.0]]), ifExists="append", databasePath=self.databasePath)
+        with self.assertRaises(DataSaveError):
+            writeFunctionTable("ideal", columns, np.array([[7.0, 8.0]]), ifExists="fail", databasePath=self.databasePath)
+
+        with sqlite3.connect(self.databasePath) as connection:
+            self.assertEqual(connection.execute('SELECT * FROM ideal').fetchall(), [(1.0, 2.0), (3.0, None), (5.0, 6.0)])
+            self.assertEqual(connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall(),
+                             [("ix_ideal_X (ideal function)",)])
+
+if __name__ == '__main__':
+    unittest.main()
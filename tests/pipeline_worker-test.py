@@ -0,0 +1,56 @@
+import threading
+import unittest
+
+import sys
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from pipeline_worker import PipelineStage
+
+
+class PipelineWorkerUnitTest(unittest.TestCase):
+    def testCallsRunInOrderWithBoundedQueue(self):
+        """Tests that the calls run in order and that a full stage blocks the caller."""
+        stage = PipelineStage("test", maxPending=2)
+        release = threading.Event()
+        calls = []
+        stage.submit(release.wait)
+        stage.submit(calls.append, 1)
+
+        blocked = threading.Thread(target=stage.submit, args=(calls.append, 2))
+        blocked.start()
+        blocked.join(timeout=0.2)
+        self.assertTrue(blocked.is_alive())
+
+        release.set()
+        blocked.join()
+        stage.wait()
+        self.assertEqual(calls, [1, 2])
+
+    def testFailureSkipsLaterCalls(self):
+        """Tests that the first error is raised and the calls queued after it are skipped."""
+        stage = PipelineStage("test")
+        calls = []
+        stage.submit(calls.append, 1)
+        stage.submit(int, "not a number")
+        stage.submit(calls.append, 2)
+
+        with self.assertRaises(ValueError):
+            stage.drain()
+        with self.assertRaises(ValueError):
+            stage.submit(calls.append, 3)
+        with self.assertRaises(ValueError):
+            stage.wait()
+        self.assertEqual(calls, [1])
+
+    def testDisabledStage(self):
+        """Tests that a disabled stage ignores its calls."""
+        stage = PipelineStage("test", enabled=False)
+        self.assertIsNone(stage.submit(int, "not a number"))
+        stage.wait()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import asyncio
+import io
+import json
+import socket
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+
+import sys
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from function_model_worker import Function, IdealFunction
+import service_worker
+from service_worker import ClassificationService, parseAddress, serveSocket, serveStdio
+
+
+class ServiceWorkerUnitTest(unittest.TestCase):
+    def setUp(self):
+        """Creates two ideal functions with a tolerance of 1 on the grid x = 0, 1, 2."""
+        train = Function.from_matrix("y1", np.array([[0.0, 0.5], [1.0, 1.0], [2.0, 2.0]]), 1)
+        self.idealFunctions = [IdealFunction(Function.from_matrix(name, np.column_stack([[0.0, 1.0, 2.0], values]), 1), train, 0.0)
+                               for name, values in (("y3", [1.0, 1.0, 2.0]), ("y7", [10.0, 10.0, 10.0]))]
+        for idealFunction in self.idealFunctions:
+            idealFunction.toleranceFactor = 2.0
+
+    def serve(self, data, chunkSize=7):
+        """Feeds the data to a service in small chunks and returns its output."""
+        service = ClassificationService(self.idealFunctions, batchSize=2, maxPendingChunks=1)
+        chunks = [data[start:start + chunkSize] for start in range(0, len(data), chunkSize)] + [b""]
+        output = []
+
+        async def readChunk():
+            return chunks.pop(0)
+
+        async def write(answer):
+            output.append(answer)
+
+        asyncio.run(service.serveStream(readChunk, write))
+        return b"".join(output).decode().splitlines(), service
+
+    def testAnswersInInputOrder(self):
+        """Tests that JSON and CSV points are answered in order, with errors on their own lines."""
+        data = b'{"x": 1, "y": 1.5, "id": "a"}\n2,10.5\n\n{"x": 0.5, "y": 1}\n2,50\nnot a point\n{"x": 0, "y": 1'
+        lines, service = self.serve(data)
+
+        self.assertEqual(json.loads(lines[0]), {"id": "a", "x": 1.0, "y": 1.5, "ideal": "y3", "delta_y": 0.5})
+        self.assertEqual(lines[1], "2.0,10.5,0.5,Y7")
+        self.assertEqual(json.loads(lines[2])["error"], "Y value not found for given X value.")
+        self.assertEqual(lines[3], "2.0,50.0,-1,-")
+        self.assertTrue(lines[4].startswith("error,Invalid point not a point"))
+        self.assertIn("error", json.loads(lines[5]))
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(service.pointsServed, 6)
+
+    def testNonFinitePoints(self):
+        """Tests that infinite and NaN values are answered with an error, every answer being valid JSON."""
+        data = b'{"x": 1, "y": NaN, "id": 1}\n{"x": 1e400, "y": 1}\n{"x": 1, "y": -Infinity}\nnan,1\n'
+        lines, _ = self.serve(data)
+
+        self.assertEqual(len(lines), 4)
+        for line in lines[:3]:
+            self.assertIn("finite", json.loads(line, parse_constant=self.fail)["error"])
+        self.assertTrue(lines[3].startswith("error,Invalid point nan,1"))
+
+    def testServeStdio(self):
+        """Tests that points read from a binary stream are answered on another one."""
+        service = ClassificationService(self.idealFunctions)
+        output = io.BytesIO()
+
+        asyncio.run(serveStdio(service, io.BytesIO(b"0,1.2\n1,9.5\n"), output))
+
+        self.assertEqual(output.getvalue().decode().splitlines(), ["0.0,1.2,0.19999999999999996,Y3", "1.0,9.5,0.5,Y7"])
+
+    def testInvalidPointInBatch(self):
+        """Tests that a point off the grid fails alone, while the rest of its batch is classified at once."""
+        service = ClassificationService(self.idealFunctions)
+        requests = [("csv", x, y, None) for x, y in ((0.0, 1.5), (0.5, 1.0), (2.0, 10.5), (1.0, 50.0))]
+
+        with mock.patch("service_worker.classifyPoints", wraps=service_worker.classifyPoints) as classifyPoints:
+            lines = service.answer(requests).decode().splitlines()
+
+        self.assertEqual(lines, ["0.0,1.5,0.5,Y3", "error,Y value not found for given X value.", "2.0,10.5,0.5,Y7",
+                                 "1.0,50.0,-1,-"])
+        # The whole batch, then the points that can be looked up
+        self.assertEqual(classifyPoints.call_count, 2)
+        np.testing.assert_array_equal(classifyPoints.call_args[0][0], [0.0, 2.0, 1.0])
+
+    def testUnixSocketPath(self):
+        """Tests that a stale socket at the path of a unix address is replaced, but a regular file is kept."""
+        service = ClassificationService(self.idealFunctions)
+
+        async def serveOnce(path):
+            ready = asyncio.Event()
+            server = asyncio.ensure_future(serveSocket(service, "unix", (path,), ready))
+            await asyncio.wait([server, asyncio.ensure_future(ready.wait())], return_when=asyncio.FIRST_COMPLETED)
+            server.cancel()
+            try:
+                await server
+            except asyncio.CancelledError:
+                pass
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "service.sock")
+            staleSocket = socket.socket(socket.AF_UNIX)
+            staleSocket.bind(path)
+            staleSocket.close()
+            asyncio.run(serveOnce(path))
+
+            path = os.path.join(directory, "data.csv")
+            with open(path, "w") as dataFile:
+                dataFile.write("x,y\n")
+            with self.assertRaises(OSError):
+                asyncio.run(serveOnce(path))
+            with open(path) as dataFile:
+                self.assertEqual(dataFile.read(), "x,y\n")
+
+    def testParseAddress(self):
+        """Tests the service addresses."""
+        self.assertEqual(parseAddress("stdio"), ("stdio", ()))
+        self.assertEqual(parseAddress("unix:/tmp/mapping.sock"), ("unix", ("/tmp/mapping.sock",)))
+        self.assertEqual(parseAddress("tcp:127.0.0.1:8000"), ("tcp", ("127.0.0.1", 8000)))
+        with self.assertRaises(ValueError):
+            parseAddress("tcp:8000")
+
+
+if __name__ == '__main__':
+    unittest.main()
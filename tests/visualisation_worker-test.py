@@ -0,0 +1,103 @@
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+
+import sys
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from calculations_worker import classifyBatch, minimiseLossBatch
+from function_model_worker import CoreFunction, MappingResult
+from visualisation_worker import BackgroundPlotter, createPlottingPointBasedOnIdealFunction, decimateLine, \
+    plotIdealFunctions, plotClassificationsByIdealFunction
+
+
+class VisualisationWorkerUnitTest(unittest.TestCase):
+    def testDecimateLine(self):
+        """Tests that a decimated line keeps the extremes and ends of every bucket, in x order."""
+        xValues = np.linspace(0.0, 1.0, 10001)[::-1]
+        yValues = np.sin(xValues * 200)
+        yValues[1234] = 5.0
+
+        lineX, lineY = decimateLine(xValues, yValues, buckets=100)
+
+        self.assertLessEqual(len(lineX), 400)
+        self.assertTrue(np.all(np.diff(lineX) > 0))
+        self.assertEqual((lineX[0], lineX[-1]), (0.0, 1.0))
+        self.assertEqual(lineY.max(), 5.0)
+        self.assertEqual(lineY.min(), yValues.min())
+        np.testing.assert_array_equal(np.sin(lineX[lineY != 5.0] * 200), lineY[lineY != 5.0])
+
+    def testHeadlessExport(self):
+        """Tests that the plots are saved in the background without a browser and leave the ideal functions unchanged."""
+        trainDataset = CoreFunction('input-data/train.csv')
+        idealDataset = CoreFunction('input-data/ideal.csv')
+        idealFunctions, _ = minimiseLossBatch(trainDataset, idealDataset.functions)
+        result = classifyBatch(CoreFunction('input-data/test.csv').functions[0], idealFunctions)
+        dataframes = [idealFunction.dataframe.copy() for idealFunction in idealFunctions]
+        yValues = [idealFunction.yValues.copy() for idealFunction in idealFunctions]
+
+        with tempfile.TemporaryDirectory() as directory, mock.patch("visualisation_worker.view") as view:
+            plotter = BackgroundPlotter()
+            plotter.submit(plotIdealFunctions, idealFunctions, "ideal", directory)
+            plotter.submit(createPlottingPointBasedOnIdealFunction, result, "test", directory)
+            plotter.wait()
+
+            self.assertEqual(sorted(os.listdir(directory)), ["ideal.html", "test.html"])
+            for fileName in ("ideal.html", "test.html"):
+                with open(os.path.join(directory, fileName)) as htmlFile:
+                    self.assertIn("<html", htmlFile.read())
+            view.assert_not_called()
+
+        for idealFunction, dataframe, values in zip(idealFunctions, dataframes, yValues):
+            self.assertTrue(idealFunction.dataframe.equals(dataframe))
+            np.testing.assert_array_equal(idealFunction.yValues, values)
+
+    def testOpenBrowser(self):
+        """Tests that a saved plot is only opened in a browser on request."""
+        trainDataset = CoreFunction('input-data/train.csv')
+        idealFunctions, _ = minimiseLossBatch(trainDataset, CoreFunction('input-data/ideal.csv').functions)
+
+        with tempfile.TemporaryDirectory() as directory, mock.patch("visualisation_worker.view") as view:
+            plotIdealFunctions(idealFunctions, "ideal", directory, openBrowser=True)
+            view.assert_called_once_with(os.path.join(directory, "ideal.html"))
+
+    def testShortLinesAreKept(self):
+        """Tests that a line with few points is only sorted."""
+        lineX, lineY = decimateLine(np.array([2.0, 1.0, 3.0]), np.array([4.0, 5.0, 6.0]), buckets=10)
+
+        np.testing.assert_array_equal(lineX, [1.0, 2.0, 3.0])
+        np.testing.assert_array_equal(lineY, [5.0, 4.0, 6.0])
+
+
+    def testConstantXLineIsKept(self):
+        """Tests that a line whose points all share one x value is returned unchanged."""
+        lineX, lineY = decimateLine(np.full(100, 2.0), np.arange(100.0), buckets=10)
+
+        np.testing.assert_array_equal(lineX, np.full(100, 2.0))
+        np.testing.assert_array_equal(lineY, np.arange(100.0))
+
+    def testRepeatedIdealFunctionIsPlottedOnce(self):
+        """Tests that an ideal function chosen for two training functions gets one figure with all its points."""
+        trainDataset = CoreFunction('input-data/train.csv')
+        idealFunctions, _ = minimiseLossBatch(trainDataset, CoreFunction('input-data/ideal.csv').functions)
+        idealFunctions = [idealFunctions[0], idealFunctions[0], idealFunctions[1]]
+        result = MappingResult(np.array([0.0, 1.0, 2.0, 3.0]), np.array([1.0, 2.0, 3.0, 4.0]),
+                               np.array([0, 1, 2, -1], dtype=np.int16), np.array([0.1, 0.2, 0.3, np.nan]),
+                               idealFunctions)
+
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch("visualisation_worker.gridplot") as gridplot, mock.patch("visualisation_worker.saveLayout"):
+            plotClassificationsByIdealFunction(result, "test", directory)
+
+        figures = [graphPlot for row in gridplot.call_args[0][0] for graphPlot in row]
+        self.assertEqual([graphPlot.title.text for graphPlot in figures],
+                         [f"Ideal function {idealFunctions[0].name} with 2 test points",
+                          f"Ideal function {idealFunctions[2].name} with 1 test points"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,26 +1,41 @@
-from bokeh.plotting import figure, output_file, show
+import os
+import numpy as np
+from bokeh.io import save
+from bokeh.plotting import figure
 from bokeh.layouts import gridplot
 from bokeh.models import Band, ColumnDataSource
 from bokeh.palettes import Category10_5, Colorblind5
+from bokeh.resources import CDN
+from bokeh.util.browser import view
+from instrumentation_worker import instrumented
+from pipeline_worker import PipelineStage
 
-def plotIdealFunctions(idealFunctions, fileName):
+# Number of x buckets the ideal function lines are reduced to, about one per horizontal pixel of a figure
+LINE_BUCKETS = 800
+
+# Largest number of test points drawn in one figure of the aggregated plot
+MAX_POINTS_PER_FIGURE = 20000
+
+@instrumented()
+def plotIdealFunctions(idealFunctions, fileName, outputDirectory="output-data", openBrowser=False):
     """
-    Generates and displays two graphs per row based on the provided `idealFunctions`.
+    Generates two graphs per row based on the provided `idealFunctions` and saves them in an HTML file.
 
     Args:
-        idealFunctions (list): A list of `IdealFunction` objects.
+        idealFunctions (list): A list of `IdealFunction` objects, which is left unchanged.
         fileName (str): The name of the output HTML file to generate.
+        outputDirectory (str): The directory of the output HTML file.
+        openBrowser (bool): Whether to open the HTML file in a browser once it is saved.
 
     Returns:
         None.
     """
-    idealFunctions.sort(key=lambda ideal_function: ideal_function.training_function.name, reverse=False)
+    idealFunctions = sorted(idealFunctions, key=lambda ideal_function: ideal_function.training_function.name)
     graphPlots = []
     for idealFunction in idealFunctions:
         graphData = createGraphFromTwoFunctions(lineFunction=idealFunction, scatterFunction=idealFunction.training_function,
                                                 squaredError=idealFunction.error)
         graphPlots.append(graphData)
-    output_file("output-data/{}.html".format(fileName), title="Training functions VS Best ideal functions")
     n = len(graphPlots)
     plots = []
     row = []
@@ -31,26 +46,29 @@ def plotIdealFunctions(idealFunctions, fileName):
         row.append(graphPlots[i])
     plots.append(row)
     gridLayout = gridplot(plots, toolbar_location=None, sizing_mode='stretch_width')
-    show(gridLayout)
+    saveLayout(gridLayout, outputDirectory, fileName, "Training functions VS Best ideal functions", openBrowser)
 
 
 
-def createPlottingPointBasedOnIdealFunction(classificationPoints, fileName):
+@instrumented()
+def createPlottingPointBasedOnIdealFunction(result, fileName, outputDirectory="output-data", openBrowser=False):
     """
-    Creates plotting points based on ideal functions and saves in an HTML file.
+    Creates one figure per classified test point with its ideal function and saves them in an HTML file.
 
     Parameters:
-    classificationPoints (list): A list of dictionaries containing the points and their classifications.
+    result (MappingResult): The classified test points, as returned by classifyBatch.
     fileName (str): The name of the output file.
+    outputDirectory (str): The directory of the output file.
+    openBrowser (bool): Whether to open the HTML file in a browser once it is saved.
 
     Returns:
     None
     """
     graphPlots = []
-    for index, item in enumerate(classificationPoints):
-        if item["classification"] is not None:
-            p = classificationGraphPlot(item["point"], item["classification"])
-            graphPlots.append(p)
+    for position in np.flatnonzero(result.idealIndexes >= 0):
+        point = {"x": float(result.xValues[position]), "y": float(result.yValues[position])}
+        p = classificationGraphPlot(point, result.idealFunctions[result.idealIndexes[position]])
+        graphPlots.append(p)
 
     # Create grid layout with four columns
     plotsPerRow = 4
@@ -64,9 +82,139 @@ def createPlottingPointBasedOnIdealFunction(classificationPoints, fileName):
                 row.append(graphPlots[idx])
         grid.append(row)
 
-    # Create output file and show grid of plots with updated title
-    output_file(f"output-data/{fileName}.html", title='Test points VS Ideal functions')
-    show(gridplot(grid))
+    # Save the grid of plots with updated title
+    saveLayout(gridplot(grid), outputDirectory, fileName, 'Test points VS Ideal functions', openBrowser)
+
+@instrumented()
+def plotClassificationsByIdealFunction(result, fileName, outputDirectory="output-data", lineBuckets=LINE_BUCKETS,
+                                       maxPoints=MAX_POINTS_PER_FIGURE, openBrowser=False):
+    """
+    Creates one figure per ideal function with all test points assigned to it and saves them in an HTML file.
+    Unlike createPlottingPointBasedOnIdealFunction, the size of the output doesn't grow with the number of points:
+    the ideal function lines are decimated to `lineBuckets` x buckets and every figure draws at most `maxPoints`
+    points, evenly spread over the assigned points.
+
+    Parameters:
+    result (MappingResult): The classified test points, as returned by classifyBatch.
+    fileName (str): The name of the output file.
+    outputDirectory (str): The directory of the output file.
+    lineBuckets (int): The number of x buckets of the decimated lines.
+    maxPoints (int): The largest number of points drawn per figure.
+    openBrowser (bool): Whether to open the HTML file in a browser once it is saved.
+
+    Returns:
+    None
+    """
+    xValues, yValues, idealIndexes, deltaY = result.columns
+
+    # The same ideal function can be chosen for several training functions; it gets a single figure with the
+    # points assigned to any of them, and the widest of their tolerance bands
+    indexesByName = {}
+    for index, idealFunction in enumerate(result.idealFunctions):
+        indexesByName.setdefault(idealFunction.name, []).append(index)
+
+    graphPlots = []
+    for indexes in indexesByName.values():
+        idealFunction = result.idealFunctions[indexes[0]]
+        lineX, lineY = decimateLine(idealFunction.xValues, idealFunction.yValues, lineBuckets)
+        tolerance = max(result.idealFunctions[index].tolerance for index in indexes)
+        # The line and the tolerance band are drawn from the same source
+        lineSource = ColumnDataSource({"x": lineX, "y": lineY, "lower": lineY - tolerance, "upper": lineY + tolerance})
+
+        assigned = np.flatnonzero(np.isin(idealIndexes, indexes))
+        shown = assigned
+        if len(assigned) > maxPoints:
+            shown = assigned[np.linspace(0, len(assigned) - 1, maxPoints).astype(np.intp)]
+        pointSource = ColumnDataSource({"x": xValues[shown], "y": yValues[shown], "delta_y": deltaY[shown]})
+
+        title = f"Ideal function {idealFunction.name} with {len(assigned)} test points"
+        if len(shown) < len(assigned):
+            title += f" ({len(shown)} shown)"
+        graphPlot = figure(title=title, x_axis_label="x", y_axis_label="y", output_backend="webgl")
+        band = Band(base="x", lower="lower", upper="upper", source=lineSource, level="underlay",
+                    fill_alpha=0.5, line_width=4, line_color=Colorblind5[2], fill_color=Colorblind5[2])
+        graphPlot.add_layout(band)
+        graphPlot.line("x", "y", source=lineSource, legend_label="Best Ideal function", line_width=2,
+                       line_color=Colorblind5[0])
+        graphPlot.scatter("x", "y", source=pointSource, fill_color=Category10_5[3], line_color=None,
+                          legend_label="Test data points", size=5)
+        graphPlot.background_fill_color = "#f9f9f9"
+        graphPlot.grid.grid_line_color = "#e4e4e4"
+        graphPlots.append(graphPlot)
+
+    # Create grid layout with two columns
+    grid = [graphPlots[start:start + 2] for start in range(0, len(graphPlots), 2)]
+
+    saveLayout(gridplot(grid, sizing_mode='stretch_width'), outputDirectory, fileName, 'Test points VS Ideal functions',
+               openBrowser)
+
+def saveLayout(layout, outputDirectory, fileName, title, openBrowser=False):
+    """
+    Saves a Bokeh layout as a standalone HTML file, without needing a browser or a display.
+
+    Parameters:
+    layout: The Bokeh layout or figure to save.
+    outputDirectory (str): The directory of the output file.
+    fileName (str): The name of the output file, without extension.
+    title (str): The title of the HTML document.
+    openBrowser (bool): Whether to open the saved file in a browser.
+
+    Returns:
+    The path of the saved file.
+    """
+    path = os.path.join(outputDirectory, f"{fileName}.html")
+    save(layout, filename=path, resources=CDN, title=title)
+    if openBrowser:
+        view(path)
+    return path
+
+class BackgroundPlotter(PipelineStage):
+    """
+    Runs plot exports one after another on a background thread, so they don't hold up the rest of the pipeline.
+    Bokeh documents aren't thread-safe, so a single thread builds all of them.
+    The plots must only be given data that isn't changed afterwards, such as a MappingResult.
+
+    Attributes:
+        enabled (bool): Whether plots are exported at all; a disabled plotter ignores everything it is given.
+    """
+
+    def __init__(self, enabled=True):
+        """
+        Initializes the plotter. The thread is started with the first plot.
+        """
+        super().__init__("plots", enabled=enabled)
+
+def decimateLine(xValues, yValues, buckets=LINE_BUCKETS):
+    """
+    Reduces a line to the first, last, lowest and highest point of each of `buckets` equally wide x ranges.
+    At about one bucket per pixel the reduced line is drawn like the full one, while it has at most
+    4 * `buckets` points.
+
+    Parameters:
+    xValues (numpy.ndarray): The x values of the line.
+    yValues (numpy.ndarray): The y values of the line.
+    buckets (int): The number of x ranges.
+
+    Returns:
+    A tuple of the x and y values of the reduced line, ordered by x.
+    """
+    order = np.argsort(xValues, kind="stable")
+    xValues = np.asarray(xValues)[order]
+    yValues = np.asarray(yValues)[order]
+    if len(xValues) <= 4 * buckets:
+        return xValues, yValues
+
+    span = xValues[-1] - xValues[0]
+    if span == 0:
+        # All points share one x value, there is nothing to bucket
+        return xValues, yValues
+    bucket = np.minimum(((xValues - xValues[0]) / span * buckets).astype(np.intp), buckets - 1)
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    ends = np.r_[starts[1:], len(bucket)] - 1
+    # Sorted by bucket and then by y, every bucket starts with its lowest and ends with its highest point
+    byValue = np.lexsort((yValues, bucket))
+    keep = np.unique(np.concatenate([starts, ends, byValue[starts], byValue[ends]]))
+    return xValues[keep], yValues[keep]
 
 def createGraphFromTwoFunctions(scatterFunction, lineFunction, squaredError):
     """
@@ -80,12 +228,12 @@ def createGraphFromTwoFunctions(scatterFunction, lineFunction, squaredError):
     Returns:
     A Bokeh figure object.
     """
-    # First function dataframes and names
-    functionOneDataframe = scatterFunction.dataframe
+    # First function values and names, copied so the plot doesn't share data with the computation
+    functionOneData = {"x": np.array(scatterFunction.xValues), "y": np.array(scatterFunction.yValues)}
     functionOneName = scatterFunction.name
 
-    # Second function dataframes and names
-    functionTwoDataframe = lineFunction.dataframe
+    # Second function values and names
+    functionTwoData = {"x": np.array(lineFunction.xValues), "y": np.array(lineFunction.yValues)}
     functionTwoName = lineFunction.name
 
     # Get squared error rounded to two
@@ -97,8 +245,8 @@ def createGraphFromTwoFunctions(scatterFunction, lineFunction, squaredError):
 
     # Set up data sources
     dataSources = {
-        'train': ColumnDataSource(functionOneDataframe),
-        'ideal': ColumnDataSource(functionTwoDataframe)
+        'train': ColumnDataSource(functionOneData),
+        'ideal': ColumnDataSource(functionTwoData)
     }
 
     # Set up plot glyphs
@@ -120,8 +268,9 @@ def classificationGraphPlot(point, idealFunction):
     graphPlot (figure): A Bokeh figure object with the plotted graph.
     """
     if idealFunction is not None:
-        # Get data from ideal function
-        functionClassificationDataframe = idealFunction.dataframe
+        # Get the data of the ideal function, copied so the shared data of the function is never changed
+        xValues = np.array(idealFunction.xValues)
+        yValues = np.array(idealFunction.yValues)
 
         # Get string representation of point
         pointString = f"({point['x']}, {round(point['y'], 2)})"
@@ -131,14 +280,12 @@ def classificationGraphPlot(point, idealFunction):
         graphPlot = figure(title=title, x_axis_label="x", y_axis_label="y")
 
         # Plot ideal function as a line
-        graphPlot.line(functionClassificationDataframe["x"], functionClassificationDataframe["y"],
-                       legend_label="Best Ideal function", line_width=2, line_color=Colorblind5[0])
+        graphPlot.line(xValues, yValues, legend_label="Best Ideal function", line_width=2, line_color=Colorblind5[0])
 
         # Plot ideal function tolerance as a band
         idealFunctionTolerance = idealFunction.tolerance
-        functionClassificationDataframe["upper"] = functionClassificationDataframe["y"] + idealFunctionTolerance
-        functionClassificationDataframe["lower"] = functionClassificationDataframe["y"] - idealFunctionTolerance
-        dataSrc = ColumnDataSource(functionClassificationDataframe.reset_index())
+        dataSrc = ColumnDataSource({"x": xValues, "y": yValues,
+                                    "upper": yValues + idealFunctionTolerance, "lower": yValues - idealFunctionTolerance})
         band = Band(base="x", lower="lower", upper="upper", source=dataSrc, level="underlay",
                     fill_alpha=0.5, line_width=4, line_color=Colorblind5[2], fill_color=Colorblind5[2])
         graphPlot.add_layout(band)